@@ -0,0 +1,327 @@
+"""
+Procesado por lotes de tickets archivados (TICKETS_DIR) sin pasar por Telegram.
+
+Reparte las imágenes entre un pool de procesos, cada uno con su propio
+TicketPipeline precalentado, y escribe los resultados según van llegando
+(JSONL o CSV). Cada imagen terminada se apunta en un fichero de checkpoint,
+así que una ejecución interrumpida continúa donde se quedó al relanzarla con
+los mismos argumentos (--reintentar-errores vuelve a procesar también las que
+fallaron). Si un worker muere, el pool se rearranca y sus imágenes se reenvían
+sin apuntarlas como error. Sirve para reprocesar el histórico tras mejorar los parsers.
+
+Uso:
+    python batch.py tickets/ -o resultados.jsonl --workers 4
+    python batch.py "tickets/2025*.jpg" -o resultados.csv
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from ocr.engines import MOTORES
+from worker_pool import OCRWorkerPool
+
+EXTENSIONES = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+CAMPOS = ["establecimiento", "cif", "fecha", "total", "iva", "divisa", "metodo_pago"]
+COLUMNAS_CSV = ["path", "status", *CAMPOS, "min_confidence", "total_ms", "error"]
+# Imágenes en vuelo por worker: suficiente para no dejar workers parados
+# sin cargar en memoria la lista completa de rutas
+EN_VUELO_POR_WORKER = 4
+# Cada cuántas imágenes se imprime el progreso
+INTERVALO_PROGRESO = 50
+# Veces que se rearranca el pool roto antes de abandonar la ejecución
+MAX_REINICIOS_POOL = 3
+# Sufijo de las imágenes que fallaron en el checkpoint
+MARCA_ERROR = "\terror"
+
+
+class PoolRoto(Exception):
+    """El pool de workers se ha roto más veces de las permitidas."""
+
+
+def iterar_rutas(origen):
+    """Rutas de imagen de un directorio (recursivo) o de un patrón glob, sin listarlas todas antes."""
+    if os.path.isdir(origen):
+        for raiz, _, ficheros in os.walk(origen):
+            for nombre in ficheros:
+                if nombre.lower().endswith(EXTENSIONES):
+                    yield os.path.join(raiz, nombre)
+    else:
+        for ruta in glob.iglob(origen, recursive=True):
+            if os.path.isfile(ruta) and ruta.lower().endswith(EXTENSIONES):
+                yield ruta
+
+
+def cargar_checkpoint(ruta):
+    """
+    Devuelve (hechas, fallidas). Manda la última línea de cada imagen: una
+    que falló y se reintentó con éxito queda como hecha.
+    """
+    hechas, fallidas = set(), set()
+    if not os.path.exists(ruta):
+        return hechas, fallidas
+    with open(ruta, encoding="utf-8") as f:
+        for linea in f:
+            if not linea.endswith("\n"):
+                continue
+            linea = linea.rstrip("\n")
+            if linea.endswith(MARCA_ERROR):
+                ruta_imagen = linea[:-len(MARCA_ERROR)]
+                fallidas.add(ruta_imagen)
+                hechas.discard(ruta_imagen)
+            else:
+                hechas.add(linea)
+                fallidas.discard(linea)
+    return hechas, fallidas
+
+
+def _recortar_linea_incompleta(ruta):
+    """Si la ejecución anterior se cortó a mitad de escribir una fila, la descarta."""
+    if not os.path.exists(ruta) or os.path.getsize(ruta) == 0:
+        return
+    with open(ruta, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        fin = f.tell()
+        f.seek(max(0, fin - 65536))
+        cola = f.read()
+        if cola.endswith(b"\n"):
+            return
+        corte = cola.rfind(b"\n")
+        f.truncate(fin - len(cola) + corte + 1 if corte >= 0 else 0)
+
+
+class EscritorResultados:
+    """Escribe cada resultado en cuanto llega y lo apunta en el checkpoint."""
+
+    def __init__(self, salida, formato, checkpoint, con_texto=False):
+        _recortar_linea_incompleta(salida)
+        nuevo = not os.path.exists(salida) or os.path.getsize(salida) == 0
+        self.formato = formato
+        self.con_texto = con_texto
+        self.f = open(salida, "a", encoding="utf-8", newline="")
+        self.f_checkpoint = open(checkpoint, "a", encoding="utf-8")
+        if formato == "csv":
+            self.csv = csv.DictWriter(self.f, fieldnames=COLUMNAS_CSV, extrasaction="ignore")
+            if nuevo:
+                self.csv.writeheader()
+
+    def escribir(self, ruta, resultado=None, lineas=None, tiempos=None, error=None):
+        fila = {"path": ruta, "status": "error" if error else "success"}
+        fila.update(resultado or {})
+        geometria = fila.pop("geometria", None)
+        if error:
+            fila["error"] = error
+
+        if self.formato == "csv":
+            if tiempos is not None:
+                fila["total_ms"] = round(tiempos.etapas.get("total", 0.0) * 1000, 2)
+            # En CSV, la confianza del campo más dudoso de los encontrados
+            confianzas = [c for c in (fila.get("confianza") or {}).values() if c > 0]
+            if confianzas:
+                fila["min_confidence"] = min(confianzas)
+            self.csv.writerow(fila)
+        else:
+            if tiempos is not None:
+                fila["timings"] = tiempos.to_dict()
+            if self.con_texto and lineas is not None:
+                fila["ocr_text"] = lineas
+                if geometria:
+                    fila["line_geometry"] = geometria
+            self.f.write(json.dumps(fila, ensure_ascii=False) + "\n")
+        self.f.flush()
+
+        # El checkpoint va después del resultado: si se corta entre medias, la
+        # imagen se vuelve a procesar (como mucho una fila repetida, nunca perdida)
+        self.f_checkpoint.write(ruta + (MARCA_ERROR if error else "") + "\n")
+        self.f_checkpoint.flush()
+
+    def cerrar(self):
+        self.f.close()
+        self.f_checkpoint.close()
+
+
+class Progreso:
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.hechos = 0
+        self.errores = 0
+        self.etapas = defaultdict(list)
+
+    def registrar(self, tiempos=None, error=False):
+        self.hechos += 1
+        self.errores += error
+        if tiempos is not None:
+            for etapa, segundos in tiempos.etapas.items():
+                self.etapas[etapa].append(segundos)
+
+    def por_segundo(self):
+        return self.hechos / max(time.perf_counter() - self.inicio, 1e-9)
+
+    def linea(self):
+        return f"{self.hechos} imágenes ({self.errores} errores) · {self.por_segundo():.2f} img/s"
+
+    def informe(self):
+        lineas = [f"Procesadas: {self.linea()} en {time.perf_counter() - self.inicio:.1f} s"]
+        if self.etapas:
+            lineas.append(f"{'etapa':<24}{'p50 ms':>10}{'p95 ms':>10}{'media ms':>10}")
+            for etapa, valores in sorted(self.etapas.items(), key=lambda e: -sum(e[1])):
+                ms = np.array(valores) * 1000
+                lineas.append(f"{etapa:<24}{np.percentile(ms, 50):>10.1f}"
+                              f"{np.percentile(ms, 95):>10.1f}{ms.mean():>10.1f}")
+        return "\n".join(lineas)
+
+
+def ejecutar(args):
+    formato = args.format or ("csv" if args.output.lower().endswith(".csv") else "jsonl")
+    checkpoint = args.checkpoint or args.output + ".checkpoint"
+    hechos, fallidos = cargar_checkpoint(checkpoint)
+    if hechos or fallidos:
+        reintentos = f", {len(fallidos)} con error a reintentar" if args.reintentar_errores else ""
+        print(f"Reanudando: {len(hechos) + len(fallidos)} imágenes ya procesadas según {checkpoint}"
+              f"{reintentos}", file=sys.stderr)
+    if not args.reintentar_errores:
+        hechos |= fallidos
+
+    pool = OCRWorkerPool(
+        args.workers or None, args.torch_threads or None,
+        cabecera_un_paso=args.single_pass_header,
+        umbral_confianza_cabecera=args.header_min_conf,
+        escalado_adaptativo=args.adaptive_scale,
+        motor_ocr=args.ocr_engine,
+        directorio_onnx=args.onnx_dir,
+        ocr_perezoso=args.lazy_ocr,
+        umbral_confianza_campos=args.field_min_conf,
+        recortar=args.crop,
+    )
+    print(f"Arrancando {pool.num_workers} workers ({pool.torch_threads} hilos de torch cada uno)...",
+          file=sys.stderr)
+    pool.precalentar()
+
+    escritor = EscritorResultados(args.output, formato, checkpoint, con_texto=args.ocr_text)
+    progreso = Progreso()
+    max_en_vuelo = pool.num_workers * EN_VUELO_POR_WORKER
+    pendientes = {}  # future -> ruta
+    reinicios = 0
+    abortado = False
+
+    def recoger(terminados):
+        """Escribe los resultados terminados. Devuelve las rutas perdidas por un pool roto."""
+        perdidas = []
+        for future in terminados:
+            ruta = pendientes.pop(future)
+            try:
+                resultado, lineas, tiempos = future.result()
+            except BrokenProcessPool:
+                # No es un fallo de la imagen: no va al checkpoint, se reenvía
+                perdidas.append(ruta)
+                continue
+            except Exception as e:
+                escritor.escribir(ruta, error=f"{type(e).__name__}: {e}")
+                progreso.registrar(error=True)
+            else:
+                escritor.escribir(ruta, resultado, lineas, tiempos)
+                progreso.registrar(tiempos)
+            if progreso.hechos % INTERVALO_PROGRESO == 0:
+                print(progreso.linea(), file=sys.stderr)
+        return perdidas
+
+    def reparar(perdidas):
+        """Un worker ha muerto: recoge lo que queda en vuelo, rearranca el pool y reenvía lo perdido."""
+        nonlocal reinicios
+        # Con el pool roto, todo lo que está en vuelo termina enseguida (bien o roto)
+        perdidas = perdidas + recoger(wait(pendientes)[0])
+        reinicios += 1
+        if reinicios > MAX_REINICIOS_POOL:
+            raise PoolRoto(f"el pool de workers se ha roto {reinicios} veces; "
+                           f"{len(perdidas)} imágenes en vuelo quedan sin procesar")
+        print(f"Un worker ha muerto; rearrancando el pool y reenviando {len(perdidas)} imágenes "
+              f"({reinicios}/{MAX_REINICIOS_POOL})", file=sys.stderr)
+        pool.reiniciar()
+        for ruta in perdidas:
+            enviar(ruta)
+
+    def enviar(ruta):
+        try:
+            pendientes[pool.enviar_ruta(ruta)] = ruta
+        except BrokenProcessPool:
+            reparar([ruta])
+
+    def esperar():
+        terminados, _ = wait(pendientes, return_when=FIRST_COMPLETED)
+        perdidas = recoger(terminados)
+        if perdidas:
+            reparar(perdidas)
+
+    try:
+        for ruta in iterar_rutas(args.source):
+            if ruta in hechos:
+                continue
+            if len(pendientes) >= max_en_vuelo:
+                esperar()
+            enviar(ruta)
+            if args.limit and progreso.hechos + len(pendientes) >= args.limit:
+                break
+
+        while pendientes:
+            esperar()
+    except KeyboardInterrupt:
+        # Lo ya escrito queda en el checkpoint; el resto se reprocesa al relanzar
+        print("\nInterrumpido; relanza el mismo comando para continuar.", file=sys.stderr)
+    except PoolRoto as e:
+        # Las imágenes en vuelo no se apuntan: se procesan al relanzar
+        abortado = True
+        print(f"\nAbortado: {e}. Relanza el mismo comando para continuar.", file=sys.stderr)
+    finally:
+        pool.cerrar()
+        escritor.cerrar()
+
+    print(progreso.informe(), file=sys.stderr)
+    if abortado:
+        sys.exit(1)
+    return progreso
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Procesa por lotes un directorio de tickets")
+    parser.add_argument("source", nargs="?", default=os.getenv("TICKETS_DIR", "tickets"),
+                        help="directorio (recursivo) o patrón glob; por defecto TICKETS_DIR")
+    parser.add_argument("-o", "--output", required=True, help="fichero de resultados (.jsonl o .csv)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="por defecto, según la extensión")
+    parser.add_argument("--checkpoint", help="por defecto, <output>.checkpoint")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("OCR_WORKERS", "0")),
+                        help="procesos del pool (0 = número de CPUs)")
+    parser.add_argument("--torch-threads", type=int, default=int(os.getenv("OCR_TORCH_THREADS", "0")),
+                        help="hilos de torch por worker (0 = CPUs / workers)")
+    parser.add_argument("--single-pass-header", action="store_true",
+                        default=os.getenv("OCR_HEADER_SINGLE_PASS", "0") == "1")
+    parser.add_argument("--header-min-conf", type=float,
+                        default=float(os.getenv("OCR_HEADER_MIN_CONF", "0.5")))
+    parser.add_argument("--adaptive-scale", action="store_true",
+                        default=os.getenv("OCR_ADAPTIVE_SCALE", "0") == "1")
+    parser.add_argument("--ocr-engine", choices=MOTORES, default=os.getenv("OCR_ENGINE", "easyocr"))
+    parser.add_argument("--onnx-dir", default=os.getenv("OCR_ONNX_DIR") or None,
+                        help="modelos exportados de los motores ONNX")
+    parser.add_argument("--lazy-ocr", action="store_true", default=os.getenv("OCR_LAZY", "0") == "1",
+                        help="reconocer por zonas solo mientras falten campos")
+    parser.add_argument("--field-min-conf", type=float, default=float(os.getenv("OCR_FIELD_MIN_CONF", "0")),
+                        help="releer la línea de los campos con menos confianza (0 = no releer)")
+    parser.add_argument("--crop", action="store_true", default=os.getenv("OCR_CROP", "0") == "1",
+                        help="recortar el ticket (contorno y perspectiva) antes del OCR")
+    parser.add_argument("--ocr-text", action="store_true", help="incluir las líneas del OCR (solo JSONL)")
+    parser.add_argument("--retry-errors", "--reintentar-errores", dest="reintentar_errores", action="store_true",
+                        help="volver a procesar las imágenes que fallaron en ejecuciones anteriores")
+    parser.add_argument("--limit", type=int, default=0, help="procesar como mucho N imágenes nuevas")
+    args = parser.parse_args()
+    ejecutar(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+Benchmark end-to-end de TicketPipeline.procesar_ticket sobre tickets sintéticos.
+
+Mide cada etapa por separado (preprocesado, cada pasada de OCR, construcción
+de líneas y cada parser) con los tiempos que anota el propio pipeline, y
+reporta latencias p50/p95, throughput, pico de memoria (RSS) y precisión por
+campo. El resultado se puede guardar como baseline JSON y comparar con otro.
+
+Con varios motores OCR (--ocr-engine easyocr onnx-int8) se pasa el mismo
+corpus por cada uno y se imprime la tabla precisión/latencia frente al primero.
+
+Uso:
+    python -m benchmarks.pipeline_bench -n 50 --output baseline.json
+    python -m benchmarks.pipeline_bench -n 50 --noise 8 --blur 1 --compare baseline.json
+    python -m benchmarks.pipeline_bench -n 50 --ocr-engine easyocr easyocr-fp32 onnx onnx-int8
+"""
+import argparse
+import json
+import resource
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from ocr.engines import MOTORES
+from pipeline import TicketPipeline
+from utils.timing import StageTimer
+from benchmarks.synthetic import generar_corpus
+
+CAMPOS = ["establecimiento", "cif", "fecha", "total", "iva", "divisa", "metodo_pago"]
+
+
+def _normalizar(valor):
+    if valor is None:
+        return None
+    if isinstance(valor, (int, float)):
+        return f"{float(valor):.2f}"
+    return str(valor).strip().upper()
+
+
+def _percentiles(valores):
+    ms = np.array(valores) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+        "mean_ms": round(float(ms.mean()), 2),
+    }
+
+
+def pico_rss_mb():
+    # ru_maxrss está en KB en Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def ejecutar(args, motor="easyocr", corpus=None):
+    if corpus is None:
+        corpus = generar_corpus(
+            args.n, semilla=args.seed, ancho=args.width, n_items=args.items,
+            ruido=args.noise, desenfoque=args.blur, rotacion=args.rotation, fondo=args.background
+        )
+
+    # La carga incluye la exportación a ONNX la primera vez
+    inicio_carga = time.perf_counter()
+    pipeline = TicketPipeline(
+        cabecera_un_paso=args.single_pass_header,
+        escalado_adaptativo=args.adaptive_scale,
+        motor_ocr=motor,
+        directorio_onnx=args.onnx_dir,
+        ocr_perezoso=args.lazy_ocr,
+        recortar=args.crop,
+    )
+    pipeline.calentar()
+    carga = time.perf_counter() - inicio_carga
+
+    etapas = defaultdict(list)
+    totales = []
+    cajas = cajas_reconocidas = 0
+    recortes = []
+    aciertos = defaultdict(int)
+
+    inicio_total = time.perf_counter()
+    for img, verdad in corpus:
+        tiempos = StageTimer()
+        inicio = time.perf_counter()
+        resultado, _ = pipeline.procesar_ticket(img, tiempos)
+        totales.append(time.perf_counter() - inicio)
+
+        for etapa, segundos in tiempos.etapas.items():
+            etapas[etapa].append(segundos)
+        if "crop_ratio" in tiempos.datos:
+            recortes.append(tiempos.datos["crop_ratio"])
+        cajas += tiempos.datos.get("ocr_boxes", 0)
+        cajas_reconocidas += tiempos.datos.get("ocr_boxes_recognized", tiempos.datos.get("ocr_boxes", 0))
+        for campo in CAMPOS:
+            if _normalizar(resultado.get(campo)) == _normalizar(verdad[campo]):
+                aciertos[campo] += 1
+    duracion = time.perf_counter() - inicio_total
+
+    return {
+        "config": dict(vars(args), ocr_engine=motor),
+        "load_s": round(carga, 2),
+        "tickets": args.n,
+        "total": _percentiles(totales),
+        "stages": {etapa: _percentiles(valores) for etapa, valores in etapas.items()},
+        "throughput_per_s": round(args.n / duracion, 3),
+        "peak_rss_mb": pico_rss_mb(),
+        # Con --lazy-ocr, fracción de las cajas detectadas que llegaron a reconocerse
+        "recognized_boxes_ratio": round(cajas_reconocidas / cajas, 3) if cajas else None,
+        # Con --crop: tickets recortados y fracción media de píxeles conservada
+        "crop": {
+            "applied": round(sum(r < 1.0 for r in recortes) / len(recortes), 3),
+            "mean_ratio": round(sum(recortes) / len(recortes), 3),
+        } if recortes else None,
+        "accuracy": {campo: round(aciertos[campo] / args.n, 3) for campo in CAMPOS},
+    }
+
+
+def precision_media(informe):
+    return sum(informe["accuracy"].values()) / len(informe["accuracy"])
+
+
+def imprimir(informe):
+    print(f"Motor OCR: {informe['config'].get('ocr_engine', 'easyocr')}  |  carga: {informe.get('load_s', '?')} s")
+    print(f"Tickets: {informe['tickets']}  |  throughput: {informe['throughput_per_s']} tickets/s"
+          f"  |  peak RSS: {informe['peak_rss_mb']} MB")
+    if informe.get("recognized_boxes_ratio") is not None and informe["config"].get("lazy_ocr"):
+        print(f"Cajas reconocidas: {informe['recognized_boxes_ratio']:.1%} de las detectadas")
+    if informe.get("crop"):
+        print(f"Recorte: {informe['crop']['applied']:.0%} de los tickets, "
+              f"conservando de media el {informe['crop']['mean_ratio']:.0%} de los píxeles")
+    print(f"{'etapa':<32}{'p50 ms':>10}{'p95 ms':>10}{'media ms':>10}")
+    filas = list(informe["stages"].items()) + [("TOTAL", informe["total"])]
+    for etapa, t in filas:
+        print(f"{etapa:<32}{t['p50_ms']:>10}{t['p95_ms']:>10}{t['mean_ms']:>10}")
+    print("Precisión por campo:")
+    for campo, valor in informe["accuracy"].items():
+        print(f"  {campo:<18}{valor:>7.1%}")
+
+
+def comparar(informe, baseline):
+    """Imprime la diferencia de latencias y precisión respecto a un baseline."""
+    print("\nComparación con baseline:")
+    etapas = dict(informe["stages"], TOTAL=informe["total"])
+    etapas_base = dict(baseline["stages"], TOTAL=baseline["total"])
+    for etapa, t in etapas.items():
+        base = etapas_base.get(etapa)
+        if not base:
+            print(f"  {etapa:<32}(nueva)")
+            continue
+        for clave in ("p50_ms", "p95_ms"):
+            delta = t[clave] - base[clave]
+            relativo = delta / base[clave] if base[clave] else 0.0
+            print(f"  {etapa:<32}{clave:<8}{base[clave]:>10} -> {t[clave]:>10} ({relativo:+.1%})")
+    for campo, valor in informe["accuracy"].items():
+        base = baseline["accuracy"].get(campo)
+        if base is not None and base != valor:
+            print(f"  precisión {campo:<22}{base:>7.1%} -> {valor:>7.1%}")
+    # Tiempo ahorrado por ticket (p.ej. --crop frente a un baseline sin recorte)
+    ahorro = baseline["total"]["mean_ms"] - informe["total"]["mean_ms"]
+    print(f"  tiempo medio por ticket: {baseline['total']['mean_ms']} -> {informe['total']['mean_ms']} ms "
+          f"({ahorro:+.1f} ms ahorrados)")
+    base_tp = baseline["throughput_per_s"]
+    print(f"  throughput: {base_tp} -> {informe['throughput_per_s']} tickets/s")
+
+
+def comparar_motores(informes):
+    """Tabla precisión/latencia de cada motor frente al primero (la referencia)."""
+    base = informes[0]
+    print(f"\nMotores OCR frente a {base['config']['ocr_engine']}:")
+    print(f"{'motor':<16}{'carga s':>9}{'p50 ms':>10}{'p95 ms':>10}{'tickets/s':>11}"
+          f"{'precisión':>11}{'Δ p50':>9}{'Δ precisión':>13}")
+    for informe in informes:
+        p50 = informe["total"]["p50_ms"]
+        delta_p50 = (p50 - base["total"]["p50_ms"]) / base["total"]["p50_ms"] if base["total"]["p50_ms"] else 0.0
+        delta_precision = precision_media(informe) - precision_media(base)
+        print(f"{informe['config']['ocr_engine']:<16}{informe['load_s']:>9}{p50:>10}"
+              f"{informe['total']['p95_ms']:>10}{informe['throughput_per_s']:>11}"
+              f"{precision_media(informe):>11.1%}{delta_p50:>+9.1%}{delta_precision * 100:>+12.1f}pp")
+    # Los campos que cambian son los que hay que revisar antes de cambiar de motor
+    for informe in informes[1:]:
+        for campo, valor in informe["accuracy"].items():
+            if valor != base["accuracy"][campo]:
+                print(f"  {informe['config']['ocr_engine']:<14}{campo:<18}"
+                      f"{base['accuracy'][campo]:>7.1%} -> {valor:>7.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end del pipeline de tickets")
+    parser.add_argument("-n", type=int, default=20, help="número de tickets sintéticos")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--width", type=int, default=800, help="ancho del ticket en px")
+    parser.add_argument("--items", type=int, default=8, help="líneas de producto por ticket")
+    parser.add_argument("--noise", type=float, default=0.0, help="desviación del ruido gaussiano")
+    parser.add_argument("--blur", type=int, default=0, help="radio de desenfoque")
+    parser.add_argument("--rotation", type=float, default=0.0, help="rotación máxima en grados")
+    parser.add_argument("--background", action="store_true",
+                        help="tickets fotografiados sobre una mesa (fondo y perspectiva)")
+    parser.add_argument("--crop", action="store_true", help="recortar el ticket antes del preprocesado")
+    parser.add_argument("--single-pass-header", action="store_true")
+    parser.add_argument("--adaptive-scale", action="store_true")
+    parser.add_argument("--lazy-ocr", action="store_true", help="OCR en dos fases (reconocer por zonas)")
+    parser.add_argument("--ocr-engine", nargs="+", choices=MOTORES, default=["easyocr"],
+                        help="uno o varios motores OCR; el primero es la referencia")
+    parser.add_argument("--onnx-dir", help="modelos exportados de los motores ONNX")
+    parser.add_argument("--output", help="guardar el informe como JSON (baseline); "
+                                         "con varios motores, uno por motor en una lista")
+    parser.add_argument("--compare", help="baseline JSON con el que comparar")
+    args = parser.parse_args()
+
+    corpus = generar_corpus(
+        args.n, semilla=args.seed, ancho=args.width, n_items=args.items,
+        ruido=args.noise, desenfoque=args.blur, rotacion=args.rotation, fondo=args.background
+    )
+    informes = []
+    for motor in args.ocr_engine:
+        informe = ejecutar(args, motor, corpus)
+        imprimir(informe)
+        print()
+        informes.append(informe)
+
+    if len(informes) > 1:
+        # ru_maxrss es el pico del proceso: con varios motores solo el primero es fiable
+        comparar_motores(informes)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        for informe in informes:
+            comparar(informe, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(informes[0] if len(informes) == 1 else informes, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Prueba de extremo a extremo del modo cola (JOB_QUEUE_DB) en una sola máquina.
+
+Encola tickets sintéticos como lo haría el bot, arranca varios procesos
+ocr_worker.py sobre la misma cola y entrega los resultados a StandInBot, un
+cliente que imita bot.send_message y guarda los mensajes en lugar de
+enviarlos a Telegram. Al final comprueba que cada ticket se ha respondido
+(y cuántas veces) y mide la precisión por campo y el throughput.
+
+--kill-after mata un worker a mitad de la prueba para comprobar que sus
+trabajos vuelven a la cola al caducar la reserva (--visibility).
+
+Uso:
+    python -m benchmarks.queue_demo -n 20 --workers 2
+    python -m benchmarks.queue_demo -n 20 --workers 3 --kill-after 15 --visibility 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import cv2
+
+from benchmarks.pipeline_bench import CAMPOS, _normalizar
+from benchmarks.synthetic import generar_corpus
+from utils.job_queue import HECHO, JobQueue, entregar_terminados
+
+WORKER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ocr_worker.py")
+
+
+class StandInBot:
+    """Sustituto de telegram.Bot: guarda los mensajes enviados por chat."""
+
+    def __init__(self):
+        self.mensajes = defaultdict(list)  # chat_id -> [(texto, opciones)]
+
+    async def send_message(self, chat_id, text, **opciones):
+        self.mensajes[chat_id].append((text, opciones))
+
+    def enviados(self):
+        return sum(len(m) for m in self.mensajes.values())
+
+
+def arrancar_workers(args, queue_db):
+    entorno = dict(os.environ, JOB_QUEUE_DB=queue_db)
+    comando = [sys.executable, WORKER, "--visibility", str(args.visibility), "--poll", "0.2"]
+    if args.ocr_engine:
+        comando += ["--ocr-engine", args.ocr_engine]
+    if args.crop:
+        comando.append("--crop")
+    return [
+        subprocess.Popen(comando + ["--worker-id", f"demo-{i}"], env=entorno)
+        for i in range(args.workers)
+    ]
+
+
+async def entregar_todo(cola, bot, verdades, workers, timeout):
+    """
+    Entrega resultados hasta que todos los tickets tengan respuesta (o no quede
+    ningún worker vivo). Devuelve los resultados por job_id.
+    """
+    resultados = {}
+
+    async def entregar(job_id, estado, datos, resultado, error):
+        ticket = resultado["resultado"] if estado == HECHO else None
+        texto = json.dumps(ticket, ensure_ascii=False) if estado == HECHO else f"Error: {error}"
+        await bot.send_message(datos["chat_id"], texto, reply_to_message_id=datos["message_id"])
+        resultados[job_id] = (estado, ticket, resultado)
+
+    tarea = asyncio.create_task(entregar_terminados(cola, entregar, intervalo=0.2))
+    limite = time.monotonic() + timeout
+    try:
+        while len(resultados) < len(verdades) and time.monotonic() < limite:
+            if all(worker.poll() is not None for worker in workers):
+                print("No queda ningún worker en marcha", file=sys.stderr)
+                break
+            await asyncio.sleep(0.2)
+    finally:
+        tarea.cancel()
+        try:
+            await tarea
+        except asyncio.CancelledError:
+            pass
+    return resultados
+
+
+def informe(resultados, verdades, bot, segundos):
+    aciertos = defaultdict(int)
+    errores = 0
+    for job_id, verdad in verdades.items():
+        estado, ticket, _ = resultados.get(job_id, (None, None, None))
+        if estado != HECHO:
+            errores += 1
+            continue
+        for campo in CAMPOS:
+            if _normalizar(ticket.get(campo)) == _normalizar(verdad[campo]):
+                aciertos[campo] += 1
+
+    n = len(verdades)
+    print(f"Entregados: {len(resultados)}/{n} ({errores} sin resultado) en {segundos:.1f} s "
+          f"· {len(resultados) / max(segundos, 1e-9):.2f} tickets/s")
+    print(f"Mensajes enviados: {bot.enviados()} (más de uno por ticket = entrega repetida)")
+    intentos = [r["datos"].get("job_attempts", 1) for _, _, r in resultados.values() if r]
+    cola_ms = sorted(r["etapas"].get("cola", 0.0) * 1000 for _, _, r in resultados.values() if r)
+    if cola_ms:
+        print(f"Espera en cola: p50 {cola_ms[len(cola_ms) // 2]:.0f} ms, máx {cola_ms[-1]:.0f} ms")
+    if intentos and max(intentos) > 1:
+        print(f"Tickets reintentados: {sum(i > 1 for i in intentos)}")
+    print(f"{'campo':<18}{'precisión':>10}")
+    for campo in CAMPOS:
+        print(f"{campo:<18}{aciertos[campo] / n:>10.2f}")
+
+
+def ejecutar(args):
+    directorio = args.queue_dir or tempfile.mkdtemp(prefix="queue_demo_")
+    queue_db = os.path.join(directorio, "jobs.db")
+    cola = JobQueue(queue_db)
+
+    corpus = generar_corpus(args.n, semilla=args.seed, fondo=args.crop)
+    verdades = {}
+    for i, (img, verdad) in enumerate(corpus):
+        ok, jpg = cv2.imencode(".jpg", img)
+        # Tres usuarios ficticios, cada uno en su chat
+        usuario = 1000 + i % 3
+        datos = {
+            "user": {"id": usuario, "username": f"demo{usuario}", "first_name": "Demo", "last_name": None},
+            "chat_id": usuario,
+            "message_id": i,
+        }
+        verdades[cola.encolar(datos, jpg.tobytes(), job_id=f"{usuario}_{i}")] = verdad
+    print(f"{args.n} tickets encolados en {queue_db}", file=sys.stderr)
+
+    bot = StandInBot()
+    workers = arrancar_workers(args, queue_db)
+    inicio = time.perf_counter()
+    try:
+        if args.kill_after > 0:
+            # SIGKILL: el worker no llega a completar ni a devolver su trabajo
+            time.sleep(args.kill_after)
+            workers[0].send_signal(signal.SIGKILL)
+            print(f"Worker demo-0 eliminado a los {args.kill_after:.0f} s", file=sys.stderr)
+        resultados = asyncio.run(entregar_todo(cola, bot, verdades, workers, args.timeout))
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGTERM)
+        for worker in workers:
+            worker.wait()
+
+    informe(resultados, verdades, bot, time.perf_counter() - inicio)
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba del modo cola con workers locales y un bot simulado")
+    parser.add_argument("-n", type=int, default=20, help="número de tickets sintéticos")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=2, help="procesos ocr_worker.py")
+    parser.add_argument("--visibility", type=float, default=30, help="segundos de reserva de cada trabajo")
+    parser.add_argument("--kill-after", type=float, default=0,
+                        help="matar un worker tras estos segundos (0 = no)")
+    parser.add_argument("--timeout", type=float, default=600, help="segundos máximos esperando resultados")
+    parser.add_argument("--queue-dir", help="carpeta de la cola (por defecto, una temporal)")
+    parser.add_argument("--ocr-engine", help="motor OCR de los workers (por defecto OCR_ENGINE)")
+    parser.add_argument("--crop", action="store_true", help="tickets sobre una mesa y workers con --crop")
+    args = parser.parse_args()
+    ejecutar(args)
+
+
+if __name__ == "__main__":
+    main()
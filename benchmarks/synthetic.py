@@ -0,0 +1,165 @@
+"""
+Generador de tickets sintéticos en español con OpenCV (sin red ni ficheros).
+
+Cada ticket se devuelve con su verdad de referencia para medir la precisión
+de los parsers. Las fuentes Hershey de OpenCV solo tienen ASCII, así que los
+textos van sin tildes y la divisa se escribe como código (EUR, USD).
+"""
+import random
+from datetime import date, timedelta
+
+import cv2
+import numpy as np
+
+from parsers.cif import validar_cif
+
+ESTABLECIMIENTOS = [
+    "MERCADONA S.A.", "SUPERMERCADOS DIA S.A.", "BAR EL RINCON S.L.", "FNAC ESPANA S.A.",
+    "RESTAURANTE CASA PEPE S.L.", "GASOLINERA PETROPRIX S.L.", "ZARA ESPANA S.A.",
+    "LIBRERIA CENTRAL S.L.", "FARMACIA LA PLAZA S.L.", "PANADERIA SAN JUAN S.L.",
+]
+
+PRODUCTOS = [
+    "LECHE ENTERA", "PAN BARRA", "HUEVOS L", "ACEITE OLIVA", "TOMATE PERA", "CAFE MOLIDO",
+    "AGUA 1.5L", "YOGUR NATURAL", "ARROZ REDONDO", "MANZANA GOLDEN", "QUESO TIERNO",
+    "PASTA ESPIRAL", "CERVEZA LATA", "GALLETAS MARIA", "DETERGENTE", "PAPEL HIGIENICO",
+]
+
+CALLES = ["C/ MAYOR 12", "AVDA DE LA PAZ 45", "CALLE SOL 3", "PLAZA ESPANA 7"]
+
+PAGOS = ["VISA", "MASTERCARD", "EFECTIVO"]
+IVAS = [4, 10, 21]
+DIVISAS = ["EUR", "EUR", "EUR", "USD"]
+
+
+def generar_cif(rng):
+    """CIF con dígito de control válido (letra de sociedad + control numérico)."""
+    while True:
+        cif = rng.choice("ABCDEFGHJUV") + "".join(str(rng.randint(0, 9)) for _ in range(7))
+        for control in "0123456789":
+            if validar_cif(cif + control):
+                return cif + control
+
+
+def _lineas_ticket(rng, n_items):
+    establecimiento = rng.choice(ESTABLECIMIENTOS)
+    cif = generar_cif(rng)
+    fecha = date(2024, 1, 1) + timedelta(days=rng.randint(0, 600))
+    iva = rng.choice(IVAS)
+    divisa = rng.choice(DIVISAS)
+    pago = rng.choice(PAGOS)
+
+    items = []
+    for _ in range(n_items):
+        precio = rng.randint(50, 2500) / 100
+        items.append((rng.choice(PRODUCTOS), precio))
+    total = round(sum(p for _, p in items), 2)
+    base = round(total / (1 + iva / 100), 2)
+    cuota = round(total - base, 2)
+
+    lineas = [
+        establecimiento,
+        rng.choice(CALLES),
+        f"CIF: {cif}",
+        f"FECHA: {fecha.strftime('%d/%m/%Y')} {rng.randint(8, 21):02d}:{rng.randint(0, 59):02d}",
+        "",
+    ]
+    for nombre, precio in items:
+        lineas.append(f"{nombre:<22}{precio:>8.2f}".replace(".", ","))
+    lineas += [
+        "",
+        f"TOTAL {total:.2f} {divisa}".replace(".", ","),
+        f"BASE {base:.2f} IVA {iva}% {cuota:.2f}".replace(".", ","),
+        f"PAGO {pago}" if pago != "EFECTIVO" else "EFECTIVO",
+        "GRACIAS POR SU VISITA",
+    ]
+
+    verdad = {
+        "establecimiento": establecimiento,
+        "cif": cif,
+        "fecha": fecha.strftime("%d/%m/%Y"),
+        "total": f"{total:.2f}",
+        "iva": float(iva),
+        "divisa": divisa,
+        "metodo_pago": pago,
+    }
+    return lineas, verdad
+
+
+def _renderizar(lineas, ancho, rng):
+    escala_fuente = ancho / 700
+    grosor = max(1, round(escala_fuente * 2))
+    alto_linea = int(40 * escala_fuente)
+    margen = int(30 * escala_fuente)
+    alto = margen * 2 + alto_linea * len(lineas)
+
+    img = np.full((alto, ancho, 3), 250, dtype=np.uint8)
+    for i, linea in enumerate(lineas):
+        y = margen + alto_linea * (i + 1)
+        cv2.putText(img, linea, (margen, y), cv2.FONT_HERSHEY_SIMPLEX,
+                    escala_fuente, (20, 20, 20), grosor, cv2.LINE_AA)
+    return img
+
+
+def _degradar(img, rng, ruido, desenfoque, rotacion):
+    if rotacion:
+        angulo = rng.uniform(-rotacion, rotacion)
+        h, w = img.shape[:2]
+        m = cv2.getRotationMatrix2D((w / 2, h / 2), angulo, 1.0)
+        img = cv2.warpAffine(img, m, (w, h), borderValue=(250, 250, 250))
+    if desenfoque:
+        k = desenfoque * 2 + 1
+        img = cv2.GaussianBlur(img, (k, k), 0)
+    if ruido:
+        gen = np.random.default_rng(rng.randint(0, 2 ** 32 - 1))
+        img = np.clip(img + gen.normal(0, ruido, img.shape), 0, 255).astype(np.uint8)
+    return img
+
+
+def _sobre_fondo(img, rng):
+    """Coloca el ticket sobre una "mesa" más oscura, algo girado y en perspectiva."""
+    h, w = img.shape[:2]
+    alto, ancho = int(h * 1.4), int(w * 1.9)
+    gen = np.random.default_rng(rng.randint(0, 2 ** 32 - 1))
+    tono = np.array([rng.randint(60, 150) for _ in range(3)], dtype=np.float32)
+    fondo = np.clip(tono + gen.normal(0, 12, (alto, ancho, 3)), 0, 255).astype(np.uint8)
+
+    x0, y0 = (ancho - w) / 2, (alto - h) / 2
+    margen = min(w, h) * 0.06
+    destino = np.float32([
+        [x0 + rng.uniform(-margen, margen), y0 + rng.uniform(-margen, margen)],
+        [x0 + w + rng.uniform(-margen, margen), y0 + rng.uniform(-margen, margen)],
+        [x0 + w + rng.uniform(-margen, margen), y0 + h + rng.uniform(-margen, margen)],
+        [x0 + rng.uniform(-margen, margen), y0 + h + rng.uniform(-margen, margen)],
+    ])
+    origen = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    matriz = cv2.getPerspectiveTransform(origen, destino)
+    ticket = cv2.warpPerspective(img, matriz, (ancho, alto))
+    mascara = cv2.warpPerspective(np.full((h, w), 255, np.uint8), matriz, (ancho, alto))
+    fondo[mascara > 0] = ticket[mascara > 0]
+    return fondo
+
+
+def generar_ticket(rng, ancho=800, n_items=8, ruido=0.0, desenfoque=0, rotacion=0.0, fondo=False):
+    """
+    Devuelve (imagen BGR, verdad de referencia).
+
+    ancho: ancho en px (la letra escala con él)
+    n_items: número de líneas de producto
+    ruido: desviación del ruido gaussiano
+    desenfoque: radio del desenfoque gaussiano (0 = sin desenfoque)
+    rotacion: grados máximos de rotación aleatoria
+    fondo: fotografiado sobre una mesa (fondo de color y perspectiva)
+    """
+    lineas, verdad = _lineas_ticket(rng, n_items)
+    img = _renderizar(lineas, ancho, rng)
+    if fondo:
+        img = _sobre_fondo(img, rng)
+    img = _degradar(img, rng, ruido, desenfoque, rotacion)
+    return img, verdad
+
+
+def generar_corpus(n, semilla=0, **opciones):
+    """Genera `n` tickets reproducibles a partir de la semilla."""
+    rng = random.Random(semilla)
+    return [generar_ticket(rng, **opciones) for _ in range(n)]
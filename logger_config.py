@@ -1,14 +1,25 @@
+import atexit
+import gzip
+import glob
 import logging
 import os
 import json
+import queue
+import shutil
+import threading
 import uuid
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 
 # --- Constantes de Configuración ---
 LOGS_DIR = 'logs'
 TICKETS_LOGS_DIR = os.path.join(LOGS_DIR, 'tickets')
-BACKUP_COUNT = 7  # Días de logs a conservar
+BACKUP_COUNT = 7  # Días de logs generales (bot_*.log) a conservar
+# Registros pendientes de escribir; si la cola se llena se descartan (y se cuentan)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Comprimir con gzip los ficheros de días anteriores al cambiar de día
+LOG_GZIP = os.getenv("LOG_GZIP", "0") == "1"
+FORMATO_FECHA = "%d-%m-%Y"
 
 # --- Creación de Directorios ---
 os.makedirs(os.path.join(TICKETS_LOGS_DIR, 'processed'), exist_ok=True)
@@ -24,71 +35,214 @@ class JsonFormatter(logging.Formatter):
         log_record['timestamp'] = datetime.utcfromtimestamp(record.created).strftime("%Y-%m-%dT%H:%M:%SZ")
         return json.dumps(log_record, ensure_ascii=False)
 
+
+# --- Fichero diario ---
+class DailyFileHandler(logging.Handler):
+    """
+    Escribe en <directorio>/<prefijo>_DD-MM-YYYY.log según la fecha de cada
+    registro, así que cambia de fichero a medianoche aunque el bot lleve
+    semanas arrancado. Al cambiar de día puede comprimir el fichero cerrado
+    (gzip) y borrar los más antiguos (conservar = días a mantener; None = todos).
+    """
+
+    def __init__(self, directorio, prefijo, comprimir=False, conservar=None):
+        super().__init__()
+        self.directorio = directorio
+        self.prefijo = prefijo
+        self.comprimir = comprimir
+        self.conservar = conservar
+        self.fecha = None
+        self.ruta = None
+        self.stream = None
+
+    def ruta_para(self, dia):
+        return os.path.join(self.directorio, f"{self.prefijo}_{dia}.log")
+
+    def emit(self, record):
+        try:
+            fecha = datetime.fromtimestamp(record.created).date()
+            # Solo hacia delante: un registro rezagado de antes de medianoche
+            # se escribe en el fichero actual en vez de reabrir el anterior
+            if self.fecha is None or fecha > self.fecha:
+                self._cambiar_de_dia(fecha)
+            self.stream.write(self.format(record) + "\n")
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+    def _cambiar_de_dia(self, fecha):
+        if self.stream:
+            self.stream.close()
+        self.fecha = fecha
+        self.ruta = self.ruta_para(fecha.strftime(FORMATO_FECHA))
+        self.stream = open(self.ruta, "a", encoding="utf-8")
+
+        # Ficheros de días anteriores (también los que quedaron sin comprimir
+        # si el bot estaba parado a medianoche)
+        anteriores = [f for f in self._ficheros_con_fecha() if f[1] < fecha]
+        if self.conservar:
+            # El fichero de hoy cuenta como uno de los días conservados
+            dias = sorted({dia for _, dia in anteriores})
+            borrar = set(dias[:max(0, len(dias) - (self.conservar - 1))])
+            for ruta, dia in anteriores:
+                if dia in borrar:
+                    os.remove(ruta)
+            anteriores = [f for f in anteriores if f[1] not in borrar]
+        if self.comprimir:
+            for ruta, _ in anteriores:
+                if ruta.endswith(".log"):
+                    _comprimir(ruta)
+
+    def _ficheros_con_fecha(self):
+        for ruta in glob.glob(os.path.join(self.directorio, f"{self.prefijo}_*.log*")):
+            nombre = os.path.basename(ruta)[len(self.prefijo) + 1:].split(".")[0]
+            try:
+                yield ruta, datetime.strptime(nombre, FORMATO_FECHA).date()
+            except ValueError:
+                continue
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+        super().close()
+
+
+def _comprimir(ruta):
+    if not os.path.exists(ruta):
+        return
+    # "ab": si ya existe un .gz del mismo día se añade otro miembro gzip
+    with open(ruta, "rb") as origen, gzip.open(ruta + ".gz", "ab") as destino:
+        shutil.copyfileobj(origen, destino)
+    os.remove(ruta)
+
+
+# --- Cola de logging ---
+class DroppingQueueHandler(QueueHandler):
+    """
+    Solo encola el registro; el formateo (JSON) y la escritura en disco los
+    hace el hilo del QueueListener. Si la cola está llena, el registro se
+    descarta y se cuenta en lugar de bloquear el event loop.
+    """
+    descartados = 0
+    _lock_descartados = threading.Lock()
+
+    def prepare(self, record):
+        # Sin formatear aquí (el QueueHandler por defecto serializa en el hilo que llama)
+        if record.args and isinstance(record.msg, str):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with DroppingQueueHandler._lock_descartados:
+                DroppingQueueHandler.descartados += 1
+
+
+class RoutingQueueListener(QueueListener):
+    """Un solo hilo para todos los loggers: cada registro va al handler de su logger."""
+
+    def __init__(self, cola, destinos):
+        super().__init__(cola)
+        self.destinos = destinos  # nombre del logger -> handler
+
+    def handle(self, record):
+        # "utils.history" usa el destino de "utils" si no tiene uno propio
+        handler = self.destinos.get(record.name) or self.destinos.get(record.name.split(".")[0])
+        if handler is not None:
+            handler.handle(record)
+
+
+cola_logs = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+destinos_logs = {}
+listener = RoutingQueueListener(cola_logs, destinos_logs)
+
+
+def logs_descartados():
+    """Registros descartados porque la cola de logging estaba llena."""
+    return DroppingQueueHandler.descartados
+
+
 # --- Función Fábrica para Loggers ---
-def create_logger(name, log_file, level=logging.INFO, formatter=None, is_json=False, rotate=False):
-    """Crea y configura un logger.
-    Si rotate=True, se hace rotación diaria (solo para bot.log)."""
-    if rotate:
-        handler = TimedRotatingFileHandler(
-            log_file, when="midnight", interval=1, backupCount=BACKUP_COUNT, encoding='utf-8'
-        )
-    else:
-        handler = logging.FileHandler(log_file, encoding='utf-8')
+def create_logger(name, directorio, prefijo, level=logging.INFO, formatter=None, is_json=False, conservar=None):
+    """Crea y configura un logger que escribe a través de la cola.
+    El fichero es <directorio>/<prefijo>_DD-MM-YYYY.log y cambia cada día."""
+    handler = DailyFileHandler(directorio, prefijo, comprimir=LOG_GZIP, conservar=conservar)
     
     if is_json:
         handler.setFormatter(JsonFormatter())
     elif formatter:
         handler.setFormatter(formatter)
+    destinos_logs[name] = handler
     
     logger = logging.getLogger(name)
     logger.setLevel(level)
     logger.propagate = False
     if not logger.handlers:
-        logger.addHandler(handler)
+        logger.addHandler(DroppingQueueHandler(cola_logs))
     return logger
 
-# --- Fecha de hoy para logs diarios ---
-today = datetime.now().strftime("%d-%m-%Y")
-
 # --- Creación de los Loggers Específicos ---
 
-# 1. Logger General (bot_DD-MM-YYYY.log) con rotación diaria
+# 1. Logger General (bot_DD-MM-YYYY.log), se conservan BACKUP_COUNT días
 general_formatter = logging.Formatter(
     '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     datefmt='%d-%m-%Y %H:%M:%S'
 )
-general_log_file = os.path.join(LOGS_DIR, f'bot_{today}.log')
 log = create_logger(
     'general_bot',
-    general_log_file,
+    LOGS_DIR, 'bot',
     formatter=general_formatter,
-    rotate=True
+    conservar=BACKUP_COUNT
 )
 
+# Los módulos de utils/ usan logging.getLogger(__name__): sus registros van al log general
+destinos_logs["utils"] = destinos_logs["general_bot"]
+logger_utils = logging.getLogger("utils")
+logger_utils.setLevel(logging.INFO)
+logger_utils.propagate = False
+if not logger_utils.handlers:
+    logger_utils.addHandler(DroppingQueueHandler(cola_logs))
+
 # 2. Logger de Tickets Procesados (processed_DD-MM-YYYY.log)
-processed_log_file = os.path.join(TICKETS_LOGS_DIR, "processed", f"processed_{today}.log")
 success_logger = create_logger(
     'ticket_success',
-    processed_log_file,
+    os.path.join(TICKETS_LOGS_DIR, "processed"), "processed",
     is_json=True
 )
 
 # 3. Logger de OCR (ocr_DD-MM-YYYY.log)
-ocr_log_file = os.path.join(TICKETS_LOGS_DIR, "ocr", f"ocr_{today}.log")
 ocr_logger = create_logger(
     'ticket_ocr',
-    ocr_log_file,
+    os.path.join(TICKETS_LOGS_DIR, "ocr"), "ocr",
     is_json=True
 )
 
 # 4. Logger de Errores (errors_DD-MM-YYYY.log)
-error_log_file = os.path.join(TICKETS_LOGS_DIR, "errors", f"errors_{today}.log")
 error_logger = create_logger(
     'ticket_error',
-    error_log_file,
+    os.path.join(TICKETS_LOGS_DIR, "errors"), "errors",
     is_json=True
 )
 
+
+def _detener_listener():
+    # Vacía la cola y cierra los ficheros al salir
+    listener.stop()
+    for handler in set(destinos_logs.values()):
+        handler.close()
+
+
+listener.start()
+atexit.register(_detener_listener)
+
 # --- Funciones Auxiliares de Logging ---
 def _get_user_details(user):
     return {
@@ -97,9 +251,13 @@ def _get_user_details(user):
         "first_name": user.first_name
     }
 
-def log_ticket_success(user, ticket_result, ocr_text=None):
-    ticket_id = str(uuid.uuid4())
+def log_ticket_success(user, ticket_result, ocr_text=None, timings=None, ticket_id=None):
+    # ticket_id fijo (p.ej. el del trabajo en la cola) para que una entrega repetida no duplique el ticket
+    ticket_id = ticket_id or str(uuid.uuid4())
     user_details = _get_user_details(user)
+    # La geometría de las líneas va al log de OCR, junto al texto que describe
+    ticket_result = dict(ticket_result)
+    line_geometry = ticket_result.pop("geometria", None)
 
     success_log_entry = {
         "ticket_id": ticket_id,
@@ -107,6 +265,8 @@ def log_ticket_success(user, ticket_result, ocr_text=None):
         "status": "success",
         "result": ticket_result
     }
+    if timings:
+        success_log_entry["timings"] = timings
     success_logger.info(success_log_entry)
 
     if ocr_text:
@@ -115,9 +275,13 @@ def log_ticket_success(user, ticket_result, ocr_text=None):
             "user": user_details,
             "raw_text": ocr_text
         }
+        if line_geometry:
+            # [altura, confianza] de cada línea de raw_text (null si no se conoce)
+            ocr_log_entry["line_geometry"] = line_geometry
         ocr_logger.info(ocr_log_entry)
+    return ticket_id
 
-def log_ticket_error(user, error_message, raw_data=None):
+def log_ticket_error(user, error_message, raw_data=None, timings=None):
     ticket_id = str(uuid.uuid4())
     user_details = _get_user_details(user)
     
@@ -128,4 +292,6 @@ def log_ticket_error(user, error_message, raw_data=None):
         "error_description": str(error_message),
         "raw_data": raw_data
     }
+    if timings:
+        error_log_entry["timings"] = timings
     error_logger.info(error_log_entry)
@@ -1,10 +1,31 @@
 import os
+import io
+import csv
+import time
+import uuid
+import asyncio
+import tempfile
 from datetime import datetime
+from types import SimpleNamespace
 from telegram import Update
+from telegram.error import BadRequest, Forbidden
+from telegram.helpers import escape_markdown
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
 from pipeline import TicketPipeline
+from preprocess.filters import cargar_imagen
+from worker_pool import OCRWorkerPool
+from ocr.engines import crear_motor
+from ocr.batching import BatchingOCREngine
+from utils.result_cache import ResultCache
+from utils.sessions import SessionStore
+from utils.scheduler import FairScheduler, ColaLlena
+from utils.albums import AlbumCollector
+from utils.history import TicketHistory, COLUMNAS_EXPORTACION
+from utils.job_queue import JobQueue, HECHO, entregar_terminados
+from utils.timing import StageTimer
+from metrics import metrics, iniciar_servidor_metricas
 from dotenv import load_dotenv
-from logger_config import log, log_ticket_success, log_ticket_error
+from logger_config import log, log_ticket_success, log_ticket_error, logs_descartados
 
 # 🔑 Cargar variables desde .env
 load_dotenv()  # Busca automáticamente un archivo .env en el directorio actual
@@ -22,12 +43,126 @@ if missing_vars:
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 TICKETS_DIR = os.getenv("TICKETS_DIR", "tickets")
 os.makedirs(TICKETS_DIR, exist_ok=True)
+# Guardar una copia de cada foto en TICKETS_DIR (se escribe después de responder)
+ARCHIVE_TICKETS = os.getenv("ARCHIVE_TICKETS", "1") == "1"
+
+# Fichero que se crea cuando el modelo OCR está listo (para healthchecks; vacío = ninguno)
+READY_FILE = os.getenv("READY_FILE", "")
+
+# Endpoint local de métricas en formato Prometheus (0 = desactivado)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# IDs de Telegram (separados por comas) que pueden usar /stats
+ADMIN_IDS = {int(i) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()}
+
+# Pool de workers OCR (0 = OCR dentro del proceso del bot)
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "0"))
+# Hilos intra-op de torch por worker (0 = CPUs / OCR_WORKERS)
+OCR_TORCH_THREADS = int(os.getenv("OCR_TORCH_THREADS", "0"))
+
+# Encabezado a partir del OCR completo en lugar de un segundo OCR del recorte superior
+OCR_HEADER_SINGLE_PASS = os.getenv("OCR_HEADER_SINGLE_PASS", "0") == "1"
+# Confianza mínima de las cajas del encabezado antes de releerlas (modo un paso)
+OCR_HEADER_MIN_CONF = float(os.getenv("OCR_HEADER_MIN_CONF", "0.5"))
+# Micro-batching de OCR entre peticiones concurrentes (solo sin pool; 0/1 = desactivado)
+OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", "0"))
+OCR_BATCH_WINDOW_MS = int(os.getenv("OCR_BATCH_WINDOW_MS", "40"))
+# Escala según la altura del texto en lugar de ampliar siempre x2
+OCR_ADAPTIVE_SCALE = os.getenv("OCR_ADAPTIVE_SCALE", "0") == "1"
+# Motor OCR: easyocr, easyocr-fp32, onnx u onnx-int8 (ver ocr/engines.py)
+OCR_ENGINE = os.getenv("OCR_ENGINE", "easyocr")
+# Carpeta de los modelos exportados por los motores ONNX (vacío = ~/.EasyOCR/onnx)
+OCR_ONNX_DIR = os.getenv("OCR_ONNX_DIR", "")
+# OCR en dos fases: detectar todo y reconocer por zonas solo mientras falten campos
+OCR_LAZY = os.getenv("OCR_LAZY", "0") == "1"
+# Campos que tienen que aparecer para dejar de reconocer zonas (separados por comas)
+OCR_LAZY_REQUIRED = [c.strip() for c in os.getenv("OCR_LAZY_REQUIRED", "establecimiento,fecha,total").split(",") if c.strip()]
+# Confianza mínima por campo antes de releer su línea (0 = no releer; la confianza se registra siempre)
+OCR_FIELD_MIN_CONF = float(os.getenv("OCR_FIELD_MIN_CONF", "0"))
+# Recortar el ticket (contorno + perspectiva) antes del preprocesado
+OCR_CROP = os.getenv("OCR_CROP", "0") == "1"
+PIPELINE_OPTIONS = {
+    "motor_ocr": OCR_ENGINE,
+    "directorio_onnx": OCR_ONNX_DIR or None,
+    "cabecera_un_paso": OCR_HEADER_SINGLE_PASS,
+    "umbral_confianza_cabecera": OCR_HEADER_MIN_CONF,
+    "escalado_adaptativo": OCR_ADAPTIVE_SCALE,
+    "ocr_perezoso": OCR_LAZY,
+    "campos_requeridos": OCR_LAZY_REQUIRED,
+    "umbral_confianza_campos": OCR_FIELD_MIN_CONF,
+    "recortar": OCR_CROP,
+}
+
+# Caché de resultados para fotos reenviadas (0 = desactivada)
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+# Carpeta para guardar también la caché en disco (vacío = solo memoria)
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+# Distancia de Hamming máxima del hash perceptual para casi-duplicados del mismo usuario (0 = desactivado)
+RESULT_CACHE_PHASH_DISTANCE = int(os.getenv("RESULT_CACHE_PHASH_DISTANCE", "0"))
+# Ficheros como mucho en RESULT_CACHE_DIR (se borran los más antiguos)
+RESULT_CACHE_DISK_SIZE = int(os.getenv("RESULT_CACHE_DISK_SIZE", "10000"))
+
+# Último ticket de cada usuario (para /editar)
+# Usuarios con sesión en memoria como máximo (se expulsa el menos reciente)
+SESSION_MAX_USERS = int(os.getenv("SESSION_MAX_USERS", "10000"))
+# Horas que se puede editar un ticket desde que se procesó o editó por última vez
+SESSION_TTL_HOURS = float(os.getenv("SESSION_TTL_HOURS", "24"))
+# Base de datos SQLite para conservar las sesiones entre reinicios (vacío = solo memoria)
+SESSION_DB = os.getenv("SESSION_DB", "")
+# Segundos entre volcados de las sesiones modificadas a SESSION_DB
+SESSION_FLUSH_SECONDS = float(os.getenv("SESSION_FLUSH_SECONDS", "5"))
+
+# Historial de tickets en SQLite para /historial, /resumen y /exportar (vacío = desactivado)
+HISTORY_DB = os.getenv("HISTORY_DB", "")
+
+# Tickets procesándose a la vez (0 = automático: workers del pool, tamaño del lote o 1)
+OCR_MAX_IN_FLIGHT = int(os.getenv("OCR_MAX_IN_FLIGHT", "0"))
+# Tickets esperando turno; por encima se responde "inténtalo más tarde"
+OCR_MAX_QUEUE = int(os.getenv("OCR_MAX_QUEUE", "100"))
+
+# Segundos sin fotos nuevas de un álbum antes de procesarlo entero (0 = cada foto por separado)
+ALBUM_WINDOW_SECONDS = float(os.getenv("ALBUM_WINDOW_SECONDS", "1.5"))
+
+# Cola de trabajos duradera en SQLite: el bot solo encola y responde, el OCR
+# lo hacen procesos ocr_worker.py aparte (vacío = OCR en este proceso)
+JOB_QUEUE_DB = os.getenv("JOB_QUEUE_DB", "")
+# Carpeta de las fotos encoladas, visible para todos los workers (vacío = junto a JOB_QUEUE_DB)
+JOB_QUEUE_IMAGES_DIR = os.getenv("JOB_QUEUE_IMAGES_DIR", "")
+# Segundos entre consultas de resultados terminados cuando no hay ninguno
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+# Intentos de enviar un resultado antes de darlo por entregado
+JOB_MAX_DELIVERY_ATTEMPTS = int(os.getenv("JOB_MAX_DELIVERY_ATTEMPTS", "5"))
+# Días que se conservan los trabajos entregados (y sus fotos) antes de borrarlos
+JOB_RETENTION_DAYS = float(os.getenv("JOB_RETENTION_DAYS", "7"))
 
 # Estado temporal de tickets por usuario
-user_tickets = {}
+user_tickets = SessionStore(SESSION_MAX_USERS, SESSION_TTL_HOURS * 3600, SESSION_DB or None, SESSION_FLUSH_SECONDS)
+
+# Pipeline OCR: se carga en segundo plano cuando el bot ya está respondiendo
+# (en modo pool cada worker carga su propio EasyOCR y aquí no se crea)
+pipeline = None
+ocr_pool = None
+# Señal de disponibilidad del modelo; las fotos que llegan antes esperan a ella
+modelo_listo = asyncio.Event()
+modelo_error = None
+carga_modelo_task = None
+
+historial = TicketHistory(HISTORY_DB) if HISTORY_DB else None
+planificador = None
+albumes = None
+# Modo cola: trabajos para ocr_worker.py y tarea que entrega sus resultados
+cola_trabajos = None
+entrega_task = None
+
+result_cache = None
+if RESULT_CACHE_SIZE > 0:
+    result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_DIR or None, RESULT_CACHE_PHASH_DISTANCE,
+                               RESULT_CACHE_DISK_SIZE)
 
-# Inicializamos pipeline OCR
-pipeline = TicketPipeline()
+# Buffers de descarga reutilizables y tareas de archivado pendientes
+MAX_DOWNLOAD_BUFFERS = 8
+download_buffers = []
+archive_tasks = set()
 
 # --- Función auxiliar para logging ---
 def get_user_info(user: Update.effective_user) -> str:
@@ -64,7 +199,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "📸 Envía una foto de tu ticket y te devolveré los campos extraídos.\n\n"
         "📝 Para modificar algún campo puedes usar:\n"
-        "`/editar campo valor`",
+        "`/editar campo valor`\n\n"
+        "🗂️ Si envías varios tickets en un álbum te respondo con un resumen; "
+        "edita cada uno con `/editar n campo valor`.\n\n"
+        "🧾 `/historial` muestra tus últimos tickets, `/resumen mes` lo gastado este mes "
+        "y `/exportar` te envía todos tus tickets en CSV.",
         parse_mode="Markdown"
     )
 
@@ -84,29 +223,459 @@ def format_ticket(ticket: dict) -> str:
     )
     return result
 
+# --- Carga del modelo en segundo plano ---
+def crear_pipeline() -> TicketPipeline:
+    ocr_engine = crear_motor(OCR_ENGINE, OCR_ONNX_DIR or None)
+    if OCR_BATCH_SIZE > 1:
+        ocr_engine = BatchingOCREngine(ocr_engine, ventana_ms=OCR_BATCH_WINDOW_MS, max_lote=OCR_BATCH_SIZE)
+    nuevo = TicketPipeline(ocr=ocr_engine, **PIPELINE_OPTIONS)
+    nuevo.calentar()
+    return nuevo
+
+def marcar_listo():
+    metrics.fijar("ocr_model_ready", 1)
+    if READY_FILE:
+        with open(READY_FILE, "w") as f:
+            f.write(datetime.now().isoformat())
+
+async def cargar_modelo():
+    """Carga y precalienta el OCR fuera del event loop y marca el bot como listo."""
+    global pipeline, modelo_error
+    log.info("Loading OCR model in background...")
+    try:
+        if ocr_pool is not None:
+            await asyncio.to_thread(ocr_pool.precalentar)
+        else:
+            pipeline = await asyncio.to_thread(crear_pipeline)
+    except Exception as e:
+        modelo_error = e
+        log.critical(f"Could not load the OCR model: {e}", exc_info=True)
+    else:
+        log.info("OCR model loaded and warmed up.")
+        marcar_listo()
+    finally:
+        # También en caso de error, para que las fotos en espera no se queden colgadas
+        modelo_listo.set()
+
+def max_en_vuelo():
+    """Tickets a la vez por defecto: uno por worker del pool, o el lote de OCR si hay batching."""
+    if OCR_MAX_IN_FLIGHT > 0:
+        return OCR_MAX_IN_FLIGHT
+    if ocr_pool is not None:
+        return ocr_pool.num_workers
+    return OCR_BATCH_SIZE if OCR_BATCH_SIZE > 1 else 1
+
+async def post_init(app):
+    global carga_modelo_task, planificador, albumes, cola_trabajos, entrega_task
+    planificador = FairScheduler(max_en_vuelo(), OCR_MAX_QUEUE)
+    albumes = AlbumCollector(encolar_album, ALBUM_WINDOW_SECONDS)
+    metrics.fijar("ocr_jobs_rejected", lambda: planificador.rechazados)
+    if JOB_QUEUE_DB:
+        # El modelo lo cargan los workers; el bot está listo en cuanto abre la cola
+        cola_trabajos = await asyncio.to_thread(JobQueue, JOB_QUEUE_DB, JOB_QUEUE_IMAGES_DIR or None,
+                                                max_entregas=JOB_MAX_DELIVERY_ATTEMPTS)
+        metrics.fijar("ocr_queue_depth", cola_trabajos.pendientes)
+        modelo_listo.set()
+        marcar_listo()
+        entrega_task = asyncio.create_task(
+            entregar_terminados(cola_trabajos, lambda *trabajo: entregar_trabajo(app.bot, *trabajo),
+                                JOB_POLL_SECONDS, JOB_RETENTION_DAYS * 86400)
+        )
+        log.info(f"Job queue mode: OCR jobs go to {JOB_QUEUE_DB} for ocr_worker.py processes.")
+    else:
+        metrics.fijar("ocr_queue_depth", lambda: planificador.pendientes)
+        metrics.fijar("ocr_jobs_in_flight", lambda: planificador.en_vuelo)
+        carga_modelo_task = asyncio.create_task(cargar_modelo())
+    await user_tickets.iniciar()
+    if historial is not None:
+        await asyncio.to_thread(historial.iniciar)
+
+async def post_shutdown(app):
+    # Volcar las sesiones y el historial pendientes antes de salir
+    if albumes is not None:
+        await albumes.cerrar()
+    if planificador is not None:
+        await planificador.cerrar()
+    if entrega_task is not None:
+        # Lo que no se haya marcado como entregado se entrega en el siguiente arranque
+        entrega_task.cancel()
+        try:
+            await entrega_task
+        except asyncio.CancelledError:
+            pass
+    await user_tickets.cerrar()
+    if historial is not None:
+        await historial.cerrar()
+
+async def esperar_modelo(update: Update):
+    """Deja en cola la foto hasta que el modelo esté cargado, avisando al usuario."""
+    if not modelo_listo.is_set():
+        await update.message.reply_text("⏳ El bot se está iniciando. Tu ticket se procesará en cuanto esté listo.")
+        await modelo_listo.wait()
+
+# --- Ejecución del pipeline ---
+async def ejecutar_pipeline(imagen, tiempos=None):
+    """
+    Procesa el ticket en el pool de workers si está activo; si no, en este proceso.
+    imagen: ruta, bytes de la foto o ndarray.
+    tiempos: StageTimer donde se anotan las etapas del pipeline.
+    """
+    if modelo_error is not None:
+        raise RuntimeError(f"El modelo OCR no está disponible: {modelo_error}")
+
+    if ocr_pool is None:
+        # En un hilo para no bloquear el event loop; el planificador limita cuántos
+        # van a la vez (con batching, varios para que su OCR se agrupe)
+        return await asyncio.to_thread(pipeline.procesar_ticket, imagen, tiempos)
+
+    # El pool preprocesa con las mismas PIPELINE_OPTIONS que sus workers
+    return await ocr_pool.procesar_ticket(imagen, tiempos)
+
+async def ejecutar_lote(imagenes, tiempos):
+    """
+    Varios tickets juntos (un álbum). Sin pool, una sola llamada a
+    TicketPipeline.procesar_lote (preprocesado en paralelo y OCR por lotes);
+    con pool, repartidos entre los workers a la vez.
+    Devuelve (resultado, ocr_text) o la excepción de cada imagen, en orden.
+    """
+    if modelo_error is not None:
+        raise RuntimeError(f"El modelo OCR no está disponible: {modelo_error}")
+    if ocr_pool is None:
+        return await asyncio.to_thread(pipeline.procesar_lote, imagenes, tiempos)
+    return await asyncio.gather(
+        *(ejecutar_pipeline(img, t) for img, t in zip(imagenes, tiempos)), return_exceptions=True
+    )
+
+# --- Descarga en memoria y archivado ---
+def tomar_buffer() -> io.BytesIO:
+    return download_buffers.pop() if download_buffers else io.BytesIO()
+
+def devolver_buffer(buffer: io.BytesIO):
+    buffer.seek(0)
+    buffer.truncate()
+    if len(download_buffers) < MAX_DOWNLOAD_BUFFERS:
+        download_buffers.append(buffer)
+
+def _escribir_fichero(filename, buffer):
+    with open(filename, "wb") as f:
+        f.write(buffer.getbuffer())
+
+async def archivar_foto(filename, buffer):
+    """Guarda la foto original en disco fuera del event loop y libera el buffer."""
+    try:
+        await asyncio.to_thread(_escribir_fichero, filename, buffer)
+    except Exception as e:
+        log.error(f"Error archiving photo {filename}: {e}")
+    finally:
+        devolver_buffer(buffer)
+
+def programar_archivado(filename, buffer):
+    # Sin datos cuando el resultado salió de la caché sin descargar la foto
+    if not ARCHIVE_TICKETS or buffer.seek(0, io.SEEK_END) == 0:
+        devolver_buffer(buffer)
+        return
+    task = asyncio.create_task(archivar_foto(filename, buffer))
+    archive_tasks.add(task)
+    task.add_done_callback(archive_tasks.discard)
+
+# --- Procesado de una foto (con caché de resultados) ---
+async def preparar_foto(photo, context, buffer, tiempos, user_id):
+    """
+    Descarga y decodifica una foto de Telegram, consultando antes la caché.
+    Devuelve (cached, img, claves): cached es (resultado, ocr_text, ticket_id)
+    si la foto ya estaba en caché (ticket_id None si este usuario aún no la
+    había enviado); si no, img es la imagen. claves (hash, phash, user_id) son
+    las de la caché para guardar el resultado (None sin caché; el hash es None
+    si se encontró por file_unique_id).
+    """
+    if result_cache is not None:
+        cached = await result_cache.buscar_file_id(photo.file_unique_id, user_id)
+        if cached:
+            log.info(f"Result cache hit (file_unique_id): {result_cache.resumen()}")
+            tiempos.anotar(cache_hit=True)
+            return cached, None, (None, None, user_id)
+
+    with tiempos.medir("descarga"):
+        file = await context.bot.get_file(photo.file_id)
+        await file.download_to_memory(out=buffer)
+    with tiempos.medir("decodificacion"):
+        with buffer.getbuffer() as datos:
+            img = await asyncio.to_thread(cargar_imagen, datos)
+    if img is None:
+        raise ValueError("No se pudo decodificar la imagen.")
+    tiempos.anotar(photo_height=int(img.shape[0]), photo_width=int(img.shape[1]))
+
+    if result_cache is None:
+        return None, img, None
+
+    with tiempos.medir("cache"):
+        hash_img, phash = await asyncio.to_thread(result_cache.claves, img)
+        cached = await result_cache.buscar_imagen(hash_img, phash, user_id)
+    if cached:
+        log.info(f"Result cache hit (image): {result_cache.resumen()}")
+        tiempos.anotar(cache_hit=True)
+    return cached, img, (hash_img, phash, user_id)
+
+async def guardar_en_cache(photo, claves, resultado, ocr_text):
+    """
+    Guarda el resultado del pipeline en la caché con un ticket_id nuevo.
+    Devuelve (resultado, ocr_text, ticket_id, nuevo) como ticket_de_cache.
+    """
+    if result_cache is None or claves is None:
+        return resultado, ocr_text, None, True
+    hash_img, phash, user_id = claves
+    ticket_id = str(uuid.uuid4())
+    await result_cache.guardar(resultado, ocr_text, hash_img, photo.file_unique_id, phash, user_id, ticket_id)
+    log.info(f"Result cache miss: {result_cache.resumen()}")
+    return resultado, ocr_text, ticket_id, True
+
+async def ticket_de_cache(photo, claves, cached):
+    """
+    Devuelve (resultado, ocr_text, ticket_id, nuevo) de un acierto de caché.
+    Si el usuario ya había enviado la foto se reutiliza su ticket_id (nuevo=False)
+    y no se vuelve a registrar; si la envió otro, es un ticket nuevo para este.
+    """
+    resultado, ocr_text, ticket_id = cached
+    if ticket_id:
+        return resultado, ocr_text, ticket_id, False
+    hash_img, _, user_id = claves
+    ticket_id = str(uuid.uuid4())
+    await result_cache.asociar_ticket(user_id, ticket_id, photo.file_unique_id, hash_img)
+    return resultado, ocr_text, ticket_id, True
+
+def registrar_ticket(user, resultado, ocr_text, tiempos, ticket_id, nuevo):
+    """Registra un ticket nuevo en el log y el historial; un reenvío solo conserva su ticket_id."""
+    if not nuevo:
+        log.info(f"Photo from user {get_user_info(user)} is a resend of ticket {ticket_id}; not logged again.")
+        return ticket_id
+    ticket_id = log_ticket_success(user, resultado, ocr_text=ocr_text, timings=tiempos.to_dict(), ticket_id=ticket_id)
+    if historial is not None:
+        historial.registrar(ticket_id, user.id, resultado)
+    return ticket_id
+
+async def procesar_foto(photo, context, buffer, tiempos, user_id):
+    """
+    Devuelve (resultado, ocr_text, ticket_id, nuevo) de una foto de Telegram.
+    La foto se descarga en `buffer` salvo que su file_unique_id ya esté en caché.
+    Los tiempos de cada etapa se anotan en `tiempos`.
+    """
+    cached, img, claves = await preparar_foto(photo, context, buffer, tiempos, user_id)
+    if cached:
+        return await ticket_de_cache(photo, claves, cached)
+    resultado, ocr_text = await ejecutar_pipeline(img, tiempos)
+    return await guardar_en_cache(photo, claves, resultado, ocr_text)
+
 # --- Manejo de imágenes ---
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
+    """
+    Encola la foto en el planificador y responde enseguida con su puesto en la cola.
+    Las fotos de un álbum se esperan y se encolan juntas (encolar_album).
+    """
     user_info = get_user_info(update.effective_user)
     log.info(f"Photo received from user {user_info}.")
+
+    if cola_trabajos is not None:
+        await encolar_trabajo(update, context)
+        return
+
+    if update.message.media_group_id and ALBUM_WINDOW_SECONDS > 0:
+        # Las fotos del álbum se juntan y se procesan en un solo trabajo (encolar_album)
+        albumes.agregar((update.effective_chat.id, update.message.media_group_id), (update, context))
+        return
+
+    await admitir_foto(update, context)
+
+async def admitir_foto(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Encola una foto suelta en el planificador y responde con su puesto en la cola."""
+    user = update.effective_user
+    user_info = get_user_info(user)
+
+    async def trabajo(espera):
+        await procesar_mensaje_foto(update, context, espera)
+
     try:
+        posicion = planificador.enviar(user.id, trabajo)
+    except ColaLlena:
+        log.warning(f"OCR queue full, photo from user {user_info} rejected. {planificador.resumen()}")
+        await update.message.reply_text(
+            "🚦 Ahora mismo hay muchos tickets en cola. Por favor, vuelve a enviarlo en unos minutos."
+        )
+        return
+
+    if posicion == 0:
         await update.message.reply_text("✅ Ticket recibido. Procesando...")
+    else:
+        await update.message.reply_text(
+            f"✅ Ticket recibido. Estás en el puesto {posicion} de la cola; te respondo en cuanto lo procese."
+        )
+
+async def encolar_album(clave, mensajes):
+    """
+    Un álbum completo entra en el planificador como un único trabajo, que
+    cuenta como tantos tickets en vuelo como fotos (hasta OCR_MAX_IN_FLIGHT).
+    """
+    update, context = mensajes[0]
+    user = update.effective_user
+    user_info = get_user_info(user)
+    if len(mensajes) == 1:
+        # Álbum de una sola foto (o ventana agotada entre fotos): como una foto suelta
+        await admitir_foto(update, context)
+        return
+
+    log.info(f"Album of {len(mensajes)} photos received from user {user_info}.")
+
+    async def trabajo(espera):
+        await procesar_album([u for u, _ in mensajes], context, espera)
+
+    try:
+        posicion = planificador.enviar(user.id, trabajo, peso=len(mensajes))
+    except ColaLlena:
+        log.warning(f"OCR queue full, album from user {user_info} rejected. {planificador.resumen()}")
+        await update.message.reply_text(
+            "🚦 Ahora mismo hay muchos tickets en cola. Por favor, vuelve a enviarlos en unos minutos."
+        )
+        return
+
+    if posicion == 0:
+        await update.message.reply_text(f"✅ {len(mensajes)} tickets recibidos. Procesando...")
+    else:
+        await update.message.reply_text(
+            f"✅ {len(mensajes)} tickets recibidos. Estás en el puesto {posicion} de la cola; "
+            "te respondo en cuanto los procese."
+        )
+
+def format_album(tickets, errores) -> str:
+    """Resumen de un álbum: una línea por ticket (numerados para /editar) y el total por divisa."""
+    lineas = [f"🧾 *{len(tickets)} tickets procesados*\n"]
+    totales = {}
 
-        # Guardar la foto original
+    def campo(valor):
+        # Texto del OCR: un _ o * suelto rompería el Markdown de todo el mensaje
+        return escape_markdown(str(valor)) if valor not in (None, "") else "_¿?_"
+
+    for n, ticket in enumerate(tickets, 1):
+        total = ticket.get("total")
+        divisa = ticket.get("divisa") or ""
+        lineas.append(
+            f"{n}. 🏬 {campo(ticket.get('establecimiento'))} · 📅 {campo(ticket.get('fecha'))} · "
+            f"💰 {campo(total)} {escape_markdown(divisa)}".rstrip()
+        )
+        if total is not None:
+            try:
+                totales[divisa] = totales.get(divisa, 0.0) + float(total)
+            except (TypeError, ValueError):
+                pass
+    if errores:
+        lineas.append("\n⚠️ *Fotos sin procesar:*")
+        lineas.extend(f"• Foto {n}: {escape_markdown(str(error))}" for n, error in errores)
+    if totales:
+        lineas.append("\n💰 *Total:* " + ", ".join(f"{t:.2f} {escape_markdown(d)}".rstrip()
+                                                  for d, t in totales.items()))
+    lineas.append("\n📝 _Para corregir un ticket:_ `/editar n campo valor`, _por ejemplo_ `/editar 2 total 5.15`")
+    return "\n".join(lineas)
+
+async def procesar_album(updates, context: ContextTypes.DEFAULT_TYPE, espera=0.0):
+    """
+    Procesa las fotos de un álbum juntas: descarga en paralelo, un único lote
+    de OCR para las que no están en caché y una sola respuesta con todos los
+    tickets. Todos quedan en el historial y editables con /editar n.
+    """
+    primero = updates[0]
+    user = primero.effective_user
+    user_info = get_user_info(user)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    fotos = [u.message.photo[-1] for u in updates]  # mayor resolución
+    buffers = [tomar_buffer() for _ in updates]
+    tiempos = [StageTimer() for _ in updates]
+    for t in tiempos:
+        t.sumar("cola", espera)
+        t.anotar(album_size=len(updates))
+    salidas = [None] * len(updates)
+    try:
+        with tiempos[0].medir("espera_modelo"):
+            await esperar_modelo(primero)
+
+        inicio = time.perf_counter()
+        preparadas = await asyncio.gather(
+            *(preparar_foto(f, context, b, t, user.id) for f, b, t in zip(fotos, buffers, tiempos)),
+            return_exceptions=True
+        )
+        pendientes = []  # índices que necesitan OCR
+        for i, preparada in enumerate(preparadas):
+            if isinstance(preparada, Exception):
+                salidas[i] = preparada
+            elif preparada[0]:
+                salidas[i] = await ticket_de_cache(fotos[i], preparada[2], preparada[0])
+            else:
+                pendientes.append(i)
+        if pendientes:
+            procesadas = await ejecutar_lote([preparadas[i][1] for i in pendientes], [tiempos[i] for i in pendientes])
+            for i, salida in zip(pendientes, procesadas):
+                if not isinstance(salida, Exception):
+                    salida = await guardar_en_cache(fotos[i], preparadas[i][2], *salida)
+                salidas[i] = salida
+        duracion = time.perf_counter() - inicio
+    except Exception as e:
+        duracion = 0.0
+        salidas = [s if s is not None else e for s in salidas]
+
+    tickets, errores = [], []
+    for n, (salida, t) in enumerate(zip(salidas, tiempos), 1):
+        # El lote se procesa a la vez: cada ticket cuenta la duración del álbum entero
+        t.sumar("total", duracion)
+        if isinstance(salida, Exception):
+            log.error(f"Error processing photo {n} of album for user {user_info}: {salida}")
+            log_ticket_error(user, error_message=str(salida), timings=t.to_dict())
+            metrics.registrar_ticket(t, estado="error")
+            errores.append((n, salida))
+            continue
+        resultado, ocr_text, ticket_id, nuevo = salida
+        ticket_id = registrar_ticket(user, resultado, ocr_text, t, ticket_id, nuevo)
+        metrics.registrar_ticket(t)
+        tickets.append((resultado, ticket_id))
+
+    try:
+        if tickets:
+            await user_tickets.guardar_album(user.id, tickets)
+            log.info(f"Album processed for user {user_info}: {len(tickets)} tickets, {len(errores)} errors.")
+            await primero.message.reply_text(format_album([r for r, _ in tickets], errores), parse_mode="Markdown")
+        else:
+            await primero.message.reply_text(f"⚠️ Error procesando las imágenes: {errores[0][1]}")
+    except Exception as e:
+        log.error(f"Error replying to album for user {user_info}: {e}", exc_info=False)
+        await primero.message.reply_text(f"⚠️ Error procesando las imágenes: {e}")
+    finally:
+        for n, (update, buffer) in enumerate(zip(updates, buffers), 1):
+            programar_archivado(f"{TICKETS_DIR}/{timestamp}_{user.id}_{n}.jpg", buffer)
+
+async def procesar_mensaje_foto(update: Update, context: ContextTypes.DEFAULT_TYPE, espera=0.0):
+    """Procesa una foto ya admitida por el planificador y responde con el resultado."""
+    user = update.effective_user
+    user_info = get_user_info(update.effective_user)
+    buffer = None
+    tiempos = StageTimer()
+    tiempos.sumar("cola", espera)
+    try:
+        with tiempos.medir("espera_modelo"):
+            await esperar_modelo(update)
+
+        # La foto se descarga en memoria (se archiva en disco al final)
         photo = update.message.photo[-1]  # mayor resolución
-        file = await context.bot.get_file(photo.file_id)
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         filename = f"{TICKETS_DIR}/{timestamp}_{user.id}.jpg"
-        await file.download_to_drive(filename)
+        buffer = tomar_buffer()
 
         # Procesar ticket
         # Asumimos que el pipeline devuelve tanto el resultado procesado como el texto crudo del OCR
-        resultado, ocr_text = pipeline.procesar_ticket(filename)
-        user_tickets[user.id] = resultado
+        with tiempos.medir("total"):
+            resultado, ocr_text, ticket_id, nuevo = await procesar_foto(photo, context, buffer, tiempos, user.id)
         
         # Usamos el nuevo sistema de logging para tickets
         # Esto guardará el resultado en 'processed.log' y el texto OCR en 'ocr.log'
-        log_ticket_success(user, resultado, ocr_text=ocr_text)
+        # (una foto reenviada conserva su ticket_id y no se registra otra vez)
+        ticket_id = registrar_ticket(user, resultado, ocr_text, tiempos, ticket_id, nuevo)
+        await user_tickets.guardar(user.id, resultado, ticket_id)
+        metrics.registrar_ticket(tiempos)
         log.info(f"Photo processed for user {user_info}.")
         # Mostrar resultado
         await update.message.reply_text(format_ticket(resultado), parse_mode="Markdown")
@@ -115,8 +684,102 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Loguear el error general en bot.log
         log.error(f"Error processing photo for user {user_info}: {e}", exc_info=False) # exc_info=False para no duplicar stack trace
         # Usar el nuevo sistema de logging para errores de ticket
-        log_ticket_error(user, error_message=str(e))
+        log_ticket_error(user, error_message=str(e), timings=tiempos.to_dict())
+        metrics.registrar_ticket(tiempos, estado="error")
+        await update.message.reply_text(f"⚠️ Error procesando la imagen: {e}")
+
+    finally:
+        if buffer is not None:
+            programar_archivado(filename, buffer)
+
+# --- Modo cola: encolar para ocr_worker.py y entregar sus resultados ---
+async def encolar_trabajo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Descarga la foto y la deja en la cola duradera; la respuesta llega desde entregar_trabajo."""
+    user = update.effective_user
+    user_info = get_user_info(user)
+    buffer = None
+    try:
+        pendientes = await asyncio.to_thread(cola_trabajos.pendientes)
+        if pendientes >= OCR_MAX_QUEUE:
+            planificador.rechazados += 1
+            log.warning(f"Job queue full ({pendientes} jobs), photo from user {user_info} rejected.")
+            await update.message.reply_text(
+                "🚦 Ahora mismo hay muchos tickets en cola. Por favor, vuelve a enviarlo en unos minutos."
+            )
+            return
+
+        photo = update.message.photo[-1]  # mayor resolución
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = f"{TICKETS_DIR}/{timestamp}_{user.id}.jpg"
+        buffer = tomar_buffer()
+        file = await context.bot.get_file(photo.file_id)
+        await file.download_to_memory(out=buffer)
+
+        datos = {
+            "user": {"id": user.id, "username": user.username,
+                     "first_name": user.first_name, "last_name": user.last_name},
+            "chat_id": update.effective_chat.id,
+            "message_id": update.message.message_id,
+        }
+        # Mismo id si Telegram entrega el mensaje dos veces: no se encola de nuevo
+        job_id = f"{update.effective_chat.id}_{update.message.message_id}"
+        await asyncio.to_thread(cola_trabajos.encolar, datos, buffer.getvalue(), job_id)
+        log.info(f"Photo from user {user_info} queued as job {job_id}.")
+        if pendientes == 0:
+            await update.message.reply_text("✅ Ticket recibido. Procesando...")
+        else:
+            await update.message.reply_text(
+                f"✅ Ticket recibido. Hay {pendientes} tickets delante; te respondo en cuanto lo procese."
+            )
+    except Exception as e:
+        log.error(f"Error queueing photo for user {user_info}: {e}")
         await update.message.reply_text(f"⚠️ Error procesando la imagen: {e}")
+    finally:
+        if buffer is not None:
+            programar_archivado(filename, buffer)
+
+async def entregar_trabajo(bot, job_id, estado, datos, resultado, error):
+    """
+    Envía el resultado de un trabajo terminado por un worker y después lo
+    registra (log, sesión, historial, métricas). Si el envío falla por un
+    error transitorio la excepción sube y entregar_terminados lo reintenta
+    sin haber registrado nada, así que cada trabajo se registra una sola vez.
+    """
+    user = SimpleNamespace(**datos["user"])
+    user_info = get_user_info(user)
+    if estado == HECHO:
+        texto = format_ticket(resultado["resultado"])
+    else:
+        texto = f"⚠️ Error procesando la imagen: {escape_markdown(str(error))}"
+
+    opciones = {"reply_to_message_id": datos["message_id"], "allow_sending_without_reply": True}
+    try:
+        try:
+            await bot.send_message(datos["chat_id"], texto, parse_mode="Markdown", **opciones)
+        except BadRequest as e:
+            # Markdown que Telegram no acepta: se manda como texto plano
+            log.warning(f"Job {job_id}: Markdown rejected ({e}); sending as plain text")
+            await bot.send_message(datos["chat_id"], texto, **opciones)
+    except (Forbidden, BadRequest) as e:
+        # El usuario bloqueó el bot o el mensaje no es válido: reintentarlo no serviría de nada
+        log.warning(f"Could not deliver job {job_id} to user {user_info}: {e}")
+
+    tiempos = StageTimer()
+    if estado == HECHO:
+        tiempos.etapas.update(resultado["etapas"])
+        tiempos.datos.update(resultado["datos"])
+        ticket = resultado["resultado"]
+        ticket_id = log_ticket_success(user, ticket, ocr_text=resultado["ocr_text"],
+                                       timings=tiempos.to_dict(), ticket_id=job_id)
+        await user_tickets.guardar(user.id, ticket, ticket_id)
+        if historial is not None:
+            historial.registrar(ticket_id, user.id, ticket)
+        metrics.registrar_ticket(tiempos)
+        log.info(f"Job {job_id} processed for user {user_info}.")
+    else:
+        log.error(f"Job {job_id} failed for user {user_info}: {error}")
+        log_ticket_error(user, error_message=error)
+        metrics.registrar_ticket(tiempos, estado="error")
 
 # --- Comando /editar ---
 async def editar(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -124,14 +787,30 @@ async def editar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         log.info(f"User {user_info} is using /editar with args: {context.args}")
         args = context.args
+        # Tras un álbum: /editar n campo valor (n = número del ticket en el resumen)
+        indice = None
+        if args and args[0].isdigit():
+            indice = int(args[0])
+            args = args[1:]
         if len(args) < 2:
             await update.message.reply_text("Uso: `/editar campo valor`", parse_mode="Markdown")
             return
 
         campo = args[0].lower()
         valor = " ".join(args[1:])
-        ticket = user_tickets.get(update.effective_user.id)
+        cuantos = await user_tickets.cuantos(update.effective_user.id)
+        if cuantos > 1 and indice is None:
+            await update.message.reply_text(
+                f"ℹ️ Tu último envío tenía {cuantos} tickets. Indica cuál: `/editar n campo valor` (1-{cuantos}).",
+                parse_mode="Markdown"
+            )
+            return
+        ticket, ticket_id = await user_tickets.obtener_con_id(update.effective_user.id, indice)
 
+        if not ticket and indice is not None and cuantos:
+            await update.message.reply_text(f"_❌ No hay ticket {indice}; elige entre 1 y {cuantos}._",
+                                            parse_mode="Markdown")
+            return
         if not ticket:
             log.info(f"User {user_info} tried /editar without a valid receipt.")
             await update.message.reply_text("_No hay ticket procesado para editar._", parse_mode="Markdown")
@@ -144,6 +823,9 @@ async def editar(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         ticket[campo] = valor
+        await user_tickets.guardar(update.effective_user.id, ticket, ticket_id, indice)
+        if historial is not None and ticket_id:
+            historial.corregir(ticket_id, update.effective_user.id, ticket, campo, valor)
 
         log.info(f"User {user_info} updated field '{campo}' to '{valor}'.")
         # Mostrar ticket actualizado
@@ -156,14 +838,148 @@ async def editar(update: Update, context: ContextTypes.DEFAULT_TYPE):
         log.error(f"Error in /editar for user {user_info}: {e}", exc_info=True)
         await update.message.reply_text(f"Error: {e}")
 
+# --- Comando /stats (solo administradores) ---
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_info = get_user_info(update.effective_user)
+    if update.effective_user.id not in ADMIN_IDS:
+        log.info(f"User {user_info} tried /stats without permission.")
+        return
+
+    log.info(f"User {user_info} executed /stats.")
+    cola = planificador.resumen() if cola_trabajos is None else await asyncio.to_thread(cola_trabajos.resumen)
+    await update.message.reply_text(f"📊 Estadísticas\n\n{cola}\n{metrics.resumen()}")
+
+# --- Historial: /historial, /resumen y /exportar ---
+MAX_HISTORIAL = 50
+
+def periodo_resumen(args):
+    """
+    /resumen [mes|año] [periodo] -> (desde, hasta, etiqueta) en ISO, hasta excluida.
+    periodo: "2025-03" o "03/2025" para meses, "2025" para años; por defecto el actual.
+    """
+    tipo = args[0].lower() if args else "mes"
+    valor = args[1] if len(args) > 1 else None
+    hoy = datetime.now()
+    if tipo in ("año", "ano", "year"):
+        anio = int(valor) if valor else hoy.year
+        return f"{anio}-01-01", f"{anio + 1}-01-01", str(anio)
+    if tipo != "mes":
+        raise ValueError("Uso: `/resumen mes [AAAA-MM]` o `/resumen año [AAAA]`")
+    if valor:
+        formato = "%m/%Y" if "/" in valor else "%Y-%m"
+        inicio = datetime.strptime(valor, formato)
+    else:
+        inicio = hoy.replace(day=1)
+    siguiente = inicio.replace(year=inicio.year + 1, month=1) if inicio.month == 12 else inicio.replace(month=inicio.month + 1)
+    return inicio.strftime("%Y-%m-01"), siguiente.strftime("%Y-%m-01"), inicio.strftime("%m/%Y")
+
+async def historial_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_info = get_user_info(update.effective_user)
+    log.info(f"User {user_info} executed /historial with args: {context.args}")
+    if historial is None:
+        await update.message.reply_text("_El historial no está activado._", parse_mode="Markdown")
+        return
+    try:
+        limite = min(int(context.args[0]), MAX_HISTORIAL) if context.args else 10
+        filas = await historial.ultimos(update.effective_user.id, limite)
+        if not filas:
+            await update.message.reply_text("_Todavía no hay tickets en tu historial._", parse_mode="Markdown")
+            return
+        lineas = [f"🧾 *Últimos {len(filas)} tickets*\n"]
+        for fila in filas:
+            # Los valores salen del OCR (o de /editar): escapados para el Markdown de Telegram
+            total = f"{fila['total']:.2f} {escape_markdown(fila['divisa'] or '')}" if fila["total"] is not None else "?"
+            fecha = escape_markdown(fila['fecha_texto'] or fila['fecha'])
+            establecimiento = escape_markdown(fila['establecimiento']) if fila['establecimiento'] else '¿?'
+            lineas.append(f"📅 {fecha} · {establecimiento} · {total}")
+        await update.message.reply_text("\n".join(lineas), parse_mode="Markdown")
+    except Exception as e:
+        log.error(f"Error in /historial for user {user_info}: {e}", exc_info=True)
+        await update.message.reply_text(f"Error: {e}")
+
+async def resumen_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_info = get_user_info(update.effective_user)
+    log.info(f"User {user_info} executed /resumen with args: {context.args}")
+    if historial is None:
+        await update.message.reply_text("_El historial no está activado._", parse_mode="Markdown")
+        return
+    try:
+        try:
+            desde, hasta, etiqueta = periodo_resumen(context.args)
+        except ValueError:
+            await update.message.reply_text("Uso: `/resumen mes [AAAA-MM]` o `/resumen año [AAAA]`", parse_mode="Markdown")
+            return
+        totales, establecimientos = await historial.resumen(update.effective_user.id, desde, hasta)
+        if not totales:
+            await update.message.reply_text(f"_No hay tickets en {etiqueta}._", parse_mode="Markdown")
+            return
+        lineas = [f"📊 *Resumen {etiqueta}*\n"]
+        for fila in totales:
+            lineas.append(f"💰 {fila['total'] or 0:.2f} {escape_markdown(fila['divisa'])} en {fila['tickets']} tickets")
+        if establecimientos:
+            lineas.append("\n🏬 *Dónde más has gastado:*")
+            for fila in establecimientos:
+                lineas.append(f"• {escape_markdown(fila['establecimiento'])}: {fila['total'] or 0:.2f} ({fila['tickets']})")
+        await update.message.reply_text("\n".join(lineas), parse_mode="Markdown")
+    except Exception as e:
+        log.error(f"Error in /resumen for user {user_info}: {e}", exc_info=True)
+        await update.message.reply_text(f"Error: {e}")
+
+async def exportar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_info = get_user_info(update.effective_user)
+    log.info(f"User {user_info} executed /exportar.")
+    if historial is None:
+        await update.message.reply_text("_El historial no está activado._", parse_mode="Markdown")
+        return
+    try:
+        # El CSV se escribe por bloques en un temporal en disco, nunca entero en memoria
+        with tempfile.NamedTemporaryFile("w+", encoding="utf-8", newline="", suffix=".csv") as f:
+            escritor = csv.writer(f)
+            escritor.writerow(COLUMNAS_EXPORTACION)
+            filas = 0
+            async for bloque in historial.exportar(update.effective_user.id):
+                await asyncio.to_thread(escritor.writerows, bloque)
+                filas += len(bloque)
+            if not filas:
+                await update.message.reply_text("_Todavía no hay tickets en tu historial._", parse_mode="Markdown")
+                return
+            f.flush()
+            with open(f.name, "rb") as documento:
+                await update.message.reply_document(documento, filename="tickets.csv",
+                                                    caption=f"🧾 {filas} tickets")
+    except Exception as e:
+        log.error(f"Error in /exportar for user {user_info}: {e}", exc_info=True)
+        await update.message.reply_text(f"Error: {e}")
+
 # --- Main ---
 if __name__ == "__main__":
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # El fichero de disponibilidad de un arranque anterior no vale
+    if READY_FILE and os.path.exists(READY_FILE):
+        os.remove(READY_FILE)
+
+    if OCR_WORKERS > 0 and not JOB_QUEUE_DB:
+        ocr_pool = OCRWorkerPool(OCR_WORKERS, OCR_TORCH_THREADS or None, **PIPELINE_OPTIONS)
+        log.info(f"Starting OCR worker pool ({ocr_pool.num_workers} workers, {ocr_pool.torch_threads} torch threads each)...")
+
+    if METRICS_PORT > 0:
+        iniciar_servidor_metricas(METRICS_PORT, METRICS_HOST)
+        log.info(f"Metrics endpoint on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    metrics.fijar("ocr_model_ready", 0)
+    metrics.fijar("log_records_dropped", logs_descartados)
+
+    app = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("editar", editar))
+    app.add_handler(CommandHandler("stats", stats))
+    app.add_handler(CommandHandler("historial", historial_command))
+    app.add_handler(CommandHandler("resumen", resumen_command))
+    app.add_handler(CommandHandler("exportar", exportar_command))
     app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
 
     log.info("Bot started. Polling for updates...")
     app.run_polling()
+
+    if ocr_pool is not None:
+        ocr_pool.cerrar()
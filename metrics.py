@@ -0,0 +1,138 @@
+import threading
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Límites de los buckets de los histogramas de latencia (segundos)
+BUCKETS_SEGUNDOS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# Límites de los buckets del número de cajas OCR por ticket
+BUCKETS_CAJAS = [10, 25, 50, 100, 200, 400, 800]
+# Muestras recientes que se guardan por etapa para los percentiles de /stats
+MUESTRAS_RECIENTES = 500
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.cuentas = [0] * len(buckets)
+        self.suma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        self.suma += valor
+        self.total += 1
+        for i, limite in enumerate(self.buckets):
+            if valor <= limite:
+                self.cuentas[i] += 1
+                break
+
+    def lineas_prometheus(self, nombre, etiquetas=""):
+        sep = "," if etiquetas else ""
+        lineas = []
+        acumulado = 0
+        for limite, cuenta in zip(self.buckets, self.cuentas):
+            acumulado += cuenta
+            lineas.append(f'{nombre}_bucket{{{etiquetas}{sep}le="{limite}"}} {acumulado}')
+        lineas.append(f'{nombre}_bucket{{{etiquetas}{sep}le="+Inf"}} {self.total}')
+        sufijo = f"{{{etiquetas}}}" if etiquetas else ""
+        lineas.append(f"{nombre}_sum{sufijo} {self.suma}")
+        lineas.append(f"{nombre}_count{sufijo} {self.total}")
+        return lineas
+
+
+class Metrics:
+    """
+    Métricas del bot en memoria: histogramas de latencia por etapa, cajas OCR
+    por ticket y contadores de tickets. Se sirven en formato texto de
+    Prometheus y se resumen en el comando /stats.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.etapas = defaultdict(lambda: Histogram(BUCKETS_SEGUNDOS))
+        self.recientes = defaultdict(lambda: deque(maxlen=MUESTRAS_RECIENTES))
+        self.cajas = Histogram(BUCKETS_CAJAS)
+        self.tickets = defaultdict(int)  # estado -> número
+        self.gauges = {}
+
+    def registrar_ticket(self, tiempos, estado="success"):
+        """Añade los tiempos de un StageTimer a los histogramas."""
+        with self._lock:
+            self.tickets[estado] += 1
+            for etapa, segundos in tiempos.etapas.items():
+                self.etapas[etapa].observar(segundos)
+                self.recientes[etapa].append(segundos)
+            if "ocr_boxes" in tiempos.datos:
+                self.cajas.observar(tiempos.datos["ocr_boxes"])
+
+    def fijar(self, nombre, valor):
+        """valor: número, o función sin argumentos que se evalúa en cada scrape."""
+        with self._lock:
+            self.gauges[nombre] = valor
+
+    def prometheus(self):
+        with self._lock:
+            lineas = [
+                "# HELP ticket_stage_seconds Latencia de cada etapa del procesado de tickets.",
+                "# TYPE ticket_stage_seconds histogram",
+            ]
+            for etapa, hist in sorted(self.etapas.items()):
+                lineas += hist.lineas_prometheus("ticket_stage_seconds", f'stage="{etapa}"')
+
+            lineas += [
+                "# HELP ticket_ocr_boxes Cajas de texto detectadas por ticket.",
+                "# TYPE ticket_ocr_boxes histogram",
+            ]
+            lineas += self.cajas.lineas_prometheus("ticket_ocr_boxes")
+
+            lineas += [
+                "# HELP tickets_total Tickets procesados por estado.",
+                "# TYPE tickets_total counter",
+            ]
+            for estado, n in sorted(self.tickets.items()):
+                lineas.append(f'tickets_total{{status="{estado}"}} {n}')
+
+            for nombre, valor in sorted(self.gauges.items()):
+                lineas.append(f"# TYPE {nombre} gauge")
+                lineas.append(f"{nombre} {valor() if callable(valor) else valor}")
+        return "\n".join(lineas) + "\n"
+
+    def resumen(self):
+        """Texto corto con p50/p95 recientes por etapa (para /stats)."""
+        with self._lock:
+            tickets = dict(self.tickets)
+            recientes = {etapa: sorted(m) for etapa, m in self.recientes.items() if m}
+
+        lineas = [f"Tickets: {tickets.get('success', 0)} ok, {tickets.get('error', 0)} error"]
+        for etapa, muestras in sorted(recientes.items(), key=lambda e: -sum(e[1])):
+            p50 = muestras[len(muestras) // 2] * 1000
+            p95 = muestras[min(len(muestras) - 1, int(len(muestras) * 0.95))] * 1000
+            lineas.append(f"{etapa}: p50 {p50:.0f} ms · p95 {p95:.0f} ms (n={len(muestras)})")
+        return "\n".join(lineas)
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        cuerpo = metrics.prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, format, *args):
+        # Sin logs por cada scrape
+        pass
+
+
+def iniciar_servidor_metricas(puerto, host="127.0.0.1"):
+    """Sirve /metrics en un hilo en segundo plano."""
+    servidor = ThreadingHTTPServer((host, puerto), _MetricsHandler)
+    hilo = threading.Thread(target=servidor.serve_forever, name="metrics-http", daemon=True)
+    hilo.start()
+    return servidor
@@ -0,0 +1,61 @@
+from abc import ABC, abstractmethod
+
+
+class OCREngine(ABC):
+    """
+    Interfaz común de los motores OCR que usa TicketPipeline.
+
+    leer_detalle(img) -> [(bbox, texto, prob)] con bbox de 4 esquinas [x, y]
+        en coordenadas de `img`, como `readtext(detail=1)` de EasyOCR.
+    leer_lineas(img) -> [texto] en el mismo orden.
+    leer_detalle_lote(imagenes) -> [leer_detalle(img) de cada una]; los
+        motores que pueden pasan todas las imágenes juntas por el modelo.
+
+    leer_lineas y leer_detalle_lote tienen una versión por defecto basada
+    en `leer_detalle`. Los motores basados en EasyOCR exponen además
+    `reader`, que es lo que necesita BatchingOCREngine.
+
+    Para el OCR en dos fases (TicketPipeline con ocr_perezoso) el motor
+    separa detección y reconocimiento:
+    detectar(img) -> [CajaDetectada], sin reconocer ningún texto.
+    reconocer(img, cajas) -> [(bbox, texto, prob)] solo de esas cajas, uno
+        por caja y con el mismo bbox que la CajaDetectada.
+    caja(img, bbox) -> CajaDetectada de una caja de leer_detalle (dentro de
+        `img`), para volver a reconocerla sin pasar otra vez por el detector.
+    Solo leer_detalle es abstracto: estas tres lanzan NotImplementedError
+    salvo en los motores con dos_fases = True, que las implementan.
+    """
+    # True si implementa detectar/reconocer
+    dos_fases = False
+
+    @abstractmethod
+    def leer_detalle(self, img):
+        ...
+
+    def leer_lineas(self, img):
+        return [r[1].strip() for r in self.leer_detalle(img)]
+
+    def leer_detalle_lote(self, imagenes):
+        return [self.leer_detalle(img) for img in imagenes]
+
+    def detectar(self, img):
+        raise NotImplementedError
+
+    def reconocer(self, img, cajas):
+        raise NotImplementedError
+
+    def caja(self, img, bbox):
+        raise NotImplementedError
+
+
+class CajaDetectada:
+    """
+    Caja de texto detectada y aún sin reconocer.
+    bbox: 4 esquinas [x, y], como en leer_detalle. original: la caja en el
+    formato propio del motor, que es lo que recibe de vuelta en reconocer().
+    """
+    __slots__ = ("bbox", "original")
+
+    def __init__(self, bbox, original):
+        self.bbox = bbox
+        self.original = original
@@ -0,0 +1,134 @@
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from ocr.base import OCREngine
+from ocr.padding import agrupar_por_tamano, rellenar
+
+
+class BatchingOCREngine(OCREngine):
+    """
+    Capa de micro-batching delante de un motor basado en EasyOCR (usa su `reader`).
+
+    Las llamadas concurrentes a `leer_detalle` (desde varios hilos) se agrupan
+    hasta `max_lote` imágenes y se procesan con `readtext_batched` de EasyOCR.
+    Cada llamada recibe su propio resultado. Una petición sin otras en cola se
+    procesa enseguida; solo cuando hay varias peticiones a la vez se espera
+    hasta `ventana_ms` a que se llene el lote.
+
+    batch_size_reconocedor: batch_size del reconocedor de EasyOCR
+                            (por defecto, igual a max_lote)
+    """
+
+    def __init__(self, engine, ventana_ms=40, max_lote=8, batch_size_reconocedor=None):
+        self.engine = engine
+        self.reader = engine.reader
+        self.ventana = ventana_ms / 1000
+        self.max_lote = max_lote
+        self.batch_size_reconocedor = batch_size_reconocedor or max_lote
+
+        self._cola = queue.Queue()
+        # leer_detalle_lote encola todas sus imágenes con este lock, y el bucle
+        # vacía la cola con él: así ve el lote entero y no solo la primera
+        self._lock_cola = threading.Lock()
+        self._peticiones = itertools.count()  # id de cada llamada, para saber si hay concurrencia
+        self._hilo = threading.Thread(target=self._bucle, name="ocr-batching", daemon=True)
+        self._hilo.start()
+
+    @property
+    def dos_fases(self):
+        return self.engine.dos_fases
+
+    def detectar(self, img):
+        # Las dos fases van directas al motor, sin agrupar
+        return self.engine.detectar(img)
+
+    def reconocer(self, img, cajas):
+        return self.engine.reconocer(img, cajas)
+
+    def caja(self, img, bbox):
+        return self.engine.caja(img, bbox)
+
+    def leer_detalle(self, img):
+        # Devuelve lista con bounding boxes, texto y probabilidad
+        future = Future()
+        self._cola.put((img, future, next(self._peticiones)))
+        return future.result()
+
+    def leer_detalle_lote(self, imagenes):
+        # Todas a la cola a la vez: salen en el mismo lote (o en lotes de max_lote)
+        futures = []
+        peticion = next(self._peticiones)
+        with self._lock_cola:
+            for img in imagenes:
+                futures.append(Future())
+                self._cola.put((img, futures[-1], peticion))
+        return [future.result() for future in futures]
+
+    def cerrar(self):
+        self._cola.put(None)
+        self._hilo.join()
+
+    # --- Hilo de batching ---
+    def _bucle(self):
+        while True:
+            primero = self._cola.get()
+            if primero is None:
+                return
+
+            lote = [primero]
+            parar = False
+            # Lo que ya estaba esperando (p.ej. llegado mientras se procesaba el lote anterior)
+            with self._lock_cola:
+                while len(lote) < self.max_lote:
+                    try:
+                        item = self._cola.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        parar = True
+                        break
+                    lote.append(item)
+
+            # Una petición sola se procesa ya; la ventana solo se espera con carga concurrente
+            concurrente = len({peticion for _, _, peticion in lote}) > 1
+            limite = time.monotonic() + self.ventana
+            while concurrente and len(lote) < self.max_lote and not parar:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    item = self._cola.get(timeout=restante)
+                except queue.Empty:
+                    break
+                if item is None:
+                    parar = True
+                    break
+                lote.append(item)
+
+            for grupo in agrupar_por_tamano(lote):
+                self._ejecutar(grupo)
+
+            if parar:
+                return
+
+    def _ejecutar(self, grupo):
+        try:
+            if len(grupo) == 1:
+                resultados = [self.engine.leer_detalle(grupo[0][0])]
+            else:
+                alto = max(img.shape[0] for img, _, _ in grupo)
+                ancho = max(img.shape[1] for img, _, _ in grupo)
+                imagenes = [rellenar(img, alto, ancho) for img, _, _ in grupo]
+                resultados = self.reader.readtext_batched(
+                    imagenes, detail=1, paragraph=False, batch_size=self.batch_size_reconocedor
+                )
+        except Exception as e:
+            for _, future, _ in grupo:
+                future.set_exception(e)
+            return
+
+        for (_, future, _), resultado in zip(grupo, resultados):
+            future.set_result(resultado)
@@ -1,9 +1,22 @@
-import easyocr
+from ocr.base import CajaDetectada, OCREngine
+from ocr.padding import agrupar_por_tamano, rellenar
 
+# batch_size del reconocedor al leer varias imágenes juntas
+BATCH_SIZE_LOTE = 8
 
-class EasyOCREngine:
-    def __init__(self):
-        self.reader = easyocr.Reader(['es'])
+
+class EasyOCREngine(OCREngine):
+    dos_fases = True
+
+    def __init__(self, idiomas=("es",), cuantizar=True):
+        """
+        cuantizar: en CPU, EasyOCR cuantiza a int8 (cuantización dinámica de
+            torch) las capas Linear/LSTM al cargar los modelos. Es su
+            comportamiento por defecto; False deja los modelos en fp32.
+        """
+        # Importación diferida: easyocr arrastra torch, que tarda en cargar
+        import easyocr
+        self.reader = easyocr.Reader(list(idiomas), quantize=cuantizar)
 
 
     def leer_lineas(self, img):
@@ -15,4 +28,61 @@ class EasyOCREngine:
     def leer_detalle(self, img):
         # Devuelve lista con bounding boxes, texto y probabilidad
         resultados = self.reader.readtext(img, detail=1, paragraph=False)
-        return resultados
\ No newline at end of file
+        return resultados
+
+
+    def leer_detalle_lote(self, imagenes):
+        """
+        Una llamada a readtext_batched por cada grupo de imágenes de tamaño
+        parecido (se rellenan hasta el mismo tamaño sin mover el texto).
+        """
+        resultados = [None] * len(imagenes)
+        for grupo in agrupar_por_tamano([(img, i) for i, img in enumerate(imagenes)]):
+            if len(grupo) == 1:
+                img, i = grupo[0]
+                resultados[i] = self.leer_detalle(img)
+                continue
+            alto = max(img.shape[0] for img, _ in grupo)
+            ancho = max(img.shape[1] for img, _ in grupo)
+            leidos = self.reader.readtext_batched(
+                [rellenar(img, alto, ancho) for img, _ in grupo],
+                detail=1, paragraph=False, batch_size=BATCH_SIZE_LOTE
+            )
+            for (_, i), leido in zip(grupo, leidos):
+                resultados[i] = leido
+        return resultados
+
+
+    def detectar(self, img):
+        """Solo el detector (CRAFT). Las cajas rectas y las inclinadas se reconocen distinto en EasyOCR."""
+        horizontales, libres = self.reader.detect(img)
+        cajas = []
+        for x1, x2, y1, y2 in horizontales[0]:
+            bbox = [[x1, y1], [x2, y1], [x2, y2], [x1, y2]]
+            cajas.append(CajaDetectada(bbox, ("horizontal", [x1, x2, y1, y2])))
+        for puntos in libres[0]:
+            cajas.append(CajaDetectada([list(p) for p in puntos], ("libre", puntos)))
+        return cajas
+
+
+    def reconocer(self, img, cajas):
+        if not cajas:
+            return []
+        horizontales = [c.original[1] for c in cajas if c.original[0] == "horizontal"]
+        libres = [c.original[1] for c in cajas if c.original[0] == "libre"]
+        return self.reader.recognize(img, horizontal_list=horizontales, free_list=libres,
+                                     detail=1, paragraph=False, batch_size=BATCH_SIZE_LOTE)
+
+
+    def caja(self, img, bbox, margen=4):
+        """
+        Rectángulo (con margen, como recorte_caja) que contiene la caja de
+        leer_detalle, recortado a la imagen como hace EasyOCR al reconocer: así
+        reconocer() devuelve exactamente este bbox.
+        """
+        alto, ancho = img.shape[:2]
+        xs = [p[0] for p in bbox]
+        ys = [p[1] for p in bbox]
+        x1, x2 = max(int(min(xs)) - margen, 0), min(int(max(xs)) + margen, ancho)
+        y1, y2 = max(int(min(ys)) - margen, 0), min(int(max(ys)) + margen, alto)
+        return CajaDetectada([[x1, y1], [x2, y1], [x2, y2], [x1, y2]], ("horizontal", [x1, x2, y1, y2]))
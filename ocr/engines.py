@@ -0,0 +1,24 @@
+# Motores OCR seleccionables por configuración (OCR_ENGINE)
+MOTORES = ("easyocr", "easyocr-fp32", "onnx", "onnx-int8")
+
+
+def crear_motor(nombre="easyocr", directorio_onnx=None):
+    """
+    Crea el motor OCR indicado. Todos cumplen la interfaz de ocr.base.OCREngine.
+
+    easyocr:      EasyOCR tal cual (en CPU cuantiza a int8 al cargar, por defecto).
+    easyocr-fp32: EasyOCR sin cuantizar, como referencia de precisión.
+    onnx:         detector y reconocedor de EasyOCR exportados a ONNX Runtime (fp32).
+    onnx-int8:    igual, con el reconocedor cuantizado a int8 por ONNX Runtime.
+    """
+    # Importaciones diferidas: cada motor arrastra sus propias dependencias
+    if nombre == "easyocr":
+        from ocr.easyocr_engine import EasyOCREngine
+        return EasyOCREngine()
+    if nombre == "easyocr-fp32":
+        from ocr.easyocr_engine import EasyOCREngine
+        return EasyOCREngine(cuantizar=False)
+    if nombre in ("onnx", "onnx-int8"):
+        from ocr.onnx_engine import ONNXEasyOCREngine
+        return ONNXEasyOCREngine(int8=nombre == "onnx-int8", directorio=directorio_onnx)
+    raise ValueError(f"Motor OCR desconocido: {nombre!r} (disponibles: {', '.join(MOTORES)})")
@@ -0,0 +1,167 @@
+import os
+
+from ocr.easyocr_engine import EasyOCREngine
+
+# Modelos exportados (se generan la primera vez y se reutilizan después)
+DIRECTORIO_ONNX = os.path.join(os.path.expanduser("~"), ".EasyOCR", "onnx")
+OPSET = 12
+
+
+class _DetectorONNX:
+    """Ocupa el sitio del CRAFT de torch dentro de EasyOCR: misma llamada, inferencia con ONNX Runtime."""
+
+    def __init__(self, sesion):
+        self.sesion = sesion
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        import torch
+        y = self.sesion.run(["y"], {"imagen": x.cpu().numpy()})[0]
+        # EasyOCR solo usa el mapa de puntuaciones, no las features
+        return torch.from_numpy(y), None
+
+
+class _ReconocedorONNX:
+    """Ocupa el sitio del reconocedor de torch; `texto` (solo para decodificadores con atención) se ignora."""
+
+    def __init__(self, sesion):
+        self.sesion = sesion
+
+    def eval(self):
+        return self
+
+    def __call__(self, imagen, texto=None):
+        import torch
+        return torch.from_numpy(self.sesion.run(["preds"], {"imagen": imagen.cpu().numpy()})[0])
+
+
+def _exportar(modelo, entrada, ruta, salidas, ejes):
+    """Exporta a un temporal y lo mueve al final: varios workers pueden arrancar a la vez."""
+    import torch
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with torch.no_grad():
+        torch.onnx.export(
+            modelo, entrada, temporal, opset_version=OPSET,
+            input_names=["imagen"], output_names=salidas, dynamic_axes=ejes,
+        )
+    os.replace(temporal, ruta)
+
+
+def exportar_detector(reader, ruta):
+    import torch
+    detector = getattr(reader.detector, "module", reader.detector).eval()
+    _exportar(
+        detector, torch.zeros(1, 3, 640, 640), ruta, ["y", "feature"],
+        {"imagen": {0: "lote", 2: "alto", 3: "ancho"},
+         "y": {0: "lote", 1: "alto", 2: "ancho"},
+         "feature": {0: "lote", 2: "alto", 3: "ancho"}},
+    )
+
+
+def exportar_reconocedor(reader, ruta):
+    import torch
+
+    class SoloImagen(torch.nn.Module):
+        # El modelo CTC recibe (imagen, texto) pero no usa el texto
+        def __init__(self, modelo):
+            super().__init__()
+            self.modelo = modelo
+
+        def forward(self, imagen):
+            return self.modelo(imagen, None)
+
+    reconocedor = getattr(reader.recognizer, "module", reader.recognizer).eval()
+    # Altura fija de 64 px (imgH de EasyOCR); el ancho depende de cada recorte
+    _exportar(
+        SoloImagen(reconocedor), torch.zeros(1, 1, 64, 256), ruta, ["preds"],
+        {"imagen": {0: "lote", 3: "ancho"}, "preds": {0: "lote", 1: "pasos"}},
+    )
+
+
+def _reader_sin_modelos(idiomas):
+    """
+    Reader de EasyOCR sin cargar CRAFT ni el reconocedor de torch (los dos se
+    sustituyen por ONNX Runtime): solo lo que usan el pre y postprocesado.
+    """
+    import easyocr
+    from easyocr.config import BASE_PATH
+    from easyocr.detection import get_textbox
+    from easyocr.utils import CTCLabelConverter
+
+    reader = easyocr.Reader(list(idiomas), detector=False, recognizer=False)
+    # Lo que Reader solo prepara al cargar cada modelo
+    reader.detect_network = "craft"
+    reader.get_textbox = get_textbox
+    diccionarios = {idioma: os.path.join(BASE_PATH, "dict", f"{idioma}.txt") for idioma in idiomas}
+    reader.converter = CTCLabelConverter(reader.character, {}, diccionarios)
+    return reader
+
+
+def cuantizar_int8(origen, destino):
+    """Cuantización dinámica int8 de ONNX Runtime (pesos de MatMul/LSTM)."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    temporal = f"{destino}.{os.getpid()}.tmp"
+    quantize_dynamic(origen, temporal, weight_type=QuantType.QInt8)
+    os.replace(temporal, destino)
+
+
+class ONNXEasyOCREngine(EasyOCREngine):
+    """
+    EasyOCR con el detector y el reconocedor ejecutados en ONNX Runtime.
+
+    Se carga EasyOCR en fp32 una vez para exportar sus dos modelos (se
+    guardan en `directorio`; en los siguientes arranques el Reader se crea
+    sin los modelos de torch) y se sustituyen dentro del Reader, así que el pre y postprocesado de
+    EasyOCR (cajas, recortes, decodificación CTC) no cambia y la salida es
+    la misma que con EasyOCREngine.
+
+    int8: cuantiza además el reconocedor a int8. El detector (solo
+        convoluciones) se queda en fp32: las convoluciones int8 dinámicas
+        suelen ser más lentas que fp32 en CPU con ONNX Runtime.
+    hilos: hilos intra-op de cada sesión (por defecto, los de torch, que el
+        pool de workers reparte entre procesos).
+    """
+
+    def __init__(self, idiomas=("es",), int8=False, directorio=None, hilos=None):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("El motor OCR 'onnx' necesita onnxruntime y onnx "
+                              "(pip install onnxruntime onnx)") from e
+        import easyocr
+        import torch
+
+        directorio = directorio or DIRECTORIO_ONNX
+        os.makedirs(directorio, exist_ok=True)
+        sufijo = f"{'_'.join(idiomas)}_{easyocr.__version__}"
+        ruta_detector = os.path.join(directorio, f"craft_{easyocr.__version__}.onnx")
+        ruta_reconocedor = os.path.join(directorio, f"reconocedor_{sufijo}.onnx")
+
+        if os.path.exists(ruta_detector) and os.path.exists(ruta_reconocedor):
+            self.reader = _reader_sin_modelos(idiomas)
+        else:
+            # Solo para exportar hace falta el modelo de torch en fp32
+            super().__init__(idiomas, cuantizar=False)
+            if not os.path.exists(ruta_detector):
+                exportar_detector(self.reader, ruta_detector)
+            if not os.path.exists(ruta_reconocedor):
+                exportar_reconocedor(self.reader, ruta_reconocedor)
+        if int8:
+            ruta_int8 = os.path.join(directorio, f"reconocedor_{sufijo}_int8.onnx")
+            if not os.path.exists(ruta_int8):
+                cuantizar_int8(ruta_reconocedor, ruta_int8)
+            ruta_reconocedor = ruta_int8
+
+        opciones = ort.SessionOptions()
+        opciones.intra_op_num_threads = hilos or torch.get_num_threads()
+        opciones.inter_op_num_threads = 1
+        opciones.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        proveedores = ["CPUExecutionProvider"]
+
+        # Los modelos de torch se liberan al sustituirlos
+        self.reader.detector = _DetectorONNX(
+            ort.InferenceSession(ruta_detector, opciones, providers=proveedores))
+        self.reader.recognizer = _ReconocedorONNX(
+            ort.InferenceSession(ruta_reconocedor, opciones, providers=proveedores))
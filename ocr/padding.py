@@ -0,0 +1,26 @@
+import numpy as np
+
+# Dos imágenes van en el mismo lote si su área no difiere más de este factor
+# (se rellenan hasta el mismo tamaño, así que mezclar tamaños muy distintos
+# desperdicia detección)
+MAX_RATIO_AREA = 1.5
+
+
+def rellenar(img, alto, ancho, valor=255):
+    """Rellena por abajo y por la derecha sin mover las coordenadas del texto."""
+    destino = np.full((alto, ancho) + img.shape[2:], valor, dtype=img.dtype)
+    destino[: img.shape[0], : img.shape[1]] = img
+    return destino
+
+
+def agrupar_por_tamano(lote):
+    """Divide el lote ([(img, ...)]) en grupos de imágenes de área parecida."""
+    ordenado = sorted(lote, key=lambda item: item[0].shape[0] * item[0].shape[1])
+    grupos = []
+    for item in ordenado:
+        area = item[0].shape[0] * item[0].shape[1]
+        if grupos and area <= grupos[-1][0] * MAX_RATIO_AREA:
+            grupos[-1][1].append(item)
+        else:
+            grupos.append((area, [item]))
+    return [items for _, items in grupos]
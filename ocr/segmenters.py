@@ -1,5 +1,58 @@
-import numpy as np
+# Fracción superior de la imagen que se considera encabezado
+RATIO_CABECERA = 0.25
+# OCR en dos fases: la primera etapa reconoce el encabezado y esta fracción
+# inferior (total, IVA, pago y a menudo la fecha); cada etapa siguiente amplía
+# el pie hacia arriba en RATIO_AMPLIACION hasta cubrir toda la imagen
+RATIO_PIE = 0.35
+RATIO_AMPLIACION = 0.25
 
-def recorte_superior(img):
+def recorte_superior(img, ratio=RATIO_CABECERA):
     h = img.shape[0]
-    return img[: int(h * 0.25), :]
\ No newline at end of file
+    return img[: int(h * ratio), :]
+
+
+def en_cabecera(bbox, alto_img, ratio=RATIO_CABECERA):
+    """True si el centro vertical de la caja cae en la banda del encabezado."""
+    ys = [p[1] for p in bbox]
+    centro_y = (min(ys) + max(ys)) / 2
+    return centro_y < alto_img * ratio
+
+
+def recorte_caja(img, bbox, margen=4):
+    """Recorta la región de una bounding box de EasyOCR con un pequeño margen."""
+    xs = [p[0] for p in bbox]
+    ys = [p[1] for p in bbox]
+    h, w = img.shape[:2]
+    x1 = max(int(min(xs)) - margen, 0)
+    y1 = max(int(min(ys)) - margen, 0)
+    x2 = min(int(max(xs)) + margen, w)
+    y2 = min(int(max(ys)) + margen, h)
+    return img[y1:y2, x1:x2]
+
+
+def _centro_y(bbox):
+    ys = [p[1] for p in bbox]
+    return (min(ys) + max(ys)) / 2
+
+
+def etapas_reconocimiento(cajas, alto_img, ratio_cabecera=RATIO_CABECERA,
+                          ratio_pie=RATIO_PIE, ratio_ampliacion=RATIO_AMPLIACION):
+    """
+    Reparte las cajas detectadas (CajaDetectada) en etapas de reconocimiento:
+    primero el encabezado y el pie, después franjas sucesivas hacia arriba
+    (la zona de artículos es la que queda para el final). Las cajas de una
+    misma línea tienen casi el mismo centro, así que no se separan entre etapas.
+    """
+    etapas = []
+    pendientes = sorted(cajas, key=lambda c: -_centro_y(c.bbox))
+    limite_cabecera = alto_img * ratio_cabecera
+    limite_pie = alto_img * (1 - ratio_pie)
+    while pendientes:
+        etapa = [c for c in pendientes
+                 if _centro_y(c.bbox) < limite_cabecera or _centro_y(c.bbox) >= limite_pie]
+        if etapa:
+            etapas.append(etapa)
+            pendientes = [c for c in pendientes
+                          if limite_cabecera <= _centro_y(c.bbox) < limite_pie]
+        limite_pie -= alto_img * ratio_ampliacion
+    return etapas
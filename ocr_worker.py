@@ -0,0 +1,143 @@
+"""
+Worker de OCR para el modo cola (JOB_QUEUE_DB): reclama trabajos de la cola
+duradera, ejecuta TicketPipeline sobre la foto y guarda el resultado para que
+el bot responda al usuario. Se pueden arrancar tantos como CPUs haya, en esta
+máquina o en otros nodos que monten el mismo volumen que la base de datos y
+la carpeta de imágenes.
+
+Cada trabajo reclamado queda reservado --visibility segundos (se renueva
+mientras se procesa). Si el worker muere a mitad, otro lo reintenta al
+caducar la reserva; tras --max-attempts intentos se da por fallido.
+SIGTERM o Ctrl+C terminan el trabajo en curso y salen.
+
+Uso:
+    python ocr_worker.py --queue-db jobs.db
+    OCR_ENGINE=onnx-int8 python ocr_worker.py --queue-db /mnt/cola/jobs.db --worker-id nodo2-1
+"""
+import argparse
+import os
+import signal
+import sys
+import threading
+import time
+
+from ocr.engines import MOTORES, crear_motor
+from pipeline import TicketPipeline
+from utils.job_queue import JobQueue, id_trabajador
+from utils.timing import StageTimer
+
+
+class Renovador:
+    """Renueva la reserva en un hilo mientras se procesa un trabajo largo."""
+
+    def __init__(self, cola, reserva):
+        self.cola = cola
+        self.reserva = reserva
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._renovar, daemon=True)
+
+    def _renovar(self):
+        while not self._parar.wait(self.cola.visibilidad / 3):
+            if not self.cola.renovar(self.reserva):
+                return
+
+    def __enter__(self):
+        self._hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._parar.set()
+        self._hilo.join()
+
+
+def procesar(pipeline, reserva):
+    """Ejecuta el pipeline sobre la foto del trabajo. Devuelve el resultado serializable."""
+    tiempos = StageTimer()
+    tiempos.sumar("cola", max(0.0, time.time() - reserva.creado))
+    tiempos.anotar(job_attempts=reserva.intentos)
+    with tiempos.medir("total"):
+        resultado, lineas = pipeline.procesar_ticket(reserva.imagen, tiempos)
+    return {"resultado": resultado, "ocr_text": lineas, "etapas": tiempos.etapas, "datos": tiempos.datos}
+
+
+def ejecutar(args):
+    cola = JobQueue(args.queue_db, args.images_dir, args.visibility, args.max_attempts)
+    trabajador = args.worker_id or id_trabajador()
+
+    parar = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: parar.set())
+
+    print(f"[{trabajador}] Cargando el modelo OCR...", file=sys.stderr)
+    pipeline = TicketPipeline(
+        ocr=crear_motor(args.ocr_engine, args.onnx_dir),
+        cabecera_un_paso=args.single_pass_header,
+        umbral_confianza_cabecera=args.header_min_conf,
+        escalado_adaptativo=args.adaptive_scale,
+        ocr_perezoso=args.lazy_ocr,
+        umbral_confianza_campos=args.field_min_conf,
+        recortar=args.crop,
+    )
+    pipeline.calentar()
+    print(f"[{trabajador}] Esperando trabajos en {args.queue_db}", file=sys.stderr)
+
+    hechos = errores = repetidos = 0
+    try:
+        while not parar.is_set():
+            reserva = cola.reclamar(trabajador)
+            if reserva is None:
+                parar.wait(args.poll)
+                continue
+            try:
+                with Renovador(cola, reserva):
+                    resultado = procesar(pipeline, reserva)
+            except Exception as e:
+                errores += 1
+                cola.fallar(reserva, f"{type(e).__name__}: {e}")
+                print(f"[{trabajador}] {reserva.id} intento {reserva.intentos}: {e}", file=sys.stderr)
+                continue
+            if cola.completar(reserva, resultado):
+                hechos += 1
+            else:
+                # Otro worker ya lo terminó tras caducar nuestra reserva, o ya se entregó
+                repetidos += 1
+                print(f"[{trabajador}] {reserva.id} ya estaba completado", file=sys.stderr)
+    except KeyboardInterrupt:
+        # El trabajo a medias vuelve a la cola cuando caduque su reserva
+        pass
+    print(f"[{trabajador}] Terminado: {hechos} tickets, {errores} errores, {repetidos} descartados (ya completados)", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker de OCR para la cola de trabajos del bot")
+    parser.add_argument("--queue-db", default=os.getenv("JOB_QUEUE_DB") or None, required=not os.getenv("JOB_QUEUE_DB"),
+                        help="base de datos SQLite de la cola (por defecto JOB_QUEUE_DB)")
+    parser.add_argument("--images-dir", default=os.getenv("JOB_QUEUE_IMAGES_DIR") or None,
+                        help="carpeta de las fotos encoladas (por defecto junto a la base de datos)")
+    parser.add_argument("--worker-id", help="nombre en la cola (por defecto host:pid)")
+    parser.add_argument("--visibility", type=float, default=float(os.getenv("JOB_VISIBILITY_SECONDS", "120")),
+                        help="segundos que un trabajo reclamado queda reservado")
+    parser.add_argument("--max-attempts", type=int, default=int(os.getenv("JOB_MAX_ATTEMPTS", "3")),
+                        help="intentos por trabajo antes de darlo por fallido")
+    parser.add_argument("--poll", type=float, default=float(os.getenv("JOB_POLL_SECONDS", "1")),
+                        help="segundos entre consultas con la cola vacía")
+    parser.add_argument("--single-pass-header", action="store_true",
+                        default=os.getenv("OCR_HEADER_SINGLE_PASS", "0") == "1")
+    parser.add_argument("--header-min-conf", type=float,
+                        default=float(os.getenv("OCR_HEADER_MIN_CONF", "0.5")))
+    parser.add_argument("--adaptive-scale", action="store_true",
+                        default=os.getenv("OCR_ADAPTIVE_SCALE", "0") == "1")
+    parser.add_argument("--ocr-engine", choices=MOTORES, default=os.getenv("OCR_ENGINE", "easyocr"))
+    parser.add_argument("--onnx-dir", default=os.getenv("OCR_ONNX_DIR") or None,
+                        help="modelos exportados de los motores ONNX")
+    parser.add_argument("--lazy-ocr", action="store_true", default=os.getenv("OCR_LAZY", "0") == "1",
+                        help="reconocer por zonas solo mientras falten campos")
+    parser.add_argument("--field-min-conf", type=float, default=float(os.getenv("OCR_FIELD_MIN_CONF", "0")),
+                        help="releer la línea de los campos con menos confianza (0 = no releer)")
+    parser.add_argument("--crop", action="store_true", default=os.getenv("OCR_CROP", "0") == "1",
+                        help="recortar el ticket (contorno y perspectiva) antes del OCR")
+    args = parser.parse_args()
+    ejecutar(args)
+
+
+if __name__ == "__main__":
+    main()
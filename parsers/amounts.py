@@ -1,30 +1,24 @@
-import re
+from utils.candidates import anotar_origen
+from utils.document import ReceiptDocument
 
 PALABRAS_TOTAL = ["TOTAL", "TOT", "TOTA", "IMPORTE", "SUMA", "PRECIO FINAL", "A COBRAR", "CAJA", "PENDIENTE"]
 
-def parse_total(lines, line_heights=None, max_reasonable=20000.0):
+def parse_total(lines, line_heights=None, max_reasonable=20000.0, origenes=None):
     """
-    lines: lista de strings del OCR
+    lines: ReceiptDocument o lista de strings del OCR
     line_heights: lista de enteros/floats indicando la altura de cada línea (opcional)
     max_reasonable: valor máximo que consideramos razonable
+    origenes: dict opcional donde se anota el Origen del total (línea, si tenía TOTAL)
     """
+    doc = ReceiptDocument.desde(lines)
+    tabla = doc.candidatos  # importes ya normalizados por línea
     total_candidates = []
 
     # --- 1️⃣ Buscar líneas con palabras clave TOTAL ---
-    for idx, linea in enumerate(lines):
-        linea_upper = linea.upper()
+    for idx, linea_upper in enumerate(doc.upper):
         if any(pal in linea_upper for pal in PALABRAS_TOTAL):
-            texto = linea_upper
             # También combinar con la siguiente línea por si el número está separado
-            if idx + 1 < len(lines):
-                texto += " " + lines[idx + 1].upper()
-
-            # Normalizar comas y espacios: "16 ,50" -> "16.50", "10 60" -> "10.60"
-            texto = texto.replace(",", ".")
-            texto = re.sub(r'(\d+)\s+(\d{1,2})', r'\1.\2', texto)
-
-            numeros = re.findall(r'\d+\.\d{1,2}', texto)
-            for n in numeros:
+            for n in tabla.importes_con_siguiente(idx):
                 val = float(n)
                 if 0 < val <= max_reasonable:
                     height = line_heights[idx] if line_heights else 0
@@ -37,17 +31,14 @@ def parse_total(lines, line_heights=None, max_reasonable=20000.0):
     if total_candidates:
         # Escoger el candidato con mayor altura, si hay empate, el último en el ticket
         best = max(total_candidates, key=lambda c: (c["height"], c["linea_index"]))
+        anotar_origen(origenes, "total", best["linea_index"], True)
         return f"{best['valor']:.2f}"
 
     # --- 2️⃣ Si no hay TOTAL, buscar cualquier número decimal válido con 2 decimales ---
     fallback_candidates = []
-    for idx, linea in enumerate(lines):
-        texto = linea.replace(",", ".")
-        texto = re.sub(r'(\d+)\s+(\d{1,2})', r'\1.\2', texto)
-        numeros = re.findall(r'\d+\.\d{1,2}', texto)
-
-        for n in numeros:
-            val = float(n)
+    for idx, importes in enumerate(tabla.importes):
+        for candidato in importes:
+            val = float(candidato.valor)
             if 0 < val <= max_reasonable:
                 height = line_heights[idx] if line_heights else 0
                 fallback_candidates.append({
@@ -59,6 +50,7 @@ def parse_total(lines, line_heights=None, max_reasonable=20000.0):
     if fallback_candidates:
         # Escoger el que tenga mayor altura, si empate el que aparece más abajo
         best = max(fallback_candidates, key=lambda c: (c["height"], c["linea_index"]))
+        anotar_origen(origenes, "total", best["linea_index"], False)
         return f"{best['valor']:.2f}"
 
     # --- 3️⃣ Si no hay nada ---
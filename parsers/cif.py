@@ -1,10 +1,9 @@
-import re
-from utils.helpers import fuzzy_in
+from utils.keywords import KeywordMatcher
+from utils.document import ReceiptDocument
+from utils.candidates import RE_CIF, anotar_origen
 
 CLAVES_CIF = ["CIF", "NIF", "C.I.F", "N.I.F", "IDENT", "IDENTIFIC", "EMPRESA"]
-
-# CIF oficial: letra inicial válida + 7 dígitos + letra/dígito final válido
-PATRON_CIF = r"[A-HJ-NP-SUVW]\d{7}[0-9A-J]"
+MATCHER_CIF = KeywordMatcher(CLAVES_CIF, umbral=70)
 
 def normalizar(texto):
     return "".join(c for c in texto.upper() if c.isalnum())
@@ -18,7 +17,7 @@ def validar_cif(cif):
     Validación oficial del dígito de control del CIF.
     Devuelve True si es válido.
     """
-    if not re.fullmatch(PATRON_CIF, cif):
+    if not RE_CIF.fullmatch(cif):
         return False
 
     letra = cif[0]
@@ -49,36 +48,37 @@ def validar_cif(cif):
 # ----------------------
 # PARSER PRINCIPAL
 # ----------------------
-def parse_cif(lines):
-    indices_relevantes = []
-
-    for i, linea in enumerate(lines):
-        if fuzzy_in(linea.upper(), CLAVES_CIF, umbral=70):
-            indices_relevantes.append(i)
+def parse_cif(lines, origenes=None):
+    """
+    lines: ReceiptDocument o lista de strings del OCR
+    origenes: dict opcional donde se anota el Origen del CIF (línea, si es válido)
+    """
+    doc = ReceiptDocument.desde(lines)
+    indices_relevantes = MATCHER_CIF.lineas_con_coincidencia(doc.upper).nonzero()[0]
 
     zonas = []
-    for idx in indices_relevantes:
+    for idx in indices_relevantes.tolist():
         for delta in [-1, 0, 1]:
-            if 0 <= idx + delta < len(lines):
-                zonas.append(lines[idx + delta])
+            if 0 <= idx + delta < len(doc):
+                zonas.append(idx + delta)
 
     if not zonas:
-        zonas = lines[:]  # fallback: revisar todo
+        zonas = range(len(doc))  # fallback: revisar todo
 
-    candidatos = []
-    for linea in zonas:
-        limpio = normalizar(linea)
-        encontrados = re.findall(PATRON_CIF, limpio)
-        candidatos.extend(encontrados)
+    # Tokens con forma de CIF ya extraídos de doc.alnum (equivalente a normalizar(linea))
+    tabla = doc.candidatos
+    candidatos = [c for idx in zonas for c in tabla.cifs[idx]]
 
     # Filtrar por validez real
-    válidos = [c for c in candidatos if validar_cif(c)]
+    válidos = [c for c in candidatos if validar_cif(c.valor)]
 
     if válidos:
-        return válidos[0]
+        anotar_origen(origenes, "cif", válidos[0].linea, True)
+        return válidos[0].valor
 
     # Si ninguno válido pero hay candidatos, devolver el mejor guess
     if candidatos:
-        return candidatos[0]
+        anotar_origen(origenes, "cif", candidatos[0].linea, False)
+        return candidatos[0].valor
 
     return None
@@ -0,0 +1,48 @@
+from utils.document import ReceiptDocument
+
+CAMPOS_CONFIANZA = ["establecimiento", "cif", "fecha", "total", "iva", "divisa", "metodo_pago"]
+
+# Peso de la evidencia del parser cuando no es concluyente (1.0 = concluyente)
+EVIDENCIA_DEBIL = {
+    "establecimiento": 0.7,  # primera línea "limpia", sin palabra de establecimiento
+    "cif": 0.5,              # dígito de control incorrecto
+    "fecha": 0.85,           # fecha válida fuera de una línea con FECHA
+    "total": 0.6,            # importe sin palabra TOTAL (el más alto o el último)
+    "iva": 0.7,              # porcentaje no estándar o deducido de los importes
+    "divisa": 0.7,           # variante aproximada (coincidencia difusa)
+    "metodo_pago": 0.8,      # deducido (CAMBIO -> EFECTIVO, coincidencia aproximada)
+}
+# Campo con valor que no sale de ninguna línea del ticket (p.ej. EUR por defecto)
+CONFIANZA_SIN_ORIGEN = 0.2
+
+
+def confianza_campos(lines, resultado, origenes):
+    """
+    Confianza (0-1) de cada campo del resultado y la línea de la que sale.
+
+    Combina la probabilidad media del OCR en la línea de origen (si el
+    documento trae geometría de construir_lineas) con la evidencia del
+    parser: CIF con dígito de control válido, total en una línea con TOTAL,
+    fecha junto a FECHA... Un campo sin valor tiene confianza 0 y uno sin
+    línea de origen, CONFIANZA_SIN_ORIGEN.
+
+    lines: ReceiptDocument o lista de strings del OCR
+    origenes: {campo: Origen} anotados por los parsers (parsear(..., origenes=...))
+    Devuelve ({campo: confianza}, {campo: índice de línea o None}).
+    """
+    doc = ReceiptDocument.desde(lines)
+    confianzas, lineas = {}, {}
+    for campo in CAMPOS_CONFIANZA:
+        origen = origenes.get(campo)
+        lineas[campo] = origen.linea if origen is not None else None
+        if resultado.get(campo) is None:
+            confianzas[campo] = 0.0
+            continue
+        if lineas[campo] is None:
+            confianzas[campo] = CONFIANZA_SIN_ORIGEN
+            continue
+        evidencia = 1.0 if origen.concluyente else EVIDENCIA_DEBIL[campo]
+        geometria = doc.geometria[origen.linea]
+        prob_ocr = geometria.conf if geometria is not None else 1.0
+        confianzas[campo] = round(float(prob_ocr) * evidencia, 3)
+    return confianzas, lineas
@@ -1,4 +1,6 @@
-from utils.helpers import fuzzy_in
+from utils.keywords import KeywordMatcher
+from utils.candidates import anotar_origen
+from utils.document import ReceiptDocument
 
 DIVISAS = {
     "EUR": ["EUR", "€", "EURO", "E.U.R"],
@@ -7,12 +9,25 @@ DIVISAS = {
     "JPY": ["JPY", "¥", "YEN"],
 }
 
-def parse_currency(lines):
-    for linea in reversed(lines):
-        linea_upper = linea.upper()
-        for divisa, variantes in DIVISAS.items():
-            for var in variantes:
-                if fuzzy_in(var, linea_upper, umbral=70):
-                    return divisa
+# Variantes aplanadas en el orden de DIVISAS, con la divisa de cada una
+_VARIANTES = [(divisa, var) for divisa, variantes in DIVISAS.items() for var in variantes]
+MATCHER_DIVISAS = KeywordMatcher([var for _, var in _VARIANTES], umbral=70)
+
+def parse_currency(lines, origenes=None):
+    """
+    lines: ReceiptDocument o lista de strings del OCR
+    origenes: dict opcional donde se anota el Origen de la divisa (sin línea si es
+        la de por defecto; concluyente si la variante aparece tal cual)
+    """
+    doc = ReceiptDocument.desde(lines)
+    coincidencias = MATCHER_DIVISAS.coincidencias(doc.upper)
+    # De abajo a arriba; en cada línea, la primera variante según el orden de DIVISAS
+    for idx in reversed(range(len(coincidencias))):
+        encontradas = coincidencias[idx].nonzero()[0]
+        if len(encontradas):
+            divisa, variante = _VARIANTES[encontradas[0]]
+            anotar_origen(origenes, "divisa", idx, variante in doc.upper[idx])
+            return divisa
     # Fallback: si no se encuentra ninguna, se puede asumir EUR o None
+    anotar_origen(origenes, "divisa", None, False)
     return "EUR"
@@ -1,11 +1,7 @@
-import re
 from datetime import datetime
-from utils.helpers import fuzzy_in
-
-PATRONES_NUMERICOS = [
-    r"(?P<d>\d{1,2})[./\-]\s*(?P<m>\d{1,2})[./\-]\s*(?P<y>\d{2,4})",
-    r"(?P<y>\d{4})[./\-]\s*(?P<m>\d{1,2})[./\-]\s*(?P<d>\d{1,2})",
-]
+from utils.keywords import KeywordMatcher
+from utils.document import ReceiptDocument
+from utils.candidates import RE_FECHA_TEXTO, RE_FECHAS_NUMERICAS, anotar_origen
 
 MONTH_MAP = {
     1: ["ENERO", "ENE", "JAN"],
@@ -22,6 +18,8 @@ MONTH_MAP = {
     12: ["DICIEMBRE", "DIC", "DEC"]
 }
 
+MATCHER_FECHA = KeywordMatcher(["FECHA"], umbral=70)
+
 def _expand_two_digit_year(y):
     """Solo expande si es año de 2 dígitos"""
     y = int(y)
@@ -64,49 +62,54 @@ def _validated_date(day, month, year):
     except:
         return None
 
-def parse_fecha(lines):
-    """Detecta fechas dando prioridad a líneas con palabra 'fecha'"""
-    texto = " ".join(str(line) for line in lines if line)
+def _validar_primera(candidatos):
+    """
+    Como re.search: solo se valida la primera coincidencia del patrón.
+    Devuelve (fecha o None, línea de la coincidencia).
+    """
+    if candidatos:
+        return _validated_date(*candidatos[0].grupos), candidatos[0].linea
+    return None, None
+
+def parse_fecha(lines, origenes=None):
+    """
+    Detecta fechas dando prioridad a líneas con palabra 'fecha'
+    lines: ReceiptDocument o lista de strings del OCR
+    origenes: dict opcional donde se anota el Origen de la fecha (línea, si tenía FECHA)
+    """
+    doc = ReceiptDocument.desde(lines)
+    tabla = doc.candidatos
 
     # 1️⃣ Buscar líneas con 'FECHA'
-    for linea in lines:
-        if fuzzy_in("FECHA", str(linea), umbral=70):
-            line_text = str(linea)
-            # Intentar primero meses escritos
-            text_pattern = r"(\d{1,2})\s*[./\-]?\s*([a-záéíóúñ]{3,})\s*[./\-]?\s*(\d{2,4})"
-            match = re.search(text_pattern, line_text, re.IGNORECASE)
-            if match:
-                day, month, year = match.groups()
-                fecha = _validated_date(day, month, year)
-                if fecha:
-                    return fecha
+    con_fecha = MATCHER_FECHA.lineas_con_coincidencia(doc.upper)
+    for idx in con_fecha.nonzero()[0].tolist():
+        # Intentar primero meses escritos
+        fecha, _ = _validar_primera(tabla.en_linea(tabla.fechas_texto, idx, RE_FECHA_TEXTO))
+        if fecha:
+            anotar_origen(origenes, "fecha", idx, True)
+            return fecha
 
-            # Intentar numérico
-            for pat in PATRONES_NUMERICOS:
-                match = re.search(pat, line_text)
-                if match:
-                    groups = match.groupdict()
-                    fecha = _validated_date(groups['d'], groups['m'], groups['y'])
-                    if fecha:
-                        return fecha
+        # Intentar numérico
+        for candidatos, patron in zip(tabla.fechas_numericas, RE_FECHAS_NUMERICAS):
+            fecha, _ = _validar_primera(tabla.en_linea(candidatos, idx, patron))
+            if fecha:
+                anotar_origen(origenes, "fecha", idx, True)
+                return fecha
 
     # 2️⃣ Si no hay línea con 'FECHA', buscar en todo el texto
+    # (los candidatos se extraen del texto unido, así que una fecha partida
+    # entre dos líneas se sigue encontrando)
     # Fechas con mes escrito
-    text_pattern = r"(\d{1,2})\s*[./\-]?\s*([a-záéíóúñ]{3,})\s*[./\-]?\s*(\d{2,4})"
-    match = re.search(text_pattern, texto, re.IGNORECASE)
-    if match:
-        day, month, year = match.groups()
-        fecha = _validated_date(day, month, year)
-        if fecha:
-            return fecha
+    fecha, linea = _validar_primera(tabla.fechas_texto)
+    if fecha:
+        anotar_origen(origenes, "fecha", linea, False)
+        return fecha
 
     # Fechas numéricas
-    for pat in PATRONES_NUMERICOS:
-        match = re.search(pat, texto)
-        if match:
-            groups = match.groupdict()
-            fecha = _validated_date(groups['d'], groups['m'], groups['y'])
-            if fecha:
-                return fecha
+    for candidatos in tabla.fechas_numericas:
+        fecha, linea = _validar_primera(candidatos)
+        if fecha:
+            anotar_origen(origenes, "fecha", linea, False)
+            return fecha
 
     return None
@@ -1,4 +1,6 @@
-from utils.helpers import fuzzy_in
+from utils.keywords import KeywordMatcher
+from utils.candidates import anotar_origen
+from utils.document import ReceiptDocument
 
 PALABRAS_ESTABLECIMIENTO = [
     "TIENDA","COMERCIO","ALMACÉN","STORE","SHOP","ZARA","MANGO","PRIMARK","CORTE",
@@ -12,28 +14,33 @@ EXCLUDE_KEYWORDS = [
     "CARITAS","BIENVENIDO","GRACIAS","BIZUM","AYUDA","EJEMPLAR","CLIENTE","COMPRA",
     "C/", "CALLE", "AVDA", "AVENIDA", "AVD"]
 
-def parse_establishment(lines):
+MATCHER_ESTABLECIMIENTO = KeywordMatcher(PALABRAS_ESTABLECIMIENTO, umbral=70)
+
+def parse_establishment(lines, origenes=None):
+    """
+    lines: ReceiptDocument o lista de strings del OCR
+    origenes: dict opcional donde se anota el Origen del nombre (línea, si tenía
+        una palabra de establecimiento)
+    """
+    doc = ReceiptDocument.desde(lines)
+
+    # Líneas candidatas: sin palabras excluidas, pocos dígitos y longitud mínima
+    limpias = [
+        i for i, linea_upper in enumerate(doc.upper)
+        if not any(k in linea_upper for k in EXCLUDE_KEYWORDS)
+        and doc.digitos[i] <= 4
+        and len(linea_upper.strip()) >= 3
+    ]
+    if not limpias:
+        return None
+
     # 1️⃣ Buscar líneas que contengan palabras de establecimiento
-    for linea in lines:
-        linea_upper = str(linea).upper()
-        if any(k in linea_upper for k in EXCLUDE_KEYWORDS):
-            continue
-        if sum(c.isdigit() for c in linea_upper) > 4:
-            continue
-        if len(linea_upper.strip()) < 3:
-            continue
-        if any(fuzzy_in(word, linea_upper, umbral=70) for word in PALABRAS_ESTABLECIMIENTO):
-            return linea.strip()
+    con_palabra = MATCHER_ESTABLECIMIENTO.lineas_con_coincidencia([doc.upper[i] for i in limpias])
+    for i, coincide in zip(limpias, con_palabra):
+        if coincide:
+            anotar_origen(origenes, "establecimiento", i, True)
+            return doc.raw[i].strip()
 
     # 2️⃣ Si no hay coincidencias con palabras clave, devolver la primera línea “limpia”
-    for linea in lines:
-        linea_upper = str(linea).upper()
-        if any(k in linea_upper for k in EXCLUDE_KEYWORDS):
-            continue
-        if sum(c.isdigit() for c in linea_upper) > 4:
-            continue
-        if len(linea_upper.strip()) < 3:
-            continue
-        return linea.strip()
-
-    return None
+    anotar_origen(origenes, "establecimiento", limpias[0], False)
+    return doc.raw[limpias[0]].strip()
@@ -1,90 +1,115 @@
 import re
-from decimal import Decimal, ROUND_HALF_UP
-
-IVA_PATTERNS = {
-    # Patrones más flexibles para diferentes formatos
-    'percentage': [
-        r'IVA\s*[:\-]?\s*(\d+[.,]?\d*)\s*%',
-        r'(\d+[.,]?\d*)\s*%\s*IVA',
-        r'IVA\s*\((\d+[.,]?\d*)%\)',
-        r'IMPUESTO.*?(\d+[.,]?\d*)\s*%',
-    ],
-    'separate_line': [
-        r'^IVA\s+(\d+[.,]?\d*)$',
-        r'^.*IVA.*?(\d+[.,]?\d*)$',
-    ],
-    'calculation': [
-        r'(\d+[.,]?\d*)\s*\+\s*IVA',
-        r'BASE\s*[:\-]?\s*(\d+[.,]?\d*).*IVA\s*[:\-]?\s*(\d+[.,]?\d*)',
-    ]
-}
+from utils.candidates import anotar_origen
+from utils.document import ReceiptDocument
 
 # Valores estándar de IVA en España (con tolerancia)
 STANDARD_IVA = [4.0, 10.0, 21.0]
 TOLERANCE = 0.5  # ±0.5% para ajustar errores de OCR
 
-def parse_iva_improved(lines):
+# Contexto que se mira antes/después de cada porcentaje candidato
+CONTEXTO_PATRON = 64
+RE_PREFIJO_IVA = re.compile(r'IVA\s*[:\-]?\s*$', re.IGNORECASE)
+RE_SUFIJO_IVA = re.compile(r'\s*IVA', re.IGNORECASE)
+RE_PREFIJO_IVA_PARENTESIS = re.compile(r'IVA\s*\(?\s*$', re.IGNORECASE)
+RE_IMPUESTO = re.compile(r'IMPUESTO', re.IGNORECASE)
+RE_PREFIJO_VAT = re.compile(r'V\.?A\.?T\.?\s*[:\-]?\s*$', re.IGNORECASE)
+
+def parse_iva_improved(lines, origenes=None):
     """
     Estrategia mejorada para detectar IVA con múltiples enfoques.
+    lines: ReceiptDocument o lista de strings del OCR
+    origenes: dict opcional donde cada método anota la línea del valor que devuelve
     """
-    full_text = " ".join(lines)
+    doc = ReceiptDocument.desde(lines)
     
     # Método 1: Búsqueda directa con patrones flexibles
-    iva_value = find_iva_with_patterns(full_text, lines)
+    iva_value = find_iva_with_patterns(doc, origenes)
     if iva_value:
         return iva_value
     
     # Método 2: Análisis de estructura de precios
-    iva_value = analyze_price_structure(lines)
+    iva_value = analyze_price_structure(doc, origenes)
     if iva_value:
         return iva_value
         
     # Método 3: Búsqueda contextual ampliada
-    iva_value = contextual_search(lines)
+    iva_value = contextual_search(doc, origenes)
     if iva_value:
         return iva_value
         
     return None
 
-def find_iva_with_patterns(full_text, lines):
-    """Busca IVA usando múltiples patrones regex"""
-    
-    # Patrones de porcentaje
-    percentage_patterns = [
-        r'IVA\s*[:\-]?\s*(\d+[.,]?\d*)\s*[%％]',
-        r'(\d+[.,]?\d*)\s*[%％]\s*IVA',
-        r'IVA\s*\(?\s*(\d+[.,]?\d*)\s*[%％]\s*\)?',
-        r'IMPUESTO.*?(\d+[.,]?\d*)\s*[%％]',
-        r'V\.?A\.?T\.?\s*[:\-]?\s*(\d+[.,]?\d*)\s*[%％]',
-    ]
-    
-    for pattern in percentage_patterns:
-        matches = re.findall(pattern, full_text, re.IGNORECASE)
-        for match in matches:
+def _porcentajes_de_impuesto(tabla, texto):
+    """
+    Porcentajes de 'IMPUESTO ... 21%': para cada 'IMPUESTO', el primer
+    porcentaje que viene detrás (como el antiguo findall con '.*?').
+    """
+    pos = 0
+    while True:
+        clave = RE_IMPUESTO.search(texto, pos)
+        if not clave:
+            return
+        siguiente = next((c for c in tabla.porcentajes if c.inicio >= clave.end()), None)
+        if siguiente is None:
+            return
+        yield siguiente
+        pos = siguiente.fin
+
+def find_iva_with_patterns(lines, origenes=None):
+    """
+    Busca IVA usando múltiples patrones sobre los porcentajes ya extraídos.
+    lines: ReceiptDocument o lista de strings del OCR
+
+    Cada patrón de porcentaje ('IVA 21%', '21% IVA', 'IVA (21%)', 'IMPUESTO ... 21%',
+    'VAT 21%') se comprueba mirando el contexto alrededor de cada candidato, en
+    el mismo orden en que se aplicaban las expresiones sobre todo el texto.
+    """
+    doc = ReceiptDocument.desde(lines)
+    tabla = doc.candidatos
+    texto = doc.texto
+
+    def con_prefijo(patron):
+        return (c for c in tabla.porcentajes
+                if patron.search(texto, max(0, c.inicio - CONTEXTO_PATRON), c.inicio))
+
+    def con_sufijo(patron):
+        return (c for c in tabla.porcentajes
+                if patron.match(texto, c.fin, c.fin + CONTEXTO_PATRON))
+
+    for candidatos in (
+        con_prefijo(RE_PREFIJO_IVA),
+        con_sufijo(RE_SUFIJO_IVA),
+        con_prefijo(RE_PREFIJO_IVA_PARENTESIS),
+        _porcentajes_de_impuesto(tabla, texto),
+        con_prefijo(RE_PREFIJO_VAT),
+    ):
+        for candidato in candidatos:
             try:
-                value = float(match.replace(',', '.'))
+                value = float(candidato.valor.replace(',', '.'))
                 # Verificar si es un valor estándar (con tolerancia)
                 for standard in STANDARD_IVA:
                     if abs(value - standard) <= TOLERANCE:
+                        anotar_origen(origenes, "iva", candidato.linea, True)
                         return standard
                 # Si no es estándar pero está en rango plausible, devolverlo redondeado
                 if 1 <= value <= 30:
+                    anotar_origen(origenes, "iva", candidato.linea, True)
                     return round(value)
             except (ValueError, TypeError):
                 continue
     
     return None
 
-def analyze_price_structure(lines):
+def analyze_price_structure(lines, origenes=None):
     """
     Analiza la estructura de precios para inferir el IVA.
     Busca patrones como: base + IVA = total
+    lines: ReceiptDocument o lista de strings del OCR
     """
-    price_pattern = r'(\d+[.,]?\d*[.,]?\d*)'  # Más flexible para formatos de precio
+    doc = ReceiptDocument.desde(lines)
     
-    for i, line in enumerate(lines):
-        line_clean = re.sub(r'[^\d\s.,]', ' ', line)  # Solo números y separadores
-        numbers = re.findall(price_pattern, line_clean)
+    # Números de cada línea (solo dígitos y separadores), ya extraídos
+    for idx, numbers in enumerate(doc.candidatos.numeros):
         
         if len(numbers) >= 3:
             # Intentar encontrar base, IVA y total
@@ -113,6 +138,7 @@ def analyze_price_structure(lines):
                         # Verificar contra valores estándar
                         for standard in STANDARD_IVA:
                             if abs(calculated_pct - standard) <= TOLERANCE:
+                                anotar_origen(origenes, "iva", idx, False)
                                 return standard
                 
                 # Buscar patrones de cálculo directo
@@ -123,31 +149,35 @@ def analyze_price_structure(lines):
                         
                         for standard in STANDARD_IVA:
                             if abs(calculated_pct - standard) <= TOLERANCE:
+                                anotar_origen(origenes, "iva", idx, False)
                                 return standard
     
     return None
 
-def contextual_search(lines):
+def contextual_search(lines, origenes=None):
     """
     Búsqueda contextual más amplia - busca líneas que contengan
     keywords de IVA y analiza el contexto cercano
+    lines: ReceiptDocument o lista de strings del OCR
     """
     iva_keywords = ['IVA', 'IMPUESTO', 'V.A.T', 'VAT', 'I.V.A', 'TAX']
+    doc = ReceiptDocument.desde(lines)
+    tabla = doc.candidatos
     
-    for i, line in enumerate(lines):
-        line_upper = line.upper()
+    for i, line_upper in enumerate(doc.upper):
         
         # Verificar si la línea contiene algún keyword
         has_keyword = any(keyword in line_upper for keyword in iva_keywords)
         
         if has_keyword:
             # Buscar porcentajes en la misma línea
-            percentages = re.findall(r'(\d+[.,]?\d*)\s*[%％]', line)
+            percentages = [c.valor for c in tabla.porcentajes_en_linea(i)]
             for pct in percentages:
                 try:
                     value = float(pct.replace(',', '.'))
                     for standard in STANDARD_IVA:
                         if abs(value - standard) <= TOLERANCE:
+                            anotar_origen(origenes, "iva", i, True)
                             return standard
                 except ValueError:
                     continue
@@ -155,14 +185,14 @@ def contextual_search(lines):
             # Buscar en líneas adyacentes
             for offset in [-1, 1, -2, 2]:  # Líneas anterior, siguiente, etc.
                 idx = i + offset
-                if 0 <= idx < len(lines):
-                    adjacent_line = lines[idx]
-                    percentages = re.findall(r'(\d+[.,]?\d*)\s*[%％]', adjacent_line)
+                if 0 <= idx < len(doc):
+                    percentages = [c.valor for c in tabla.porcentajes_en_linea(idx)]
                     for pct in percentages:
                         try:
                             value = float(pct.replace(',', '.'))
                             for standard in STANDARD_IVA:
                                 if abs(value - standard) <= TOLERANCE:
+                                    anotar_origen(origenes, "iva", idx, False)
                                     return standard
                         except ValueError:
                             continue
@@ -170,19 +200,28 @@ def contextual_search(lines):
     return None
 
 # Función principal mejorada
-def parse_iva(lines):
+def parse_iva(lines, origenes=None):
     """
     Versión mejorada que combina múltiples estrategias
+    lines: ReceiptDocument o lista de strings del OCR
+    origenes: dict opcional donde se anota el Origen del IVA (línea; concluyente
+        si es un tipo estándar sacado de una línea con IVA)
     """
-    result = parse_iva_improved(lines)
+    encontrados = {}
+    result = parse_iva_improved(lines, encontrados)
+    origen = encontrados.get("iva")
+    linea = origen.linea if origen else None
     
     # Post-procesamiento: asegurar que sea un valor estándar
     if result:
         # Redondear al valor estándar más cercano
         closest_standard = min(STANDARD_IVA, key=lambda x: abs(x - result))
         if abs(closest_standard - result) <= 2:  # Tolerancia más amplia
+            anotar_origen(origenes, "iva", linea, bool(origen and origen.concluyente)
+                          and closest_standard == result)
             return closest_standard
         elif 1 <= result <= 30:  # Rango plausible pero no estándar
+            anotar_origen(origenes, "iva", linea, False)
             return round(result)
     
     return None
\ No newline at end of file
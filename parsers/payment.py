@@ -1,5 +1,6 @@
-import re
-from utils.helpers import fuzzy_in
+from utils.keywords import KeywordMatcher
+from utils.candidates import anotar_origen
+from utils.document import ReceiptDocument
 
 # Variantes OCR típicas de "EFECTIVO"
 EFECTIVO_VARIANTES = [
@@ -13,29 +14,41 @@ TARJETA_VARIANTES = [
     "VISA", "MASTERCARD", "MAESTRO", "DEBITO", "DEBIT", "CREDIT"
 ]
 
-def parse_payment(lines):
-    lines_upper = [l.upper() for l in lines]
+MATCHER_TARJETAS = KeywordMatcher(TARJETA_VARIANTES, umbral=90)
+
+def parse_payment(lines, origenes=None):
+    """
+    lines: ReceiptDocument o lista de strings del OCR
+    origenes: dict opcional donde se anota el Origen del método (línea, si aparece
+        tal cual en lugar de deducirse)
+    """
+    lines_upper = ReceiptDocument.desde(lines).upper
 
     # 1️⃣ Detectar EFECTIVO primero pero con variantes explícitas, no fuzzy
-    for linea in lines_upper:
+    for idx, linea in enumerate(lines_upper):
         for variante in EFECTIVO_VARIANTES:
             if variante in linea:
+                anotar_origen(origenes, "metodo_pago", idx, True)
                 return "EFECTIVO"
 
     # 2️⃣ Detectar tarjetas (VISA, MASTERCARD…) por coincidencia exacta o casi exacta
-    for linea in lines_upper:
+    for idx, linea in enumerate(lines_upper):
         for variante in TARJETA_VARIANTES:
             if variante in linea:
+                anotar_origen(origenes, "metodo_pago", idx, True)
                 return variante
 
     # 3️⃣ Último recurso: fuzzy matching PERO con umbral bajo para evitar falsos positivos
-    for linea in lines_upper:
-        for metodo in TARJETA_VARIANTES:
-            if fuzzy_in(metodo, linea, umbral=90):
-                return metodo
+    for idx, fila in enumerate(MATCHER_TARJETAS.coincidencias(lines_upper)):
+        encontrados = fila.nonzero()[0]
+        if len(encontrados):
+            anotar_origen(origenes, "metodo_pago", idx, False)
+            return TARJETA_VARIANTES[encontrados[0]]
 
     # 4️⃣ Si aparece "CAMBIO", es EFECTIVO
-    if any("CAMBIO" in l for l in lines_upper):
-        return "EFECTIVO"
+    for idx, linea in enumerate(lines_upper):
+        if "CAMBIO" in linea:
+            anotar_origen(origenes, "metodo_pago", idx, False)
+            return "EFECTIVO"
 
     return None
@@ -1,57 +1,455 @@
 from parsers.iva import parse_iva
-from preprocess.filters import preprocesar_imagen
-from ocr.easyocr_engine import EasyOCREngine
-from ocr.segmenters import recorte_superior
-from utils.ocr_structure import construir_lineas
+from preprocess.filters import cargar_imagen, preprocesar_imagen_con_escala, variantes_relectura
+from preprocess.crop import recortar_ticket
+from ocr.engines import crear_motor
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from ocr.segmenters import recorte_superior, en_cabecera, recorte_caja, etapas_reconocimiento
+from utils.ocr_structure import construir_lineas, LineaOCR
+from utils.timing import StageTimer
+from utils.document import ReceiptDocument
 from parsers.establishment import parse_establishment
 from parsers.cif import parse_cif
 from parsers.date import parse_fecha
 from parsers.amounts import parse_total
 from parsers.payment import parse_payment
 from parsers.currency import parse_currency  # <-- nuevo
+from parsers.confidence import confianza_campos
+
+ESCALA_BASE = 2
+# OCR en dos fases: se dejan de reconocer regiones en cuanto estos campos tienen valor
+CAMPOS_REQUERIDOS = ("establecimiento", "fecha", "total")
+
+def parsear(doc, tiempos=None, origenes=None):
+    """
+    Ejecuta todos los parsers sobre un ReceiptDocument (sin OCR).
+    Lo usan el pipeline y la repetición de parsers sobre los logs (replay.py).
+    origenes: dict opcional donde cada parser anota el Origen (línea y
+        evidencia) de su campo, para parsers.confidence.confianza_campos.
+    """
+    tiempos = tiempos if tiempos is not None else StageTimer()
+
+    # --- Parseos robustos ---
+    with tiempos.medir("parse_establishment"):
+        nombre = parse_establishment(doc, origenes)
+    with tiempos.medir("parse_cif"):
+        cif = parse_cif(doc, origenes)
+    with tiempos.medir("parse_fecha"):
+        fecha = parse_fecha(doc, origenes)
+    with tiempos.medir("parse_total"):
+        total = parse_total(doc, line_heights=doc.alturas_relativas, origenes=origenes)
+    with tiempos.medir("parse_payment"):
+        metodo_pago = parse_payment(doc, origenes)
+    with tiempos.medir("parse_iva"):
+        iva = parse_iva(doc, origenes)
+    with tiempos.medir("parse_currency"):
+        divisa = parse_currency(doc, origenes)  # <-- nuevo
+
+    # --- Construir diccionario antes del return ---
+    return {
+        "establecimiento": nombre,
+        "cif": cif,
+        "fecha": fecha,
+        "total": total,
+        "iva": iva,
+        "divisa": divisa,          # <-- añadido
+        "metodo_pago": metodo_pago
+    }
+
+
+def recortar_imagen(imagen, tiempos):
+    """
+    Carga la imagen y recorta el ticket (preprocess.crop). Anota en `tiempos`
+    la etapa "recorte" y la fracción de píxeles conservada. Si la imagen no
+    se puede cargar se devuelve tal cual y el preprocesado da el error.
+    """
+    with tiempos.medir("recorte"):
+        cargada = cargar_imagen(imagen)
+        if cargada is None:
+            return imagen
+        recortada, datos = recortar_ticket(cargada)
+    tiempos.anotar(**datos)
+    return recortada
+
+
+def factor_escala(escalado_adaptativo):
+    """scale_factor de preprocesar_imagen_con_escala según la opción escalado_adaptativo."""
+    return "auto" if escalado_adaptativo else ESCALA_BASE
+
+
+def preprocesar(imagen, tiempos, scale_factor=ESCALA_BASE, recortar=False):
+    """
+    Recorte opcional y preprocesado de una imagen (ruta, bytes o ndarray).
+    Lo usan TicketPipeline y el pool de workers, que preprocesa en el proceso
+    principal. Devuelve (imagen preprocesada, escala aplicada).
+    """
+    if recortar:
+        imagen = recortar_imagen(imagen, tiempos)
+    with tiempos.medir("preprocesado"):
+        img, escala = preprocesar_imagen_con_escala(imagen, scale_factor)
+    if img is None:
+        raise ValueError("No se pudo preprocesar la imagen.")
+    return img, escala
+
+
+def _clave_caja(bbox):
+    """Esquinas de una caja como tupla, para emparejar lo que devuelve reconocer()."""
+    return tuple((int(x), int(y)) for x, y in bbox)
+
 
 class TicketPipeline:
 
-    def __init__(self):
-        self.ocr = EasyOCREngine()
+    def __init__(self, cabecera_un_paso=False, umbral_confianza_cabecera=0.5, ocr=None,
+                 escalado_adaptativo=False, motor_ocr="easyocr", directorio_onnx=None,
+                 ocr_perezoso=False, campos_requeridos=CAMPOS_REQUERIDOS, umbral_confianza_campos=0.0,
+                 recortar=False):
+        """
+        cabecera_un_paso: si es True, las líneas de encabezado se sacan de las
+            detecciones del OCR completo en vez de repetir el OCR del recorte superior.
+        umbral_confianza_cabecera: en modo un paso, las cajas del encabezado con
+            probabilidad menor se vuelven a reconocer (solo su recorte).
+        ocr: motor OCR ya creado (ocr.base.OCREngine); si no se pasa, se crea
+            uno nuevo de tipo `motor_ocr`.
+        escalado_adaptativo: elegir la escala según la altura del texto en lugar
+            de ampliar siempre x2.
+        motor_ocr: uno de ocr.engines.MOTORES ("easyocr", "onnx-int8"...).
+        directorio_onnx: dónde guardar los modelos exportados de los motores ONNX.
+        ocr_perezoso: OCR en dos fases. Se detectan todas las cajas, pero solo
+            se reconocen por etapas (encabezado y pie primero) mientras falte
+            alguno de `campos_requeridos` en el resultado. El encabezado sale
+            de esas mismas cajas, como con cabecera_un_paso.
+        umbral_confianza_campos: los campos con menos confianza se releen
+            (solo su línea, ampliada y binarizada). 0 = no releer; la confianza
+            de cada campo se devuelve siempre en resultado["confianza"].
+        recortar: buscar el contorno del ticket y recortarlo (corrigiendo
+            perspectiva e inclinación) antes del preprocesado.
+        """
+        self.ocr = ocr or crear_motor(motor_ocr, directorio_onnx)
+        if ocr_perezoso and not self.ocr.dos_fases:
+            raise ValueError("El motor OCR no separa detección y reconocimiento (ocr_perezoso)")
+        self.ocr_perezoso = ocr_perezoso
+        self.campos_requeridos = tuple(campos_requeridos)
+        self.umbral_confianza_campos = umbral_confianza_campos
+        self.recortar = recortar
+        self.cabecera_un_paso = cabecera_un_paso
+        self.umbral_confianza_cabecera = umbral_confianza_cabecera
+        self.scale_factor = factor_escala(escalado_adaptativo)
+
+    def calentar(self):
+        """
+        Inferencia de prueba sobre un ticket sintético para que el primer
+        ticket real no pague las reservas de memoria e inicializaciones de torch.
+        """
+        img = np.full((160, 640), 255, dtype=np.uint8)
+        cv2.putText(img, "TOTAL 1,00 EUR", (20, 100), cv2.FONT_HERSHEY_SIMPLEX, 1.5, 0, 3)
+        self.procesar_imagen(img)
+
+    def procesar_ticket(self, imagen, tiempos=None):
+        """
+        imagen: ruta del fichero, bytes de la imagen codificada o ndarray.
+        tiempos: StageTimer opcional donde se anotan los tiempos de cada etapa.
+        """
+        tiempos = tiempos if tiempos is not None else StageTimer()
+        img, escala = self._preprocesar(imagen, tiempos)
+        return self.procesar_imagen(img, escala, tiempos)
+
+    def _preprocesar(self, imagen, tiempos):
+        return preprocesar(imagen, tiempos, self.scale_factor, self.recortar)
+
+    def procesar_lote(self, imagenes, tiempos=None):
+        """
+        Varios tickets a la vez (p.ej. un álbum de Telegram): recorte y
+        preprocesado en paralelo en hilos, y el OCR completo (y el del
+        encabezado) de todas las imágenes en una sola llamada por lotes al
+        motor (leer_detalle_lote). El resto del pipeline va ticket a ticket.
+        En modo ocr_perezoso solo el preprocesado va en paralelo.
+
+        imagenes: lista de rutas, bytes o ndarrays.
+        tiempos: lista de StageTimer, uno por imagen (opcional).
+        Devuelve una lista en el mismo orden con (resultado, lineas) o la
+        excepción de esa imagen, para que un ticket ilegible no tire el lote.
+        """
+        tiempos = tiempos if tiempos is not None else [StageTimer() for _ in imagenes]
+        salida = [None] * len(imagenes)
+        with ThreadPoolExecutor(max_workers=min(len(imagenes), os.cpu_count() or 1) or 1) as hilos:
+            futures = [hilos.submit(self._preprocesar, img, t) for img, t in zip(imagenes, tiempos)]
+        preparadas = []  # (índice, img, escala)
+        for i, future in enumerate(futures):
+            try:
+                preparadas.append((i, *future.result()))
+            except Exception as e:
+                salida[i] = e
+
+        if self.ocr_perezoso:
+            for i, img, escala in preparadas:
+                salida[i] = self._procesar_seguro(self.procesar_imagen, img, escala, tiempos[i])
+            return salida
 
-    def procesar_ticket(self, ruta_imagen):
-        img = preprocesar_imagen(ruta_imagen)
+        completos = self._leer_lote([img for _, img, _ in preparadas], [tiempos[i] for i, _, _ in preparadas],
+                                    "ocr_completo")
+        if self.cabecera_un_paso:
+            cabeceras = [None] * len(preparadas)
+        else:
+            cabeceras = self._leer_lote([recorte_superior(img) for _, img, _ in preparadas],
+                                        [tiempos[i] for i, _, _ in preparadas], "ocr_cabecera")
+        for (i, img, escala), ocr_result, ocr_result_top in zip(preparadas, completos, cabeceras):
+            tiempos[i].anotar(ocr_batch_size=len(preparadas))
+            salida[i] = self._procesar_seguro(self._procesar_detalle, img, escala, tiempos[i],
+                                              ocr_result, ocr_result_top)
+        return salida
+
+    def _leer_lote(self, imagenes, tiempos, etapa):
+        """OCR por lotes; el tiempo de la llamada se reparte a partes iguales entre los tickets."""
+        if not imagenes:
+            return []
+        inicio = time.perf_counter()
+        resultados = self.ocr.leer_detalle_lote(imagenes)
+        por_ticket = (time.perf_counter() - inicio) / len(imagenes)
+        for t in tiempos:
+            t.sumar(etapa, por_ticket)
+        return resultados
+
+    @staticmethod
+    def _procesar_seguro(funcion, *args):
+        try:
+            return funcion(*args)
+        except Exception as e:
+            return e
+
+    def procesar_imagen(self, img, escala=ESCALA_BASE, tiempos=None):
+        """
+        OCR + parseo sobre una imagen ya preprocesada.
+        Separado de `procesar_ticket` para que los workers del pool
+        reciban la imagen preprocesada por memoria compartida.
+        escala: factor aplicado en el preprocesado (solo se anota; la agrupación
+            en líneas se ajusta sola a la altura del texto).
+        tiempos: StageTimer opcional donde se anotan los tiempos de cada etapa.
+        """
+        tiempos = tiempos if tiempos is not None else StageTimer()
+        if self.ocr_perezoso:
+            return self._procesar_por_etapas(img, escala, tiempos)
 
         # OCR completo con bounding boxes
-        ocr_result = self.ocr.leer_detalle(img)  # [(bbox, texto, prob)]
+        with tiempos.medir("ocr_completo"):
+            ocr_result = self.ocr.leer_detalle(img)  # [(bbox, texto, prob)]
+        return self._procesar_detalle(img, escala, tiempos, ocr_result)
 
+    def _procesar_detalle(self, img, escala, tiempos, ocr_result, ocr_result_top=None):
+        """
+        Resto del pipeline a partir del OCR completo.
+        ocr_result_top: OCR del recorte superior si ya se ha hecho (procesar_lote).
+        """
         # Construir líneas ordenadas por posición (arriba a abajo)
-        lines, raw_lines = construir_lineas(ocr_result)
+        with tiempos.medir("construir_lineas"):
+            lines, raw_lines = construir_lineas(ocr_result)
 
         # OCR específico para encabezado (arriba)
-        img_top = recorte_superior(img)
-        ocr_result_top = self.ocr.leer_detalle(img_top)
-        lines_top, _ = construir_lineas(ocr_result_top)
+        with tiempos.medir("ocr_cabecera"):
+            if self.cabecera_un_paso:
+                ocr_result_top = self._cabecera_desde_detalle(img, ocr_result)
+            elif ocr_result_top is None:
+                img_top = recorte_superior(img)
+                ocr_result_top = self.ocr.leer_detalle(img_top)
+        with tiempos.medir("construir_lineas"):
+            lines_top, raw_lines_top = construir_lineas(ocr_result_top)
+
+        tiempos.anotar(
+            image_height=int(img.shape[0]),
+            image_width=int(img.shape[1]),
+            scale=escala,
+            ocr_boxes=len(ocr_result),
+            ocr_boxes_header=len(ocr_result_top),
+        )
 
         # Combinar líneas
         todas_las_lineas = lines_top + lines
 
-        # --- Parseos robustos ---
-        nombre = parse_establishment(todas_las_lineas)
-        cif = parse_cif(todas_las_lineas)
-        fecha = parse_fecha(todas_las_lineas)
-        total = parse_total(todas_las_lineas)
-        metodo_pago = parse_payment(todas_las_lineas)
-        iva = parse_iva(todas_las_lineas)
-        divisa = parse_currency(todas_las_lineas)  # <-- nuevo
-
-        # --- Construir diccionario antes del return ---
-        resultado = {
-            "establecimiento": nombre,
-            "cif": cif,
-            "fecha": fecha,
-            "total": total,
-            "iva": iva,
-            "divisa": divisa,          # <-- añadido
-            "metodo_pago": metodo_pago
-        }
+        # Normalizar el texto una sola vez para todos los parsers
+        with tiempos.medir("documento"):
+            doc = ReceiptDocument(todas_las_lineas, raw_lines_top + raw_lines)
+
+        origenes = {}
+        resultado = parsear(doc, tiempos, origenes)
+        resultado, todas_las_lineas = self._reforzar_campos(img, doc, resultado, origenes, tiempos)
 
         # Devuelve el resultado procesado y el texto crudo del OCR para logging
         # `todas_las_lineas` es la lista de strings extraída por el OCR
         return resultado, todas_las_lineas
+
+    def _procesar_por_etapas(self, img, escala, tiempos):
+        """
+        OCR en dos fases: detección de todas las cajas y reconocimiento por
+        etapas (ocr.segmenters.etapas_reconocimiento), parseando tras cada una.
+        En tickets con muchos artículos la zona central no llega a reconocerse.
+        """
+        with tiempos.medir("ocr_deteccion"):
+            cajas = self.ocr.detectar(img)
+        etapas = etapas_reconocimiento(cajas, img.shape[0])
+
+        ocr_result = []
+        reconocidas = 0
+        ejecutadas = 0
+        lines_top, raw_lines_top = [], []
+        resultado = doc = None
+        origenes = {}
+        for etapa in etapas or [[]]:
+            with tiempos.medir("ocr_reconocimiento"):
+                ocr_result += self.ocr.reconocer(img, etapa)
+            reconocidas += len(etapa)
+            ejecutadas += 1
+
+            with tiempos.medir("construir_lineas"):
+                lines, raw_lines = construir_lineas(ocr_result)
+            if ejecutadas == 1:
+                # Todo el encabezado entra en la primera etapa: se construye una sola vez
+                with tiempos.medir("ocr_cabecera"):
+                    ocr_result_top = self._cabecera_desde_detalle(img, ocr_result)
+                with tiempos.medir("construir_lineas"):
+                    lines_top, raw_lines_top = construir_lineas(ocr_result_top)
+
+            todas_las_lineas = lines_top + lines
+            with tiempos.medir("documento"):
+                doc = ReceiptDocument(todas_las_lineas, raw_lines_top + raw_lines)
+            origenes = {}
+            resultado = parsear(doc, tiempos, origenes)
+            if all(resultado.get(campo) for campo in self.campos_requeridos):
+                break
+
+        tiempos.anotar(
+            image_height=int(img.shape[0]),
+            image_width=int(img.shape[1]),
+            scale=escala,
+            ocr_boxes=len(cajas),
+            ocr_boxes_recognized=reconocidas,
+            ocr_stages=ejecutadas,
+            ocr_stages_total=len(etapas),
+        )
+        return self._reforzar_campos(img, doc, resultado, origenes, tiempos)
+
+    def _reforzar_campos(self, img, doc, resultado, origenes, tiempos):
+        """
+        Calcula la confianza de cada campo y, si alguno queda por debajo de
+        umbral_confianza_campos, vuelve a leer solo la línea de la que sale
+        con las variantes de preprocess.filters.variantes_relectura. Un campo
+        releído solo se sustituye si su confianza mejora y, si además cambia
+        de valor, solo si la nueva llega al umbral; los cambios aceptados y
+        rechazados se anotan en `tiempos` con el valor anterior y el nuevo.
+        origenes: el Origen de cada campo, anotado por parsear.
+        Devuelve (resultado con "confianza" y "geometria", líneas finales del OCR).
+        """
+        with tiempos.medir("confianza"):
+            confianzas, lineas_origen = confianza_campos(doc, resultado, origenes)
+
+        debiles = [
+            campo for campo, confianza in confianzas.items()
+            if 0 < confianza < self.umbral_confianza_campos
+            and lineas_origen[campo] is not None and doc.geometria[lineas_origen[campo]] is not None
+        ]
+        if debiles:
+            geometria = list(doc.geometria)
+            lineas = list(doc.raw)
+            with tiempos.medir("relectura"):
+                for idx in sorted({lineas_origen[campo] for campo in debiles}):
+                    releida = self._releer_linea(img, geometria[idx])
+                    if releida is not None:
+                        lineas[idx], geometria[idx] = releida.texto, releida
+
+                nuevo_doc = ReceiptDocument(lineas, geometria)
+                nuevos_origenes = {}
+                nuevo = parsear(nuevo_doc, origenes=nuevos_origenes)
+                nuevas, _ = confianza_campos(nuevo_doc, nuevo, nuevos_origenes)
+            mejorados, cambiados, rechazados = [], {}, {}
+            for campo in debiles:
+                if nuevas[campo] <= confianzas[campo]:
+                    continue
+                if nuevo[campo] != resultado[campo]:
+                    # Un valor distinto con poca confianza puede ser otro error de OCR
+                    if nuevas[campo] < self.umbral_confianza_campos:
+                        rechazados[campo] = [resultado[campo], nuevo[campo]]
+                        continue
+                    cambiados[campo] = [resultado[campo], nuevo[campo]]
+                mejorados.append(campo)
+                resultado[campo] = nuevo[campo]
+                confianzas[campo] = nuevas[campo]
+            tiempos.anotar(fields_reread=debiles, fields_improved=mejorados)
+            if cambiados:
+                tiempos.anotar(fields_changed=cambiados)
+            if rechazados:
+                tiempos.anotar(fields_change_rejected=rechazados)
+            if mejorados:
+                doc = nuevo_doc
+
+        resultado["confianza"] = confianzas
+        # Altura y confianza de cada línea: el log de OCR las guarda junto al
+        # texto para que replay.py reconstruya el documento con su geometría
+        resultado["geometria"] = [
+            [round(float(g.h), 1), round(float(g.conf), 3)] if g is not None else None
+            for g in doc.geometria
+        ]
+        return resultado, doc.raw
+
+    def _releer_linea(self, img, linea):
+        """Vuelve a pasar el OCR por el recorte de una línea. Devuelve un LineaOCR si mejora la probabilidad."""
+        margen = max(4, int(linea.h * 0.2))
+        bbox = [[linea.x, linea.y], [linea.x + linea.w, linea.y],
+                [linea.x + linea.w, linea.y + linea.h], [linea.x, linea.y + linea.h]]
+        recorte = recorte_caja(img, bbox, margen)
+        if not recorte.size:
+            return None
+
+        mejor = None
+        for variante in variantes_relectura(recorte):
+            releido = self.ocr.leer_detalle(variante)
+            if not releido:
+                continue
+            prob = sum(r[2] for r in releido) / len(releido)
+            if prob > (mejor.conf if mejor else linea.conf):
+                texto = " ".join(r[1] for r in sorted(releido, key=lambda r: r[0][0][0]))
+                mejor = LineaOCR(texto, linea.x, linea.y, linea.w, linea.h, prob, len(releido))
+            if mejor is not None and mejor.conf >= self.umbral_confianza_campos:
+                break
+        return mejor
+
+    def _cabecera_desde_detalle(self, img, ocr_result):
+        """
+        Reutiliza las cajas del OCR completo que caen en el encabezado.
+        Solo las de baja confianza se releen (ver _releer_cajas).
+        """
+        alto = img.shape[0]
+        cabecera = [r for r in ocr_result if en_cabecera(r[0], alto)]
+        debiles = [i for i, (_, _, prob) in enumerate(cabecera) if prob < self.umbral_confianza_cabecera]
+        if debiles:
+            releidas = self._releer_cajas(img, [cabecera[i][0] for i in debiles])
+            for i, (texto, prob) in zip(debiles, releidas):
+                if prob > cabecera[i][2]:
+                    # Mantener la caja original para ordenar las líneas
+                    cabecera[i] = (cabecera[i][0], texto, prob)
+        return cabecera
+
+    def _releer_cajas(self, img, bboxes):
+        """
+        (texto, prob) de cada caja leída otra vez; prob 0 si no sale nada.
+        Con un motor de dos fases, solo el reconocedor y todas las cajas en una
+        llamada; si no, cada recorte ampliado x2 pasa por leer_detalle.
+        """
+        if self.ocr.dos_fases:
+            cajas = [self.ocr.caja(img, bbox) for bbox in bboxes]
+            leidas = {_clave_caja(bbox): (texto, prob) for bbox, texto, prob in self.ocr.reconocer(img, cajas)}
+            return [leidas.get(_clave_caja(c.bbox), ("", 0)) for c in cajas]
+
+        releidas = []
+        for bbox in bboxes:
+            recorte = recorte_caja(img, bbox)
+            releido = []
+            if recorte.size:
+                recorte = cv2.resize(recorte, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+                releido = self.ocr.leer_detalle(recorte)
+            if releido:
+                texto = " ".join(r[1] for r in sorted(releido, key=lambda r: r[0][0][0]))
+                releidas.append((texto, sum(r[2] for r in releido) / len(releido)))
+            else:
+                releidas.append(("", 0))
+        return releidas
@@ -0,0 +1,91 @@
+import cv2
+import numpy as np
+
+# El contorno se busca en una copia reducida a este ancho; el recorte se hace a resolución completa
+ANCHO_DETECCION = 500
+# El contorno tiene que ocupar al menos esta fracción de la foto para fiarse de él
+AREA_MIN = 0.15
+# Por encima de esta fracción el ticket ya llena la foto y no compensa recortar
+AREA_MAX = 0.92
+# Un contorno que no se reduce a 4 vértices se acepta como su rectángulo mínimo
+# si lo llena al menos en esta proporción (ticket con esquinas arrugadas o dobladas)
+RELLENO_MIN_RECTANGULO = 0.85
+
+
+def _ordenar_esquinas(puntos):
+    """4 puntos -> (arriba-izq, arriba-der, abajo-der, abajo-izq)."""
+    puntos = np.asarray(puntos, dtype=np.float32).reshape(4, 2)
+    suma = puntos.sum(axis=1)
+    resta = np.diff(puntos, axis=1).ravel()
+    return np.array([
+        puntos[np.argmin(suma)], puntos[np.argmin(resta)],
+        puntos[np.argmax(suma)], puntos[np.argmax(resta)],
+    ], dtype=np.float32)
+
+
+def detectar_contorno(image, ancho_deteccion=ANCHO_DETECCION):
+    """
+    Busca el contorno del ticket con Canny + contornos sobre una copia reducida.
+    Devuelve las 4 esquinas en coordenadas de la imagen original, o None si no
+    hay un contorno fiable (fondo del mismo color, ticket cortado, foto ya ajustada).
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    alto, ancho = gray.shape[:2]
+    escala = min(1.0, ancho_deteccion / ancho)
+    pequena = cv2.resize(gray, None, fx=escala, fy=escala, interpolation=cv2.INTER_AREA) if escala < 1 else gray
+
+    suavizada = cv2.GaussianBlur(pequena, (5, 5), 0)
+    bordes = cv2.Canny(suavizada, 50, 150)
+    # Cerrar huecos del borde (papel arrugado, sombras)
+    bordes = cv2.dilate(bordes, np.ones((3, 3), np.uint8), iterations=2)
+    contornos, _ = cv2.findContours(bordes, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    area_imagen = pequena.shape[0] * pequena.shape[1]
+    for contorno in sorted(contornos, key=cv2.contourArea, reverse=True)[:5]:
+        area = cv2.contourArea(contorno)
+        if area < AREA_MIN * area_imagen:
+            break
+        aproximado = cv2.approxPolyDP(contorno, 0.02 * cv2.arcLength(contorno, True), True)
+        if len(aproximado) == 4 and cv2.isContourConvex(aproximado):
+            esquinas = aproximado.reshape(4, 2)
+        else:
+            rectangulo = cv2.minAreaRect(contorno)
+            if area < RELLENO_MIN_RECTANGULO * rectangulo[1][0] * rectangulo[1][1]:
+                continue
+            esquinas = cv2.boxPoints(rectangulo)
+        if cv2.contourArea(esquinas.astype(np.float32)) > AREA_MAX * area_imagen:
+            return None
+        return _ordenar_esquinas(esquinas) / escala
+    return None
+
+
+def recortar_ticket(image):
+    """
+    Recorta el ticket y corrige perspectiva e inclinación antes del preprocesado.
+
+    image: ndarray BGR o gris a resolución completa.
+    Devuelve (imagen, datos). Sin un contorno fiable se devuelve la imagen tal
+    cual. datos: crop_applied, crop_ratio (fracción de píxeles que se conserva)
+    y crop_skew_deg (inclinación corregida).
+    """
+    esquinas = detectar_contorno(image)
+    if esquinas is None:
+        return image, {"crop_applied": False, "crop_ratio": 1.0}
+
+    sup_izq, sup_der, inf_der, inf_izq = esquinas
+    ancho = int(round(max(np.linalg.norm(sup_der - sup_izq), np.linalg.norm(inf_der - inf_izq))))
+    alto = int(round(max(np.linalg.norm(inf_izq - sup_izq), np.linalg.norm(inf_der - sup_der))))
+    if ancho < 16 or alto < 16:
+        return image, {"crop_applied": False, "crop_ratio": 1.0}
+
+    destino = np.array([[0, 0], [ancho - 1, 0], [ancho - 1, alto - 1], [0, alto - 1]], dtype=np.float32)
+    matriz = cv2.getPerspectiveTransform(esquinas, destino)
+    recortada = cv2.warpPerspective(image, matriz, (ancho, alto), flags=cv2.INTER_LINEAR,
+                                    borderMode=cv2.BORDER_REPLICATE)
+
+    inclinacion = float(np.degrees(np.arctan2(sup_der[1] - sup_izq[1], sup_der[0] - sup_izq[0])))
+    return recortada, {
+        "crop_applied": True,
+        "crop_ratio": round(ancho * alto / (image.shape[0] * image.shape[1]), 3),
+        "crop_skew_deg": round(inclinacion, 1),
+    }
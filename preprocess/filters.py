@@ -2,21 +2,103 @@ import cv2
 import numpy as np
 
 
-def preprocesar_imagen(image_path: str, scale_factor: int = 2) -> np.ndarray:
+def cargar_imagen(fuente) -> np.ndarray:
+    """
+    Carga la imagen desde una ruta, desde bytes codificados (JPEG/PNG en memoria)
+    o la devuelve tal cual si ya es un ndarray.
+    """
+    if isinstance(fuente, np.ndarray):
+        return fuente
+    if isinstance(fuente, (bytes, bytearray, memoryview)):
+        return cv2.imdecode(np.frombuffer(fuente, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return cv2.imread(fuente)
+
+
+# --- Escalado adaptativo ---
+# Altura de letra (px) con la que mejor trabaja EasyOCR; es la que tiene una
+# foto típica de Telegram tras el antiguo escalado fijo x2
+ALTURA_TEXTO_OBJETIVO = 24
+# Ancho objetivo cuando no se puede estimar la altura del texto
+ANCHO_OBJETIVO = 1600
+ESCALA_MIN = 0.25
+ESCALA_MAX = 2.0
+# Ancho de la copia reducida usada para estimar la altura del texto
+ANCHO_ESTIMACION = 800
+
+
+def estimar_altura_texto(gray: np.ndarray):
+    """
+    Estima la altura dominante de las letras (en px de la imagen original)
+    con componentes conexas sobre una copia reducida. Devuelve None si no hay
+    suficientes componentes con forma de carácter.
+    """
+    height, width = gray.shape[:2]
+    reduccion = min(1.0, ANCHO_ESTIMACION / width)
+    small = gray
+    if reduccion < 1.0:
+        small = cv2.resize(gray, None, fx=reduccion, fy=reduccion, interpolation=cv2.INTER_AREA)
+
+    _, binaria = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    n, _, stats, _ = cv2.connectedComponentsWithStats(binaria, connectivity=8)
+    if n <= 1:
+        return None
+
+    alturas = stats[1:, cv2.CC_STAT_HEIGHT]
+    anchos = stats[1:, cv2.CC_STAT_WIDTH]
+    # Quedarse con componentes con forma de carácter (ni ruido ni bloques)
+    mascara = (alturas >= 4) & (alturas <= small.shape[0] * 0.1) & (anchos <= alturas * 3)
+    if mascara.sum() < 20:
+        return None
+
+    return float(np.median(alturas[mascara])) / reduccion
+
+
+def elegir_escala(gray: np.ndarray) -> float:
+    """Escala para que el texto quede cerca de ALTURA_TEXTO_OBJETIVO."""
+    altura = estimar_altura_texto(gray)
+    if altura:
+        escala = ALTURA_TEXTO_OBJETIVO / altura
+    else:
+        escala = ANCHO_OBJETIVO / gray.shape[1]
+
+    escala = min(max(escala, ESCALA_MIN), ESCALA_MAX)
+    # Evitar remuestreos que apenas cambian el tamaño
+    if abs(escala - 1.0) < 0.1:
+        return 1.0
+    return round(escala, 3)
+
+
+def preprocesar_imagen_con_escala(image_path, scale_factor=2):
+    """
+    Igual que preprocesar_imagen pero devuelve (imagen, escala aplicada).
+    scale_factor: factor fijo, o "auto" para elegirlo según la altura del texto
+                  (reduce fotos grandes y solo amplía las pequeñas).
+    La escala se necesita para interpretar las coordenadas de las cajas del OCR.
+    """
     try:
-        image = cv2.imread(image_path)
+        image = cargar_imagen(image_path)
         if image is None:
-            raise ValueError(f"No se pudo cargar la imagen: {image_path}")
+            descripcion = image_path if isinstance(image_path, str) else type(image_path).__name__
+            raise ValueError(f"No se pudo cargar la imagen: {descripcion}")
 
-        # Escalar primero si es necesario
-        if scale_factor > 1:
-            height, width = image.shape[:2]
-            new_width = width * scale_factor
-            new_height = height * scale_factor
-            image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_CUBIC)
+        if scale_factor == "auto":
+            # En gris primero: la estimación y el remuestreo van sobre un solo canal
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+            escala = elegir_escala(gray)
+            if escala != 1.0:
+                interpolacion = cv2.INTER_AREA if escala < 1 else cv2.INTER_CUBIC
+                gray = cv2.resize(gray, None, fx=escala, fy=escala, interpolation=interpolacion)
+        else:
+            escala = scale_factor if scale_factor > 1 else 1
+            # Escalar primero si es necesario
+            if scale_factor > 1:
+                height, width = image.shape[:2]
+                new_width = width * scale_factor
+                new_height = height * scale_factor
+                image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_CUBIC)
 
-        # Convertir a gris
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            # Convertir a gris
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
 
         # Mejorar contraste local con CLAHE
         clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
@@ -25,8 +107,27 @@ def preprocesar_imagen(image_path: str, scale_factor: int = 2) -> np.ndarray:
         # Suavizado ligero para reducir ruido sin perder bordes
         gray = cv2.GaussianBlur(gray, (3, 3), 0)
 
-        return gray
+        return gray, escala
 
     except Exception as e:
         print(f"Error en preprocesamiento: {e}")
-        return None
+        return None, None
+
+
+def preprocesar_imagen(image_path, scale_factor=2) -> np.ndarray:
+    """image_path: ruta, bytes de la imagen codificada o ndarray (BGR o gris)."""
+    gray, _ = preprocesar_imagen_con_escala(image_path, scale_factor)
+    return gray
+
+
+def variantes_relectura(recorte):
+    """
+    Versiones alternativas del recorte de una línea para volver a pasarle el
+    OCR cuando un campo sale con poca confianza, de la más barata a la más
+    agresiva: ampliado x2 y ampliado x3 binarizado con Otsu.
+    """
+    gray = cv2.cvtColor(recorte, cv2.COLOR_BGR2GRAY) if recorte.ndim == 3 else recorte
+    yield cv2.resize(gray, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+    ampliado = cv2.resize(gray, None, fx=3, fy=3, interpolation=cv2.INTER_CUBIC)
+    _, binarizado = cv2.threshold(ampliado, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    yield binarizado
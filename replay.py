@@ -0,0 +1,243 @@
+"""
+Repite los parsers sobre el texto OCR guardado en los logs, sin ejecutar el OCR.
+
+Lee los logs JSONL de logs/tickets/ocr (raw_text de cada ticket) línea a
+línea, reparte los tickets en lotes entre varios procesos y compara el nuevo
+resultado con el registrado en logs/tickets/processed, emparejando por
+ticket_id mientras recorre los dos logs a la vez. La altura y confianza de
+cada línea (line_geometry) se restauran para que el total salga igual que en
+el bot. Sirve para comprobar un cambio en los parsers contra miles de
+tickets reales en segundos.
+
+Uso:
+    python replay.py
+    python replay.py --logs-dir logs/tickets --workers 8 --output cambios.jsonl
+"""
+import argparse
+import glob
+import gzip
+import json
+import os
+import sys
+import time
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+CAMPOS = ["establecimiento", "cif", "fecha", "total", "iva", "divisa", "metodo_pago"]
+TAMANO_LOTE = 256
+# Lotes en vuelo por worker (el resto de tickets se sigue leyendo del disco bajo demanda)
+LOTES_POR_WORKER = 2
+# Resultados de logs/tickets/processed leídos por adelantado al buscar el de un ticket
+VENTANA_EMPAREJADO = 10000
+
+
+def leer_jsonl(patron, invalidas=None):
+    """
+    Recorre los registros de todos los ficheros que casan con el patrón, sin
+    cargarlos enteros. Los .gz (días anteriores con LOG_GZIP=1) se leen igual.
+    """
+    for ruta in sorted(glob.glob(patron)):
+        abrir = gzip.open if ruta.endswith(".gz") else open
+        with abrir(ruta, "rt", encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    yield json.loads(linea)
+                except json.JSONDecodeError:
+                    if invalidas is not None:
+                        invalidas[ruta] += 1
+
+
+def emparejar(registros, procesados, ventana=None):
+    """
+    Añade a cada registro de OCR el resultado registrado de su ticket (o None)
+    recorriendo los dos logs a la vez, sin cargar ninguno entero. Se escriben
+    en el mismo orden, así que casi siempre el siguiente procesado es el del
+    ticket; los que se adelantan quedan en un búfer de como mucho `ventana`
+    entradas (los procesados sin texto OCR, como las fotos en blanco, se
+    descartan al salir de él).
+    """
+    ventana = ventana or VENTANA_EMPAREJADO
+    procesados = iter(procesados)
+    bufer = OrderedDict()  # ticket_id -> resultado, leídos por adelantado
+    for registro in registros:
+        ticket_id = registro.get("ticket_id")
+        if ticket_id is None:
+            continue
+        while ticket_id not in bufer:
+            siguiente = next(procesados, None)
+            if siguiente is None:
+                break
+            if "ticket_id" not in siguiente:
+                continue
+            bufer[siguiente["ticket_id"]] = siguiente.get("result") or {}
+            if len(bufer) > ventana:
+                bufer.popitem(last=False)
+        yield registro, bufer.pop(ticket_id, None)
+
+
+def lotes(emparejados, tamano):
+    """Lotes de (ticket_id, raw_text, line_geometry o None, resultado registrado o None)."""
+    lote = []
+    for registro, anterior in emparejados:
+        if not isinstance(registro.get("raw_text"), list):
+            continue
+        lote.append((registro["ticket_id"], registro["raw_text"], registro.get("line_geometry"), anterior))
+        if len(lote) >= tamano:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+def _documento(lineas, geometria):
+    """ReceiptDocument con la altura y confianza registradas de cada línea, como en el bot."""
+    from utils.document import ReceiptDocument
+    from utils.ocr_structure import LineaOCR
+
+    if not geometria or len(geometria) != len(lineas):
+        # Logs anteriores a line_geometry: solo texto
+        return ReceiptDocument(lineas)
+    return ReceiptDocument(lineas, [
+        LineaOCR(texto, 0, 0, 0, g[0], g[1], []) if g else None
+        for texto, g in zip(lineas, geometria)
+    ])
+
+
+def _parsear_lote(lote):
+    """
+    Worker: ejecuta los parsers sobre un lote.
+    Devuelve ([(ticket_id, nuevo, anterior)], segundos por parser).
+    """
+    from pipeline import parsear
+    from utils.timing import StageTimer
+
+    tiempos = StageTimer()
+    resultados = []
+    for ticket_id, lineas, geometria, anterior in lote:
+        resultado = parsear(_documento(lineas, geometria), tiempos)
+        # Mismo formato que el log (floats y strings tal cual salen de json)
+        resultados.append((ticket_id, json.loads(json.dumps(resultado, ensure_ascii=False)), anterior))
+    return resultados, tiempos.etapas
+
+
+class Comparacion:
+    def __init__(self, ejemplos=10, salida=None):
+        self.ejemplos = ejemplos
+        self.salida = salida
+        self.tickets = 0
+        self.sin_referencia = 0
+        self.con_cambios = 0
+        self.cambios = Counter()   # campo -> tickets con ese campo distinto
+        self.ganados = Counter()   # campo -> antes None, ahora con valor
+        self.perdidos = Counter()  # campo -> antes con valor, ahora None
+        self.muestras = []
+
+    def registrar(self, ticket_id, nuevo, anterior):
+        self.tickets += 1
+        if anterior is None:
+            self.sin_referencia += 1
+            return
+        diferencias = {}
+        for campo in CAMPOS:
+            antes, ahora = anterior.get(campo), nuevo.get(campo)
+            if antes == ahora:
+                continue
+            diferencias[campo] = {"old": antes, "new": ahora}
+            self.cambios[campo] += 1
+            if antes is None:
+                self.ganados[campo] += 1
+            elif ahora is None:
+                self.perdidos[campo] += 1
+        if not diferencias:
+            return
+        self.con_cambios += 1
+        if len(self.muestras) < self.ejemplos:
+            self.muestras.append((ticket_id, diferencias))
+        if self.salida:
+            self.salida.write(json.dumps({"ticket_id": ticket_id, "changes": diferencias}, ensure_ascii=False) + "\n")
+
+    def informe(self):
+        comparados = self.tickets - self.sin_referencia
+        lineas = [
+            f"Tickets: {self.tickets} ({comparados} con resultado registrado, "
+            f"{self.sin_referencia} sin él) · con cambios: {self.con_cambios}"
+        ]
+        if self.cambios:
+            lineas.append(f"{'campo':<18}{'cambios':>9}{'ganados':>9}{'perdidos':>9}")
+            for campo in CAMPOS:
+                if self.cambios[campo]:
+                    lineas.append(f"{campo:<18}{self.cambios[campo]:>9}"
+                                  f"{self.ganados[campo]:>9}{self.perdidos[campo]:>9}")
+        for ticket_id, diferencias in self.muestras:
+            detalle = ", ".join(f"{c}: {d['old']!r} -> {d['new']!r}" for c, d in diferencias.items())
+            lineas.append(f"  {ticket_id}  {detalle}")
+        return "\n".join(lineas)
+
+
+def ejecutar(args):
+    invalidas = defaultdict(int)
+    registros = leer_jsonl(args.ocr or os.path.join(args.logs_dir, "ocr", "ocr_*.log*"), invalidas)
+    procesados = leer_jsonl(args.processed or os.path.join(args.logs_dir, "processed", "processed_*.log*"))
+
+    salida = open(args.output, "w", encoding="utf-8") if args.output else None
+    comparacion = Comparacion(ejemplos=args.examples, salida=salida)
+    etapas = defaultdict(float)
+
+    workers = args.workers or os.cpu_count() or 1
+    inicio = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pendientes = set()
+
+            def recoger(terminados):
+                for future in terminados:
+                    pendientes.discard(future)
+                    resultados, segundos = future.result()
+                    for ticket_id, nuevo, anterior in resultados:
+                        comparacion.registrar(ticket_id, nuevo, anterior)
+                    for etapa, s in segundos.items():
+                        etapas[etapa] += s
+
+            for lote in lotes(emparejar(registros, procesados, args.match_window), args.chunk):
+                if len(pendientes) >= workers * LOTES_POR_WORKER:
+                    terminados, _ = wait(pendientes, return_when=FIRST_COMPLETED)
+                    recoger(terminados)
+                pendientes.add(executor.submit(_parsear_lote, lote))
+            while pendientes:
+                terminados, _ = wait(pendientes, return_when=FIRST_COMPLETED)
+                recoger(terminados)
+    finally:
+        if salida:
+            salida.close()
+    duracion = time.perf_counter() - inicio
+
+    print(comparacion.informe())
+    n = comparacion.tickets
+    print(f"\nThroughput: {n / max(duracion, 1e-9):.0f} tickets/s con {workers} procesos ({duracion:.2f} s)")
+    if n:
+        print(f"{'parser':<24}{'ms/ticket':>10}")
+        for etapa, s in sorted(etapas.items(), key=lambda e: -e[1]):
+            print(f"{etapa:<24}{s * 1000 / n:>10.3f}")
+    for ruta, cuenta in invalidas.items():
+        print(f"Aviso: {cuenta} líneas no válidas en {ruta}", file=sys.stderr)
+    return comparacion
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Repite los parsers sobre los logs de OCR y compara resultados")
+    parser.add_argument("--logs-dir", default=os.path.join("logs", "tickets"))
+    parser.add_argument("--ocr", help="patrón glob de los logs de OCR (por defecto <logs-dir>/ocr/ocr_*.log*)")
+    parser.add_argument("--processed", help="patrón glob de los logs de resultados "
+                                            "(por defecto <logs-dir>/processed/processed_*.log*)")
+    parser.add_argument("--workers", type=int, default=0, help="procesos (0 = número de CPUs)")
+    parser.add_argument("--chunk", type=int, default=TAMANO_LOTE, help="tickets por lote enviado a cada proceso")
+    parser.add_argument("--match-window", type=int, default=VENTANA_EMPAREJADO,
+                        help="resultados leídos por adelantado al emparejar los dos logs")
+    parser.add_argument("--examples", type=int, default=10, help="ejemplos de cambios a mostrar")
+    parser.add_argument("--output", help="guardar todos los cambios en un JSONL")
+    args = parser.parse_args()
+    ejecutar(args)
+
+
+if __name__ == "__main__":
+    main()
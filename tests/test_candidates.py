@@ -0,0 +1,101 @@
+import json
+import os
+import re
+
+import pytest
+
+from utils.candidates import PATRON_CIF, PATRONES_NUMERICOS, PATRON_FECHA_TEXTO
+from utils.document import ReceiptDocument
+
+LINEAS = [
+    "MERCADONA S.A.",
+    "CIF: A-46103834  NIF 12345678Z",
+    "FECHA 12/03/2024 18:22",
+    "LECHE 1,15 PAN 0 ,60",
+    "TOTAL 16 ,50",
+    "IVA 21% BASE 10,00 2,10 12,10",
+    "2024-03-12 05 MAR 24",
+    "TOTAL",
+    "7,25",
+    "IVA 10",
+    "% INCLUIDO",
+]
+
+with open(os.path.join(os.path.dirname(__file__), "fixtures", "tickets.json"), encoding="utf-8") as f:
+    CONJUNTOS = {"lineas": LINEAS, **{nombre: t["lineas"] for nombre, t in json.load(f).items()}}
+
+
+# --- Lo que hacían los parsers originales, patrón a patrón ---
+def _importes_linea(linea):
+    texto = re.sub(r'(\d+)\s+(\d{1,2})', r'\1.\2', linea.replace(",", "."))
+    return re.findall(r'\d+\.\d{1,2}', texto)
+
+
+def _cifs_linea(linea):
+    return re.findall(PATRON_CIF, "".join(c for c in linea.upper() if c.isalnum()))
+
+
+def _grupos(m):
+    return m.group("d", "m", "y") if m.re.groupindex else m.groups()
+
+
+def _en_texto(patron, texto, flags=0):
+    return [(m.start(), _grupos(m)) for m in re.finditer(patron, texto, flags)]
+
+
+@pytest.mark.parametrize("nombre", sorted(CONJUNTOS))
+def test_tabla_igual_que_los_patrones_originales(nombre):
+    lineas = CONJUNTOS[nombre]
+    doc = ReceiptDocument(lineas)
+    tabla = doc.candidatos
+
+    assert [[c.valor for c in fila] for fila in tabla.importes] == [_importes_linea(l) for l in lineas]
+    assert [[c.valor for c in fila] for fila in tabla.cifs] == [_cifs_linea(l) for l in lineas]
+
+    texto = " ".join(lineas)
+    assert [(c.inicio, c.grupos) for c in tabla.porcentajes] == _en_texto(r'(\d+[.,]?\d*)\s*[%％]', texto)
+    assert [(c.inicio, c.grupos) for c in tabla.fechas_texto] == _en_texto(PATRON_FECHA_TEXTO, texto, re.IGNORECASE)
+    for candidatos, patron in zip(tabla.fechas_numericas, PATRONES_NUMERICOS):
+        assert [(c.inicio, c.grupos) for c in candidatos] == _en_texto(patron, texto)
+
+    # Cada candidato del texto unido apunta a la línea en la que empieza
+    for c in tabla.porcentajes + tabla.fechas_texto:
+        inicio = tabla.offsets[c.linea]
+        assert inicio <= c.inicio <= inicio + len(lineas[c.linea])
+
+    # Buscar en una línea con la tabla es como ejecutar el patrón sobre la línea sola
+    for idx, linea in enumerate(lineas):
+        assert [c.valor for c in tabla.porcentajes_en_linea(idx)] == re.findall(r'(\d+[.,]?\d*)\s*[%％]', linea)
+
+
+def test_valores_de_ejemplo():
+    tabla = ReceiptDocument(LINEAS).candidatos
+    assert [c.valor for c in tabla.importes[5]] == ["10.00", "2.10", "12.10"]
+    # "A-46103834" se encuentra sin el guion
+    assert tabla.cifs[1][0].valor == "A46103834"
+    assert [(c.linea, c.valor) for c in tabla.porcentajes] == [(5, "21"), (9, "10")]
+    # Los grupos de las fechas se guardan siempre como (día, mes, año)
+    assert (6, ("12", "03", "2024")) in [(c.linea, c.grupos) for c in tabla.fechas_numericas[1]]
+    # El patrón de mes en texto es permisivo; parse_fecha descarta lo que no es un mes
+    assert (6, ("05", "MAR", "24")) in [(c.linea, c.grupos) for c in tabla.fechas_texto]
+    assert tabla.numeros[5] == ["21", "10,00", "2,10", "12,10"]
+
+
+def test_porcentaje_partido_entre_lineas():
+    tabla = ReceiptDocument(LINEAS).candidatos
+    # "IVA 10" + "% INCLUIDO" es un porcentaje en el texto unido, pero en
+    # ninguna de las dos líneas por separado
+    assert tabla.porcentajes[-1].linea == 9
+    assert tabla.porcentajes_en_linea(9) == []
+    assert tabla.porcentajes_en_linea(10) == []
+
+
+def test_importes_con_siguiente_une_numeros_partidos():
+    tabla = ReceiptDocument(["TOTAL 12", "50 EUR", "IVA"]).candidatos
+    assert tabla.importes_con_siguiente(0) == _importes_linea("TOTAL 12 50 EUR") == ["12.50"]
+    assert tabla.importes_con_siguiente(1) == []
+
+    tabla = ReceiptDocument(LINEAS).candidatos
+    assert tabla.importes_con_siguiente(7) == ["7.25"]
+    for idx in range(len(LINEAS) - 1):
+        assert tabla.importes_con_siguiente(idx) == _importes_linea(LINEAS[idx] + " " + LINEAS[idx + 1])
@@ -0,0 +1,62 @@
+import random
+
+import numpy as np
+import pytest
+from rapidfuzz import fuzz
+
+from parsers.payment import TARJETA_VARIANTES
+from utils.keywords import KeywordMatcher
+
+PALABRAS = ["TOTAL", "EFECTIVO", "VISA", "IVA"]
+
+
+def _referencia(lineas, palabras, umbral):
+    """Cada palabra puntuada contra la línea entera con partial_ratio."""
+    return np.array([[bool(linea) and fuzz.partial_ratio(p, linea) >= umbral for p in palabras] for linea in lineas],
+                    dtype=bool).reshape(len(lineas), len(palabras))
+
+
+def test_coincidencia_exacta_sin_puntuacion_difusa(monkeypatch):
+    matcher = KeywordMatcher(PALABRAS)
+
+    def no_llamar(lineas):
+        raise AssertionError(f"puntuación difusa con {lineas}")
+
+    monkeypatch.setattr(matcher, "puntuaciones", no_llamar)
+    assert matcher.lineas_con_coincidencia(["TOTAL 12,10", "PAGO CON VISA", ""]).tolist() == [True, True, False]
+
+
+def test_coincidencia_difusa_con_errores_de_ocr():
+    matcher = KeywordMatcher(PALABRAS)
+    lineas = ["T0TAL 8,45", "EFECTIV0", "V1SA ****1234", "GRACIAS POR SU VISITA", "12345"]
+    # "V1SA" es VISA con un error de OCR; "VISITA" contiene "VISA" con una letra de más
+    assert matcher.lineas_con_coincidencia(lineas).tolist() == [True, True, True, True, False]
+
+
+def test_umbral_alto_para_tarjetas():
+    matcher = KeywordMatcher(TARJETA_VARIANTES, umbral=90)
+    coincidencias = matcher.coincidencias(["PAGO MASTERCRD", "MAESTRO", "CARD", "EFECTIVO"])
+    assert coincidencias.shape == (4, len(TARJETA_VARIANTES))
+    assert [TARJETA_VARIANTES[i] for i in coincidencias[1].nonzero()[0]] == ["MAESTRO"]
+    # partial_ratio compara la más corta con trozos de la más larga: "CARD" está en "MASTERCARD"
+    assert [TARJETA_VARIANTES[i] for i in coincidencias[2].nonzero()[0]] == ["MASTERCARD"]
+    assert not coincidencias[3].any()
+
+
+def test_sin_lineas():
+    matcher = KeywordMatcher(PALABRAS)
+    assert matcher.coincidencias([]).shape == (0, len(PALABRAS))
+    assert matcher.lineas_con_coincidencia([]).tolist() == []
+
+
+@pytest.mark.parametrize("umbral", [70, 75, 90])
+def test_igual_que_puntuar_cada_palabra(umbral):
+    rnd = random.Random(umbral)
+    alfabeto = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 ,.%€$"
+    lineas = ["".join(rnd.choice(alfabeto) for _ in range(rnd.randint(0, 30))) for _ in range(200)]
+    lineas += ["TOTAL A PAGAR", "EFECTIVO 20,00", "IVA 21%", "VISA", "TOTA", "EFECTVO"]
+    matcher = KeywordMatcher(PALABRAS, umbral=umbral)
+
+    referencia = _referencia(lineas, PALABRAS, umbral)
+    assert (matcher.coincidencias(lineas) == referencia).all()
+    assert matcher.lineas_con_coincidencia(lineas).tolist() == referencia.any(axis=1).tolist()
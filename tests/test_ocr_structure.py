@@ -0,0 +1,86 @@
+import random
+
+import pytest
+
+from utils.ocr_structure import construir_lineas
+
+
+def _construir_lineas_original(ocr_result, y_threshold=12):
+    """La versión con dicts anterior a NumPy, como referencia."""
+    palabras = []
+    for (bbox, text, prob) in ocr_result:
+        xs = [p[0] for p in bbox]
+        ys = [p[1] for p in bbox]
+        palabras.append({"text": text, "x": min(xs), "y": min(ys)})
+
+    palabras.sort(key=lambda p: (p["y"], p["x"]))
+
+    lineas = []
+    linea_actual = []
+    last_y = None
+    for p in palabras:
+        if last_y is None:
+            linea_actual.append(p)
+            last_y = p["y"]
+            continue
+        if abs(p["y"] - last_y) <= y_threshold:
+            linea_actual.append(p)
+        else:
+            lineas.append(sorted(linea_actual, key=lambda p: p["x"]))
+            linea_actual = [p]
+        last_y = p["y"]
+    if linea_actual:
+        lineas.append(sorted(linea_actual, key=lambda p: p["x"]))
+
+    return [" ".join(p["text"] for p in linea) for linea in lineas]
+
+
+def _caja(x, y, w, h):
+    return [[x, y], [x + w, y], [x + w, y + h], [x, y + h]]
+
+
+def _cajas_aleatorias(rnd):
+    """Palabras en renglones con algo de ruido vertical, a veces con empates en x o y."""
+    resultado = []
+    y = rnd.randint(0, 20)
+    for renglon in range(rnd.randint(1, 25)):
+        y += rnd.randint(5, 40)
+        for palabra in range(rnd.randint(1, 6)):
+            x = rnd.choice([rnd.randint(0, 600), 100])
+            resultado.append((_caja(x, y + rnd.randint(-6, 6), rnd.randint(10, 80), rnd.randint(12, 30)),
+                              f"r{renglon}p{palabra}", rnd.random()))
+    rnd.shuffle(resultado)
+    return resultado
+
+
+@pytest.mark.parametrize("semilla", range(300))
+def test_agrupa_igual_que_la_version_original(semilla):
+    ocr_result = _cajas_aleatorias(random.Random(semilla))
+    textos, lineas = construir_lineas(ocr_result, y_threshold=12)
+    assert textos == _construir_lineas_original(ocr_result, y_threshold=12)
+    assert [linea.texto for linea in lineas] == textos
+
+
+def test_geometria_y_confianza_por_linea():
+    ocr_result = [
+        (_caja(200, 52, 60, 20), "12,10", 0.5),
+        (_caja(10, 50, 80, 24), "TOTAL", 0.9),
+        (_caja(10, 10, 100, 30), "MERCADONA", 1.0),
+    ]
+    textos, lineas = construir_lineas(ocr_result, y_threshold=12)
+    assert textos == ["MERCADONA", "TOTAL 12,10"]
+    total = lineas[1]
+    assert (total.x, total.y, total.w, total.h) == (10, 50, 250, 24)
+    assert total.conf == pytest.approx(0.7)
+    assert total.palabras == 2
+
+
+def test_umbral_por_defecto_con_la_altura_mediana():
+    # Texto de 40 px: 14 px de diferencia es la misma línea (umbral 20), no con 12 fijos
+    ocr_result = [(_caja(10, 100, 50, 40), "TOTAL", 0.9), (_caja(80, 114, 50, 40), "9,99", 0.9)]
+    assert construir_lineas(ocr_result)[0] == ["TOTAL 9,99"]
+    assert construir_lineas(ocr_result, y_threshold=12)[0] == ["TOTAL", "9,99"]
+
+
+def test_sin_cajas():
+    assert construir_lineas([]) == ([], [])
@@ -0,0 +1,53 @@
+import asyncio
+
+# Telegram no admite más de 10 fotos por álbum
+MAX_FOTOS_ALBUM = 10
+
+
+class AlbumCollector:
+    """
+    Junta las fotos de un álbum de Telegram. Telegram entrega cada foto del
+    álbum como un mensaje suelto (con el mismo media_group_id), casi a la vez.
+
+    Cada foto nueva reinicia una espera de `ventana` segundos; cuando pasa
+    sin fotos nuevas, o al llegar a max_fotos, se llama a
+    `await al_completar(clave, elementos)` con todas las del álbum en orden
+    de llegada. El handler que añade la foto vuelve enseguida.
+    """
+
+    def __init__(self, al_completar, ventana=1.5, max_fotos=MAX_FOTOS_ALBUM):
+        self.al_completar = al_completar
+        self.ventana = ventana
+        self.max_fotos = max_fotos
+        self._albumes = {}  # clave -> (elementos, temporizador)
+        self._tareas = set()
+
+    def __len__(self):
+        return len(self._albumes)
+
+    def agregar(self, clave, elemento):
+        """Añade una foto al álbum `clave` (p.ej. (chat_id, media_group_id))."""
+        elementos, temporizador = self._albumes.get(clave, ([], None))
+        if temporizador is not None:
+            temporizador.cancel()
+        elementos.append(elemento)
+        if len(elementos) >= self.max_fotos:
+            self._albumes[clave] = (elementos, None)
+            self._completar(clave)
+            return
+        temporizador = asyncio.get_running_loop().call_later(self.ventana, self._completar, clave)
+        self._albumes[clave] = (elementos, temporizador)
+
+    def _completar(self, clave):
+        elementos, _ = self._albumes.pop(clave)
+        tarea = asyncio.create_task(self.al_completar(clave, elementos))
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+
+    async def cerrar(self):
+        """Descarta los álbumes a medio juntar y espera a los que ya se están entregando."""
+        for _, temporizador in self._albumes.values():
+            if temporizador is not None:
+                temporizador.cancel()
+        self._albumes.clear()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
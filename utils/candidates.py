@@ -0,0 +1,172 @@
+import re
+from bisect import bisect_right
+
+# --- Patrones precompilados (compartidos con los parsers) ---
+
+# CIF oficial: letra inicial válida + 7 dígitos + letra/dígito final válido
+PATRON_CIF = r"[A-HJ-NP-SUVW]\d{7}[0-9A-J]"
+
+PATRONES_NUMERICOS = [
+    r"(?P<d>\d{1,2})[./\-]\s*(?P<m>\d{1,2})[./\-]\s*(?P<y>\d{2,4})",
+    r"(?P<y>\d{4})[./\-]\s*(?P<m>\d{1,2})[./\-]\s*(?P<d>\d{1,2})",
+]
+PATRON_FECHA_TEXTO = r"(\d{1,2})\s*[./\-]?\s*([a-záéíóúñ]{3,})\s*[./\-]?\s*(\d{2,4})"
+
+RE_CIF = re.compile(PATRON_CIF)
+RE_FECHAS_NUMERICAS = [re.compile(p) for p in PATRONES_NUMERICOS]
+RE_FECHA_TEXTO = re.compile(PATRON_FECHA_TEXTO, re.IGNORECASE)
+RE_PORCENTAJE = re.compile(r'(\d+[.,]?\d*)\s*[%％]')
+
+# Importes: "16 ,50" -> "16.50", "10 60" -> "10.60"
+RE_IMPORTE_SEPARADO = re.compile(r'(\d+)\s+(\d{1,2})')
+RE_IMPORTE = re.compile(r'\d+\.\d{1,2}')
+RE_FIN_CON_DIGITO = re.compile(r'\d\s*$')
+RE_INICIO_CON_DIGITO = re.compile(r'\s*\d')
+
+# Números sueltos para el análisis de estructura de precios del IVA
+RE_NO_NUMERICO = re.compile(r'[^\d\s.,]')
+RE_NUMERO = re.compile(r'(\d+[.,]?\d*[.,]?\d*)')
+
+
+def normalizar_importes(texto):
+    return RE_IMPORTE_SEPARADO.sub(r'\1.\2', texto.replace(",", "."))
+
+
+def _grupos(m):
+    # Las fechas numéricas usan grupos con nombre; se guardan siempre como (d, m, y)
+    if m.re.groupindex:
+        return m.group("d", "m", "y")
+    return m.groups()
+
+
+class Candidate:
+    """
+    Coincidencia tipada: línea, posición (inicio, fin) y grupos capturados.
+    La posición es relativa al texto en el que se buscó: el texto unido para
+    porcentajes y fechas, la línea normalizada para importes y la vista
+    alfanumérica de la línea para CIFs.
+    """
+    __slots__ = ("linea", "inicio", "fin", "grupos")
+
+    def __init__(self, linea, inicio, fin, grupos):
+        self.linea = linea
+        self.inicio = inicio
+        self.fin = fin
+        self.grupos = grupos
+
+    @property
+    def valor(self):
+        return self.grupos[0] if self.grupos else None
+
+
+class Origen:
+    """
+    Línea de la que un parser ha sacado el valor de un campo (None si el
+    valor no sale de ninguna, p.ej. una divisa por defecto) y si la evidencia
+    es concluyente (CIF con dígito de control válido, total en una línea
+    con TOTAL...). Lo usa parsers.confidence para puntuar cada campo.
+    """
+    __slots__ = ("linea", "concluyente")
+
+    def __init__(self, linea, concluyente):
+        self.linea = linea
+        self.concluyente = concluyente
+
+    def __repr__(self):
+        return f"Origen(linea={self.linea}, concluyente={self.concluyente})"
+
+
+def anotar_origen(origenes, campo, linea, concluyente):
+    """Guarda el Origen del campo si quien llama al parser pasó un dict `origenes`."""
+    if origenes is not None:
+        origenes[campo] = Origen(linea, concluyente)
+
+
+class CandidateTable:
+    """
+    Una sola pasada de extracción sobre el texto de un ticket.
+
+    Por línea:
+      importes[i]   importes normalizados ("12.50") en el orden del texto
+      cifs[i]       tokens con forma de CIF sobre la vista alfanumérica
+      numeros[i]    números sueltos como strings (estructura de precios del IVA)
+    Sobre el texto unido (doc.texto), con la línea donde empieza cada uno:
+      porcentajes, fechas_texto, fechas_numericas[k]
+    Las fechas guardan sus grupos como (día, mes, año), con el mes en texto
+    o numérico según el patrón.
+
+    Los patrones del texto unido se ejecutan sobre todo el ticket, igual que
+    antes, para no perder coincidencias partidas entre dos líneas. Los parsers
+    solo seleccionan y puntúan candidatos de esta tabla.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+
+        # Offsets de cada línea dentro de doc.texto (unido con " ")
+        self.offsets = []
+        pos = 0
+        for linea in doc.raw:
+            self.offsets.append(pos)
+            pos += len(linea) + 1
+
+        self.normalizados = []
+        self.importes = []
+        self.numeros = []
+        for idx, linea in enumerate(doc.raw):
+            normalizado = normalizar_importes(linea)
+            self.normalizados.append(normalizado)
+            self.importes.append(self._extraer_linea(RE_IMPORTE, normalizado, idx))
+            self.numeros.append(RE_NUMERO.findall(RE_NO_NUMERICO.sub(' ', linea)))
+        self.cifs = [self._extraer_linea(RE_CIF, limpio, idx) for idx, limpio in enumerate(doc.alnum)]
+
+        texto = doc.texto
+        self.porcentajes = self._extraer(RE_PORCENTAJE, texto)
+        self.fechas_texto = self._extraer(RE_FECHA_TEXTO, texto)
+        self.fechas_numericas = [self._extraer(p, texto) for p in RE_FECHAS_NUMERICAS]
+
+    @staticmethod
+    def _extraer_linea(patron, texto, idx):
+        return [Candidate(idx, m.start(), m.end(), (m.group(),)) for m in patron.finditer(texto)]
+
+    def _extraer(self, patron, texto):
+        return [
+            Candidate(bisect_right(self.offsets, m.start()) - 1, m.start(), m.end(), _grupos(m))
+            for m in patron.finditer(texto)
+        ]
+
+    # --- Consultas ---
+    def importes_con_siguiente(self, idx):
+        """
+        Importes de la línea idx unida a la siguiente (el número puede estar
+        partido entre ambas), como strings en el orden del texto combinado.
+        """
+        if idx + 1 >= len(self.importes):
+            return [c.valor for c in self.importes[idx]]
+        # Solo si la unión puede juntar "12" + "50" hay que normalizar el texto combinado
+        if RE_FIN_CON_DIGITO.search(self.normalizados[idx]) and RE_INICIO_CON_DIGITO.match(self.doc.raw[idx + 1]):
+            combinado = self.doc.raw[idx] + " " + self.doc.raw[idx + 1]
+            return RE_IMPORTE.findall(normalizar_importes(combinado))
+        return [c.valor for c in self.importes[idx] + self.importes[idx + 1]]
+
+    def en_linea(self, candidatos, idx, patron):
+        """
+        Candidatos contenidos en la línea idx, como si el patrón se hubiera
+        ejecutado solo sobre esa línea. Si algún candidato cruza el borde de
+        la línea se vuelve a buscar en la línea sola para no cambiar el resultado.
+        """
+        inicio = self.offsets[idx]
+        fin = inicio + len(self.doc.raw[idx])
+        dentro = []
+        for c in candidatos:
+            if c.fin <= inicio or c.inicio >= fin:
+                continue
+            if c.inicio < inicio or c.fin > fin:
+                linea = self.doc.raw[idx]
+                return [Candidate(idx, inicio + m.start(), inicio + m.end(), _grupos(m))
+                        for m in patron.finditer(linea)]
+            dentro.append(c)
+        return dentro
+
+    def porcentajes_en_linea(self, idx):
+        return self.en_linea(self.porcentajes, idx, RE_PORCENTAJE)
@@ -0,0 +1,94 @@
+import unicodedata
+from functools import cached_property
+
+from utils.candidates import CandidateTable
+
+
+def plegar_acentos(texto):
+    """'CAFÉ Ñ' -> 'CAFE N'"""
+    descompuesto = unicodedata.normalize("NFKD", texto)
+    return "".join(c for c in descompuesto if not unicodedata.combining(c))
+
+
+class ReceiptDocument:
+    """
+    Texto de un ticket normalizado una sola vez y compartido por todos los parsers.
+
+    raw: líneas tal cual salen del OCR
+    upper: líneas en mayúsculas
+    geometria: por línea, el LineaOCR de construir_lineas (x, y, w, h, conf)
+               o None si no se conoce
+
+    El resto de vistas (texto unido, sin acentos, solo alfanumérico, tokens,
+    dígitos por línea, tabla de candidatos) se calculan la primera vez que algún
+    parser las pide.
+    """
+
+    def __init__(self, lineas, geometria=None):
+        """
+        lineas: lista de strings (todas_las_lineas)
+        geometria: opcional, los LineaOCR de cada línea devueltos por construir_lineas
+        """
+        self.raw = [str(linea) for linea in lineas]
+        self.upper = [linea.upper() for linea in self.raw]
+        self.geometria = list(geometria) if geometria else [None] * len(self.raw)
+
+    @classmethod
+    def desde(cls, lineas):
+        """Acepta un ReceiptDocument o una lista de líneas (API antigua de los parsers)."""
+        if isinstance(lineas, cls):
+            return lineas
+        return cls(lineas)
+
+    def __len__(self):
+        return len(self.raw)
+
+    @cached_property
+    def texto(self):
+        return " ".join(self.raw)
+
+    @cached_property
+    def texto_upper(self):
+        return " ".join(self.upper)
+
+    @cached_property
+    def plegado(self):
+        """Mayúsculas sin acentos."""
+        return [plegar_acentos(linea) for linea in self.upper]
+
+    @cached_property
+    def alnum(self):
+        """Mayúsculas solo con caracteres alfanuméricos (sin espacios ni signos)."""
+        return ["".join(c for c in linea if c.isalnum()) for linea in self.upper]
+
+    @cached_property
+    def tokens(self):
+        return [linea.split() for linea in self.upper]
+
+    @cached_property
+    def digitos(self):
+        return [sum(c.isdigit() for c in linea) for linea in self.raw]
+
+    @cached_property
+    def alturas(self):
+        """Altura del texto de cada línea en px (0 si no hay geometría)."""
+        return [g.h if g else 0 for g in self.geometria]
+
+    @cached_property
+    def alturas_relativas(self):
+        """
+        Altura de cada línea respecto a la mediana, en pasos de 0.5 (1.0 = texto
+        normal, 1.5 = claramente más grande). Así un píxel de diferencia entre
+        cajas no cuenta como texto más grande. 0 si no hay geometría.
+        """
+        medidas = sorted(h for h in self.alturas if h)
+        if not medidas:
+            return [0] * len(self.raw)
+        mediana = medidas[len(medidas) // 2]
+        return [round(h / mediana * 2) / 2 if h else 0 for h in self.alturas]
+
+    @cached_property
+    def candidatos(self):
+        """Importes, fechas, porcentajes y CIFs extraídos en una sola pasada."""
+        return CandidateTable(self)
+
@@ -0,0 +1,301 @@
+import asyncio
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+# Filas por lectura al exportar (nunca se carga el historial completo)
+FILAS_POR_BLOQUE = 500
+COLUMNAS_EXPORTACION = ["ticket_id", "fecha", "establecimiento", "cif", "total", "iva",
+                        "divisa", "metodo_pago", "creado"]
+# Reintentos de un lote que falla (p.ej. base de datos bloqueada), con espera creciente
+REINTENTOS_LOTE = 3
+ESPERA_REINTENTO = 1.0
+# Espera máxima de una consulta a que se apliquen las escrituras anteriores
+ESPERA_SINCRONIZAR = 5.0
+
+ESQUEMA = [
+    """CREATE TABLE IF NOT EXISTS tickets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ticket_id TEXT NOT NULL UNIQUE,
+        user_id INTEGER NOT NULL,
+        creado TEXT NOT NULL,
+        fecha TEXT NOT NULL,
+        fecha_texto TEXT,
+        establecimiento TEXT,
+        cif TEXT,
+        total REAL,
+        iva REAL,
+        divisa TEXT,
+        metodo_pago TEXT,
+        resultado TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_tickets_user_fecha ON tickets (user_id, fecha)",
+    "CREATE INDEX IF NOT EXISTS idx_tickets_cif ON tickets (cif)",
+    "CREATE INDEX IF NOT EXISTS idx_tickets_establecimiento ON tickets (establecimiento)",
+    """CREATE TABLE IF NOT EXISTS correcciones (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ticket_id TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        campo TEXT NOT NULL,
+        valor TEXT,
+        creado TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_correcciones_ticket ON correcciones (ticket_id)",
+]
+
+SQL_INSERTAR = (
+    "INSERT OR IGNORE INTO tickets (ticket_id, user_id, creado, fecha, fecha_texto, establecimiento,"
+    " cif, total, iva, divisa, metodo_pago, resultado)"
+    " VALUES (:ticket_id, :user_id, :creado, :fecha, :fecha_texto, :establecimiento,"
+    " :cif, :total, :iva, :divisa, :metodo_pago, :resultado)"
+)
+# La fecha de envío (creado) se mantiene como respaldo si la corrección no es una fecha válida
+SQL_CORREGIR = (
+    "UPDATE tickets SET fecha = COALESCE(:fecha_corregida, substr(creado, 1, 10)), fecha_texto = :fecha_texto,"
+    " establecimiento = :establecimiento, cif = :cif, total = :total, iva = :iva, divisa = :divisa,"
+    " metodo_pago = :metodo_pago, resultado = :resultado"
+    " WHERE ticket_id = :ticket_id AND user_id = :user_id"
+)
+SQL_CORRECCION = (
+    "INSERT INTO correcciones (ticket_id, user_id, campo, valor, creado)"
+    " VALUES (:ticket_id, :user_id, :campo, :valor, :creado)"
+)
+
+
+def _fecha_iso(texto):
+    """'05/03/2025' (formato de parse_fecha) -> '2025-03-05'; None si no es una fecha."""
+    if not texto:
+        return None
+    for formato in ("%d/%m/%Y", "%d-%m-%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(str(texto).strip(), formato).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+
+def _numero(valor):
+    if valor is None:
+        return None
+    try:
+        return float(str(valor).replace(",", "."))
+    except ValueError:
+        return None
+
+
+def _columnas(resultado):
+    """Columnas indexables de un resultado (el JSON completo, sin la geometría de las líneas, se guarda aparte)."""
+    return {
+        "fecha_texto": resultado.get("fecha"),
+        "establecimiento": resultado.get("establecimiento"),
+        "cif": resultado.get("cif"),
+        "total": _numero(resultado.get("total")),
+        "iva": _numero(resultado.get("iva")),
+        "divisa": resultado.get("divisa"),
+        "metodo_pago": resultado.get("metodo_pago"),
+        "resultado": json.dumps({c: v for c, v in resultado.items() if c != "geometria"}, ensure_ascii=False),
+    }
+
+
+def _resolver(marca):
+    # La marca puede estar cancelada si sincronizar dejó de esperar
+    if not marca.done():
+        marca.set_result(None)
+
+
+class TicketHistory:
+    """
+    Historial de tickets en SQLite (modo WAL) para /historial, /resumen y /exportar.
+
+    Las escrituras (tickets nuevos y correcciones de /editar) se encolan y un
+    hilo escritor las aplica por lotes: todo lo que haya en la cola va en una
+    sola transacción. Las consultas usan conexiones de solo lectura en hilos
+    aparte, que en WAL no se bloquean con el escritor.
+
+    `fecha` es la fecha del ticket en ISO (YYYY-MM-DD) o, si no se detectó, la
+    de envío, para que (user_id, fecha) sirva para todas las consultas por periodo.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._cola = queue.Queue()
+        self._hilo = None
+
+    # --- Ciclo de vida ---
+    def iniciar(self):
+        conexion = sqlite3.connect(self.ruta)
+        try:
+            conexion.execute("PRAGMA journal_mode=WAL")
+            for sentencia in ESQUEMA:
+                conexion.execute(sentencia)
+            conexion.commit()
+        finally:
+            conexion.close()
+        self._hilo = threading.Thread(target=self._escritor, name="ticket-history", daemon=True)
+        self._hilo.start()
+
+    async def cerrar(self):
+        """Aplica lo pendiente y para el hilo escritor."""
+        if self._hilo is None:
+            return
+        self._cola.put(None)
+        await asyncio.to_thread(self._hilo.join)
+        self._hilo = None
+
+    # --- Escrituras (no bloquean) ---
+    def registrar(self, ticket_id, user_id, resultado, creado=None):
+        creado = creado or datetime.now()
+        fila = {
+            "ticket_id": ticket_id,
+            "user_id": user_id,
+            "creado": creado.isoformat(timespec="seconds"),
+            "fecha": _fecha_iso(resultado.get("fecha")) or creado.strftime("%Y-%m-%d"),
+            **_columnas(resultado),
+        }
+        self._cola.put((SQL_INSERTAR, fila))
+
+    def corregir(self, ticket_id, user_id, resultado, campo, valor):
+        fila = {
+            "ticket_id": ticket_id,
+            "user_id": user_id,
+            "fecha_corregida": _fecha_iso(resultado.get("fecha")),
+            **_columnas(resultado),
+        }
+        self._cola.put((SQL_CORREGIR, fila))
+        self._cola.put((SQL_CORRECCION, {
+            "ticket_id": ticket_id,
+            "user_id": user_id,
+            "campo": campo,
+            "valor": valor,
+            "creado": datetime.now().isoformat(timespec="seconds"),
+        }))
+
+    def _escritor(self):
+        conexion = sqlite3.connect(self.ruta)
+        try:
+            while True:
+                operacion = self._cola.get()
+                lote = [operacion]
+                # Lo que se haya acumulado mientras tanto va en la misma transacción
+                while operacion is not None:
+                    try:
+                        operacion = self._cola.get_nowait()
+                    except queue.Empty:
+                        break
+                    lote.append(operacion)
+
+                fin = lote[-1] is None
+                # Las marcas de sincronizar van en la cola entre las escrituras
+                marcas = [op for op in lote if isinstance(op, asyncio.Future)]
+                pendientes = [op for op in lote if op is not None and not isinstance(op, asyncio.Future)]
+                try:
+                    self._aplicar(conexion, pendientes)
+                finally:
+                    for marca in marcas:
+                        marca.get_loop().call_soon_threadsafe(_resolver, marca)
+                if fin:
+                    return
+        finally:
+            conexion.close()
+
+    def _aplicar(self, conexion, pendientes):
+        """
+        Aplica el lote en una transacción, reintentándolo si falla. Si sigue
+        fallando, aplica las operaciones una a una para perder solo las que fallan.
+        """
+        for intento in range(REINTENTOS_LOTE):
+            try:
+                with conexion:
+                    for sql, parametros in pendientes:
+                        conexion.execute(sql, parametros)
+                return
+            except sqlite3.Error:
+                log.warning("History batch of %d writes failed (attempt %d/%d)",
+                            len(pendientes), intento + 1, REINTENTOS_LOTE, exc_info=True)
+                time.sleep(ESPERA_REINTENTO * 2 ** intento)
+        for sql, parametros in pendientes:
+            try:
+                with conexion:
+                    conexion.execute(sql, parametros)
+            except sqlite3.Error:
+                log.exception("Dropping history write for ticket %s", parametros.get("ticket_id"))
+
+    async def sincronizar(self, espera=ESPERA_SINCRONIZAR):
+        """
+        Espera a que se hayan aplicado las escrituras encoladas hasta ahora
+        (no las que lleguen después), como mucho `espera` segundos: pasado
+        ese tiempo la consulta sigue y puede no ver las últimas escrituras.
+        """
+        if self._hilo is None or not self._hilo.is_alive():
+            return
+        marca = asyncio.get_running_loop().create_future()
+        self._cola.put(marca)
+        try:
+            await asyncio.wait_for(marca, espera)
+        except asyncio.TimeoutError:
+            log.warning("History writes still pending after %.1f s; reading without them", espera)
+
+    # --- Consultas ---
+    def _leer(self, sql, parametros):
+        conexion = sqlite3.connect(f"file:{self.ruta}?mode=ro", uri=True)
+        try:
+            conexion.row_factory = sqlite3.Row
+            return [dict(fila) for fila in conexion.execute(sql, parametros)]
+        finally:
+            conexion.close()
+
+    async def ultimos(self, user_id, limite=10):
+        await self.sincronizar()
+        return await asyncio.to_thread(
+            self._leer,
+            "SELECT ticket_id, fecha, fecha_texto, establecimiento, total, divisa FROM tickets"
+            " WHERE user_id = ? ORDER BY fecha DESC, id DESC LIMIT ?",
+            (user_id, limite)
+        )
+
+    async def resumen(self, user_id, desde, hasta, top=5):
+        """
+        Gasto de un usuario entre dos fechas ISO (hasta excluida).
+        Devuelve (totales por divisa, establecimientos con más gasto).
+        """
+        await self.sincronizar()
+        filtro = "WHERE user_id = ? AND fecha >= ? AND fecha < ?"
+        totales = await asyncio.to_thread(
+            self._leer,
+            f"SELECT COALESCE(divisa, 'EUR') AS divisa, COUNT(*) AS tickets, SUM(total) AS total"
+            f" FROM tickets {filtro} GROUP BY 1 ORDER BY total DESC",
+            (user_id, desde, hasta)
+        )
+        establecimientos = await asyncio.to_thread(
+            self._leer,
+            f"SELECT establecimiento, COUNT(*) AS tickets, SUM(total) AS total FROM tickets {filtro}"
+            f" AND establecimiento IS NOT NULL GROUP BY establecimiento ORDER BY total DESC LIMIT ?",
+            (user_id, desde, hasta, top)
+        )
+        return totales, establecimientos
+
+    async def exportar(self, user_id, filas_por_bloque=FILAS_POR_BLOQUE):
+        """Generador asíncrono de bloques de filas (tuplas en el orden de COLUMNAS_EXPORTACION)."""
+        await self.sincronizar()
+        conexion = await asyncio.to_thread(
+            sqlite3.connect, f"file:{self.ruta}?mode=ro", uri=True, check_same_thread=False
+        )
+        try:
+            cursor = await asyncio.to_thread(
+                conexion.execute,
+                f"SELECT {', '.join(COLUMNAS_EXPORTACION)} FROM tickets WHERE user_id = ? ORDER BY fecha, id",
+                (user_id,)
+            )
+            while True:
+                bloque = await asyncio.to_thread(cursor.fetchmany, filas_por_bloque)
+                if not bloque:
+                    break
+                yield bloque
+        finally:
+            conexion.close()
@@ -0,0 +1,350 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+
+# Estados de un trabajo
+PENDIENTE = "pendiente"
+EN_CURSO = "en_curso"
+HECHO = "hecho"
+FALLIDO = "fallido"
+
+# Cada cuánto borra el bucle de entrega los trabajos entregados antiguos (segundos)
+INTERVALO_PURGA = 3600
+
+log = logging.getLogger(__name__)
+
+ESQUEMA = [
+    """CREATE TABLE IF NOT EXISTS trabajos (
+        id TEXT PRIMARY KEY,
+        estado TEXT NOT NULL,
+        datos TEXT NOT NULL,
+        imagen TEXT NOT NULL,
+        creado REAL NOT NULL,
+        visible_desde REAL NOT NULL,
+        intentos INTEGER NOT NULL DEFAULT 0,
+        reserva TEXT,
+        trabajador TEXT,
+        resultado TEXT,
+        error TEXT,
+        terminado REAL,
+        entregado REAL,
+        entregas INTEGER NOT NULL DEFAULT 0,
+        reintento_entrega REAL,
+        error_entrega TEXT
+    )""",
+    # Reclamar: el más antiguo visible entre pendientes y reservas caducadas
+    "CREATE INDEX IF NOT EXISTS idx_trabajos_estado ON trabajos (estado, visible_desde, creado)",
+    # Entregar: terminados aún sin entregar
+    "CREATE INDEX IF NOT EXISTS idx_trabajos_entrega ON trabajos (entregado, estado)",
+]
+# Columnas añadidas después de crear la tabla: se añaden a las colas ya existentes
+COLUMNAS_NUEVAS = [
+    ("entregas", "INTEGER NOT NULL DEFAULT 0"),
+    ("reintento_entrega", "REAL"),
+    ("error_entrega", "TEXT"),
+]
+
+
+def id_trabajador():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Reserva:
+    """Trabajo reclamado por un worker. `token` identifica esta reserva concreta."""
+    __slots__ = ("id", "token", "datos", "imagen", "intentos", "creado")
+
+    def __init__(self, id, token, datos, imagen, intentos, creado):
+        self.id = id
+        self.token = token
+        self.datos = datos
+        self.imagen = imagen
+        self.intentos = intentos
+        self.creado = creado
+
+
+class JobQueue:
+    """
+    Cola de trabajos de OCR duradera en SQLite (modo WAL) con las imágenes en
+    un directorio al lado. La comparten el bot (encola y entrega resultados)
+    y los procesos de ocr_worker.py, en la misma máquina o en nodos que
+    montan el mismo volumen (SQLite necesita bloqueos de fichero fiables).
+
+    - Entrega al menos una vez: un trabajo reclamado queda invisible durante
+      `visibilidad` segundos; si el worker muere sin completarlo, otro lo
+      vuelve a reclamar al caducar la reserva.
+    - Completar es idempotente: solo cuenta la primera vez que un trabajo
+      pasa a hecho; un worker tardío con una reserva caducada no lo pisa.
+      Sí pisa un fallido que aún no se ha entregado (p.ej. una reserva
+      caducada en su último intento): mejor el resultado que el error.
+    - Tras `max_intentos` reservas sin éxito el trabajo queda como fallido.
+    - Si el bot no consigue entregar un resultado, lo reintenta con espera
+      creciente; tras `max_entregas` intentos lo da por entregado.
+
+    Las llamadas son bloqueantes (cortas); el bot las ejecuta con asyncio.to_thread.
+    """
+
+    def __init__(self, ruta, directorio_imagenes=None, visibilidad=120, max_intentos=3, max_entregas=5):
+        self.ruta = ruta
+        self.directorio_imagenes = directorio_imagenes or os.path.splitext(ruta)[0] + "_imagenes"
+        self.visibilidad = visibilidad
+        self.max_intentos = max_intentos
+        self.max_entregas = max_entregas
+        os.makedirs(self.directorio_imagenes, exist_ok=True)
+        with self._conectar() as conexion:
+            conexion.execute("PRAGMA journal_mode=WAL")
+            for sentencia in ESQUEMA:
+                conexion.execute(sentencia)
+            existentes = {fila["name"] for fila in conexion.execute("PRAGMA table_info(trabajos)")}
+            for columna, tipo in COLUMNAS_NUEVAS:
+                if columna not in existentes:
+                    conexion.execute(f"ALTER TABLE trabajos ADD COLUMN {columna} {tipo}")
+
+    def _conectar(self):
+        # isolation_level=None: las transacciones se abren a mano con BEGIN IMMEDIATE
+        conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+        conexion.row_factory = sqlite3.Row
+        return _Conexion(conexion)
+
+    # --- Productor (bot) ---
+    def encolar(self, datos, imagen, job_id=None):
+        """
+        datos: dict serializable (usuario, chat, mensaje...). imagen: bytes de la foto.
+        Encolar dos veces el mismo job_id no duplica el trabajo. Devuelve el job_id.
+        """
+        job_id = job_id or uuid.uuid4().hex
+        ruta_imagen = os.path.join(self.directorio_imagenes, f"{job_id}.jpg")
+        # La imagen se escribe antes que la fila: un worker nunca ve un trabajo sin imagen
+        temporal = f"{ruta_imagen}.tmp"
+        with open(temporal, "wb") as f:
+            f.write(imagen)
+        os.replace(temporal, ruta_imagen)
+
+        ahora = time.time()
+        with self._conectar() as conexion:
+            conexion.execute(
+                "INSERT OR IGNORE INTO trabajos (id, estado, datos, imagen, creado, visible_desde)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, PENDIENTE, json.dumps(datos, ensure_ascii=False), ruta_imagen, ahora, ahora)
+            )
+        return job_id
+
+    def pendientes(self):
+        """Trabajos sin terminar (esperando o en curso)."""
+        with self._conectar() as conexion:
+            return conexion.execute(
+                "SELECT COUNT(*) FROM trabajos WHERE estado IN (?, ?)", (PENDIENTE, EN_CURSO)
+            ).fetchone()[0]
+
+    def resumen(self):
+        with self._conectar() as conexion:
+            cuentas = dict(conexion.execute(
+                "SELECT estado, COUNT(*) FROM trabajos WHERE entregado IS NULL GROUP BY estado"
+            ).fetchall())
+        return (f"Cola de trabajos: {cuentas.get(PENDIENTE, 0)} en espera, {cuentas.get(EN_CURSO, 0)} en curso, "
+                f"{cuentas.get(HECHO, 0) + cuentas.get(FALLIDO, 0)} sin entregar")
+
+    def terminados_sin_entregar(self, limite=50):
+        """
+        [(job_id, estado, datos, resultado o None, error o None)] listos para
+        responder al usuario (sin los que esperan para reintentar la entrega).
+        """
+        with self._conectar() as conexion:
+            filas = conexion.execute(
+                "SELECT id, estado, datos, resultado, error FROM trabajos"
+                " WHERE entregado IS NULL AND estado IN (?, ?)"
+                " AND (reintento_entrega IS NULL OR reintento_entrega <= ?) ORDER BY terminado LIMIT ?",
+                (HECHO, FALLIDO, time.time(), limite)
+            ).fetchall()
+        return [
+            (f["id"], f["estado"], json.loads(f["datos"]),
+             json.loads(f["resultado"]) if f["resultado"] else None, f["error"])
+            for f in filas
+        ]
+
+    def marcar_entregado(self, job_id, estado=None):
+        """
+        Tras responder al usuario. Si el bot cae antes, el resultado se vuelve a entregar.
+        estado: el que tenía el trabajo al entregarlo; si cambió entretanto (un
+        fallido que un worker tardío completó) queda sin entregar y se envía el nuevo.
+        """
+        with self._conectar() as conexion:
+            if estado is None:
+                conexion.execute("UPDATE trabajos SET entregado = ? WHERE id = ?", (time.time(), job_id))
+            else:
+                conexion.execute("UPDATE trabajos SET entregado = ? WHERE id = ? AND estado = ?",
+                                 (time.time(), job_id, estado))
+
+    def fallo_entrega(self, job_id, error):
+        """
+        Apunta un intento de entrega fallido; el siguiente espera 2**entregas
+        segundos. Tras max_entregas intentos el trabajo se da por entregado
+        (con el error en error_entrega) y devuelve True.
+        """
+        ahora = time.time()
+        with self._conectar() as conexion:
+            conexion.execute("BEGIN IMMEDIATE")
+            fila = conexion.execute("SELECT entregas FROM trabajos WHERE id = ?", (job_id,)).fetchone()
+            entregas = (fila["entregas"] if fila else 0) + 1
+            abandonado = entregas >= self.max_entregas
+            conexion.execute(
+                "UPDATE trabajos SET entregas = ?, error_entrega = ?, reintento_entrega = ?, entregado = ?"
+                " WHERE id = ?",
+                (entregas, str(error), ahora + 2 ** entregas, ahora if abandonado else None, job_id)
+            )
+            conexion.execute("COMMIT")
+        return abandonado
+
+    def purgar(self, antiguedad=7 * 86400):
+        """Borra los trabajos entregados hace más de `antiguedad` segundos y sus imágenes."""
+        limite = time.time() - antiguedad
+        with self._conectar() as conexion:
+            filas = conexion.execute(
+                "SELECT id, imagen FROM trabajos WHERE entregado IS NOT NULL AND entregado < ?", (limite,)
+            ).fetchall()
+            conexion.executemany("DELETE FROM trabajos WHERE id = ?", [(f["id"],) for f in filas])
+        for fila in filas:
+            try:
+                os.remove(fila["imagen"])
+            except FileNotFoundError:
+                pass
+        return len(filas)
+
+    # --- Consumidor (ocr_worker.py) ---
+    def reclamar(self, trabajador=None):
+        """
+        Reserva el trabajo visible más antiguo durante `visibilidad` segundos.
+        Devuelve una Reserva o None si no hay nada que hacer.
+        """
+        trabajador = trabajador or id_trabajador()
+        ahora = time.time()
+        with self._conectar() as conexion:
+            conexion.execute("BEGIN IMMEDIATE")
+            # Reservas caducadas que ya agotaron sus intentos: fallidas
+            conexion.execute(
+                "UPDATE trabajos SET estado = ?, error = COALESCE(error, 'Tiempo de procesado agotado'),"
+                " terminado = ? WHERE estado = ? AND visible_desde <= ? AND intentos >= ?",
+                (FALLIDO, ahora, EN_CURSO, ahora, self.max_intentos)
+            )
+            fila = conexion.execute(
+                "SELECT id, datos, imagen, intentos, creado FROM trabajos"
+                " WHERE estado IN (?, ?) AND visible_desde <= ? ORDER BY creado LIMIT 1",
+                (PENDIENTE, EN_CURSO, ahora)
+            ).fetchone()
+            if fila is None:
+                conexion.execute("COMMIT")
+                return None
+            token = uuid.uuid4().hex
+            conexion.execute(
+                "UPDATE trabajos SET estado = ?, reserva = ?, trabajador = ?, intentos = intentos + 1,"
+                " visible_desde = ? WHERE id = ?",
+                (EN_CURSO, token, trabajador, ahora + self.visibilidad, fila["id"])
+            )
+            conexion.execute("COMMIT")
+        return Reserva(fila["id"], token, json.loads(fila["datos"]), fila["imagen"],
+                       fila["intentos"] + 1, fila["creado"])
+
+    def renovar(self, reserva):
+        """Alarga la reserva (trabajos largos). False si ya no es de este worker."""
+        with self._conectar() as conexion:
+            cursor = conexion.execute(
+                "UPDATE trabajos SET visible_desde = ? WHERE id = ? AND reserva = ? AND estado = ?",
+                (time.time() + self.visibilidad, reserva.id, reserva.token, EN_CURSO)
+            )
+            return cursor.rowcount == 1
+
+    def completar(self, reserva, resultado):
+        """
+        Guarda el resultado. Idempotente: devuelve False si el trabajo ya estaba
+        hecho (otro worker lo completó tras caducar esta reserva) o ya se entregó.
+        Un fallido sin entregar se sustituye por el resultado (y sus intentos de
+        entrega vuelven a empezar), aunque esta reserva haya caducado.
+        """
+        with self._conectar() as conexion:
+            cursor = conexion.execute(
+                "UPDATE trabajos SET estado = ?, resultado = ?, error = NULL, terminado = ?,"
+                " entregas = 0, reintento_entrega = NULL, error_entrega = NULL"
+                " WHERE id = ? AND estado != ? AND entregado IS NULL",
+                (HECHO, json.dumps(resultado, ensure_ascii=False), time.time(), reserva.id, HECHO)
+            )
+            return cursor.rowcount == 1
+
+    def fallar(self, reserva, error):
+        """
+        El worker no pudo procesarlo. Se reintenta (con espera creciente)
+        hasta max_intentos; después queda como fallido con el error.
+        """
+        ahora = time.time()
+        with self._conectar() as conexion:
+            if reserva.intentos >= self.max_intentos:
+                conexion.execute(
+                    "UPDATE trabajos SET estado = ?, error = ?, terminado = ?"
+                    " WHERE id = ? AND reserva = ? AND estado = ?",
+                    (FALLIDO, str(error), ahora, reserva.id, reserva.token, EN_CURSO)
+                )
+            else:
+                conexion.execute(
+                    "UPDATE trabajos SET estado = ?, error = ?, visible_desde = ?"
+                    " WHERE id = ? AND reserva = ? AND estado = ?",
+                    (PENDIENTE, str(error), ahora + 2 ** reserva.intentos, reserva.id, reserva.token, EN_CURSO)
+                )
+
+
+async def entregar_terminados(cola, entregar, intervalo=1.0, conservar=7 * 86400):
+    """
+    Bucle del bot: por cada trabajo terminado llama a
+    `await entregar(job_id, estado, datos, resultado, error)` y después lo
+    marca como entregado. Si entregar falla, se registra y el trabajo se
+    reintenta con espera creciente hasta cola.max_entregas veces (el usuario
+    puede recibir la respuesta dos veces, nunca ninguna mientras queden
+    intentos). Cada INTERVALO_PURGA segundos borra los trabajos entregados
+    hace más de `conservar` segundos.
+    """
+    proxima_purga = time.monotonic()
+    while True:
+        if time.monotonic() >= proxima_purga:
+            proxima_purga = time.monotonic() + INTERVALO_PURGA
+            try:
+                borrados = await asyncio.to_thread(cola.purgar, conservar)
+                if borrados:
+                    log.info(f"Job queue: purged {borrados} delivered jobs")
+            except Exception:
+                log.exception("Job queue: purge failed")
+
+        entregados = 0
+        for trabajo in await asyncio.to_thread(cola.terminados_sin_entregar):
+            job_id = trabajo[0]
+            try:
+                await entregar(*trabajo)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                if await asyncio.to_thread(cola.fallo_entrega, job_id, error):
+                    log.error(f"Job {job_id}: giving up after {cola.max_entregas} delivery attempts: {error}")
+                else:
+                    log.warning(f"Job {job_id}: delivery failed, will retry: {error}")
+                continue
+            await asyncio.to_thread(cola.marcar_entregado, job_id, trabajo[1])
+            entregados += 1
+        if not entregados:
+            await asyncio.sleep(intervalo)
+
+
+class _Conexion:
+    """Conexión SQLite como context manager que además se cierra al salir."""
+
+    def __init__(self, conexion):
+        self.conexion = conexion
+
+    def __enter__(self):
+        return self.conexion
+
+    def __exit__(self, tipo, valor, traza):
+        try:
+            if tipo is not None and self.conexion.in_transaction:
+                self.conexion.execute("ROLLBACK")
+        finally:
+            self.conexion.close()
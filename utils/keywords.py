@@ -0,0 +1,53 @@
+import re
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+
+class KeywordMatcher:
+    """
+    Búsqueda difusa de un conjunto fijo de palabras clave en muchas líneas.
+
+    Se construye una vez por conjunto de palabras (a nivel de módulo en cada
+    parser). Las líneas se puntúan contra todas las palabras en una sola
+    llamada vectorizada a `rapidfuzz.process.cdist`; antes, una expresión
+    regular con todas las palabras resuelve las coincidencias exactas sin
+    pasar por la puntuación difusa.
+
+    Las líneas se esperan ya en mayúsculas (como las palabras clave).
+    """
+
+    def __init__(self, palabras, umbral=75, scorer=fuzz.partial_ratio):
+        self.palabras = list(palabras)
+        self.umbral = umbral
+        self.scorer = scorer
+        # Primera etapa: alternativa con todas las palabras, las largas primero
+        ordenadas = sorted(self.palabras, key=len, reverse=True)
+        self._exactas = re.compile("|".join(re.escape(p) for p in ordenadas))
+
+    def puntuaciones(self, lineas):
+        """Matriz (líneas x palabras) de puntuaciones; 0 por debajo del umbral."""
+        if not lineas:
+            return np.zeros((0, len(self.palabras)), dtype=np.float32)
+        return process.cdist(lineas, self.palabras, scorer=self.scorer, score_cutoff=self.umbral)
+
+    def coincidencias(self, lineas):
+        """Matriz booleana (líneas x palabras): qué palabras aparecen en cada línea."""
+        return self.puntuaciones(lineas) >= self.umbral
+
+    def lineas_con_coincidencia(self, lineas):
+        """Vector booleano: True si la línea contiene alguna de las palabras."""
+        resultado = np.zeros(len(lineas), dtype=bool)
+        pendientes = []
+        for i, linea in enumerate(lineas):
+            if not linea:
+                continue
+            if self._exactas.search(linea):
+                resultado[i] = True
+            else:
+                pendientes.append(i)
+
+        if pendientes:
+            scores = self.puntuaciones([lineas[i] for i in pendientes])
+            resultado[pendientes] = (scores >= self.umbral).any(axis=1)
+        return resultado
@@ -1,55 +1,87 @@
-def construir_lineas(ocr_result, y_threshold=12):
+from itertools import chain
+
+import numpy as np
+
+# Dos palabras seguidas (ordenadas por Y) están en la misma línea si sus
+# bordes superiores distan menos de esta fracción de la altura mediana del texto.
+# Con el escalado x2 y texto de ~24-30 px equivale al antiguo umbral fijo de 12 px,
+# pero se adapta solo a la escala que haya elegido el preprocesado.
+FACTOR_SEPARACION_LINEA = 0.5
+
+
+class LineaOCR:
+    """Una línea reconstruida: texto, caja envolvente, altura del texto y confianza media."""
+    __slots__ = ("texto", "x", "y", "w", "h", "conf", "palabras")
+
+    def __init__(self, texto, x, y, w, h, conf, palabras):
+        self.texto = texto
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h          # altura de la palabra más alta
+        self.conf = conf    # media de las probabilidades del OCR
+        self.palabras = palabras
+
+    def __repr__(self):
+        return f"LineaOCR({self.texto!r}, y={self.y:.0f}, h={self.h:.0f}, conf={self.conf:.2f})"
+
+
+def construir_lineas(ocr_result, y_threshold=None):
     """
     Ordena y agrupa las palabras detectadas por EasyOCR en líneas reales.
-    Devuelve una lista de diccionarios con:
-        { "texto": "...", "x": ?, "y": ?, "w": ?, "h": ? }
-    """
-
-    palabras = []
 
-    # Convertir bounding boxes a objetos con coordenadas simples
-    for (bbox, text, prob) in ocr_result:
-        (x1, y1), (x2, y2), (x3, y3), (x4, y4) = bbox
-        x = min(x1, x2, x3, x4)
-        y = min(y1, y2, y3, y4)
-        w = max(x1, x2, x3, x4) - x
-        h = max(y1, y2, y3, y4) - y
+    ocr_result: [(bbox, texto, prob)] con bbox de 4 esquinas
+    y_threshold: separación vertical máxima en px entre palabras de la misma
+        línea; por defecto se calcula con la altura mediana del texto.
 
-        palabras.append({
-            "text": text,
-            "x": x,
-            "y": y,
-            "w": w,
-            "h": h
-        })
+    Devuelve las líneas de texto y, por cada línea, un LineaOCR con su
+    geometría y confianza media.
+    """
+    if not ocr_result:
+        return [], []
 
-    # Orden por Y, luego por X
-    palabras.sort(key=lambda p: (p["y"], p["x"]))
+    n = len(ocr_result)
+    textos = [r[1] for r in ocr_result]
+    # (N, 4, 2): aplanar las esquinas con fromiter es bastante más rápido que
+    # np.asarray sobre listas anidadas
+    coords = chain.from_iterable(chain.from_iterable(r[0] for r in ocr_result))
+    cajas = np.fromiter(coords, dtype=np.float32, count=n * 8).reshape(n, 4, 2)
+    probs = np.fromiter((r[2] for r in ocr_result), dtype=np.float32, count=n)
 
-    # Agrupar en líneas verdaderas
-    lineas = []
-    linea_actual = []
-    last_y = None
+    minimos = cajas.min(axis=1)
+    maximos = cajas.max(axis=1)
+    x, y = minimos[:, 0], minimos[:, 1]
+    w = maximos[:, 0] - x
+    h = maximos[:, 1] - y
 
-    for p in palabras:
-        if last_y is None:
-            linea_actual.append(p)
-            last_y = p["y"]
-            continue
+    if y_threshold is None:
+        y_threshold = max(1.0, FACTOR_SEPARACION_LINEA * float(np.median(h)))
 
-        if abs(p["y"] - last_y) <= y_threshold:
-            linea_actual.append(p)
-        else:
-            # Cerrar línea y abrir otra
-            lineas.append(sorted(linea_actual, key=lambda p: p["x"]))
-            linea_actual = [p]
+    # Orden por Y (luego por X): una línea nueva cada vez que salta la Y
+    orden = np.lexsort((x, y))
+    saltos = np.abs(np.diff(y[orden])) > y_threshold
+    id_linea = np.empty(len(orden), dtype=np.int64)
+    id_linea[orden] = np.concatenate(([0], np.cumsum(saltos)))
 
-        last_y = p["y"]
+    # Dentro de cada línea, de izquierda a derecha
+    orden = np.lexsort((y, x, id_linea))
+    inicios = np.flatnonzero(np.r_[True, np.diff(id_linea[orden]) != 0])
 
-    if linea_actual:
-        lineas.append(sorted(linea_actual, key=lambda p: p["x"]))
+    # Agregados por línea en bloque (reduceat sobre las palabras ya ordenadas)
+    x1 = np.minimum.reduceat(x[orden], inicios).tolist()
+    y1 = np.minimum.reduceat(y[orden], inicios).tolist()
+    x2 = np.maximum.reduceat(maximos[orden, 0], inicios).tolist()
+    alto = np.maximum.reduceat(h[orden], inicios).tolist()
+    n_palabras = np.diff(np.r_[inicios, len(orden)])
+    conf = (np.add.reduceat(probs[orden], inicios) / n_palabras).tolist()
 
-    # Convertir líneas a texto limpio
-    lineas_texto = [" ".join([p["text"] for p in linea]) for linea in lineas]
+    orden = orden.tolist()
+    limites = inicios.tolist() + [len(orden)]
+    lineas_texto = []
+    lineas = []
+    for k in range(len(inicios)):
+        texto = " ".join([textos[i] for i in orden[limites[k]:limites[k + 1]]])
+        lineas_texto.append(texto)
+        lineas.append(LineaOCR(texto, x1[k], y1[k], x2[k] - x1[k], alto[k], conf[k], int(n_palabras[k])))
 
     return lineas_texto, lineas
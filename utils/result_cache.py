@@ -0,0 +1,239 @@
+import asyncio
+import os
+import json
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def hash_contenido(img: np.ndarray) -> str:
+    """Hash de los píxeles decodificados (igual para la misma imagen aunque cambie el JPEG)."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(img.shape).encode())
+    h.update(np.ascontiguousarray(img).data)
+    return h.hexdigest()
+
+
+def hash_perceptual(img: np.ndarray, lado=8) -> int:
+    """
+    dHash de lado*lado bits (64 por defecto): resiste recompresiones y
+    pequeños cambios de tamaño. Con lado=16 (256 bits) distingue mucho mejor
+    dos tickets distintos con la misma maquetación.
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (lado + 1, lado), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+
+def _distancia(a, b):
+    return bin(a ^ b).count("1")
+
+
+class ResultCache:
+    """
+    Caché LRU de resultados de `procesar_ticket` ({"resultado", "lineas", "tickets"}).
+    "tickets" guarda el ticket_id de cada usuario que ya recibió ese resultado,
+    para que un reenvío no registre el mismo ticket otra vez.
+
+    Claves:
+      - file_unique_id de Telegram (permite saltarse incluso la descarga)
+      - hash del contenido decodificado
+      - hash perceptual opcional para reenvíos casi idénticos, solo entre
+        fotos del mismo usuario: dHash de 64 bits a distancia de Hamming
+        <= distancia_phash (0 = desactivado; 1 recomendado), confirmado con
+        el dHash de 256 bits a <= 4 * distancia_phash
+
+    directorio: si se indica, segundo nivel en disco (un JSON por clave) que
+    sobrevive a los reinicios, con como mucho max_disco ficheros (se borran
+    los más antiguos). El hash perceptual solo se busca en memoria. Los
+    ficheros se leen y escriben en un hilo (asyncio.to_thread).
+    """
+
+    def __init__(self, max_entradas=256, directorio=None, distancia_phash=0, max_disco=10000):
+        self.max_entradas = max_entradas
+        self.directorio = directorio
+        self.distancia_phash = distancia_phash
+        self.max_disco = max_disco
+        self.hits = 0
+        self.misses = 0
+
+        self._entradas = OrderedDict()  # hash contenido -> entrada
+        self._file_ids = {}             # file_unique_id -> hash contenido
+        self._file_ids_de = {}          # hash contenido -> {file_unique_id} (para expulsar)
+        self._phashes = {}              # hash contenido -> (user_id, dHash 64, dHash 256)
+        self._disco = OrderedDict()     # clave en disco -> None, de la más antigua a la más reciente
+
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+            self._disco.update((clave, None) for clave in self._claves_en_disco())
+
+    def claves(self, img):
+        """Devuelve (hash de contenido, hash perceptual o None) de una imagen decodificada."""
+        phash = None
+        if self.distancia_phash > 0:
+            phash = (hash_perceptual(img), hash_perceptual(img, lado=16))
+        return hash_contenido(img), phash
+
+    # --- Consulta ---
+    async def buscar_file_id(self, file_id, user_id=None):
+        entrada = self._buscar_memoria(self._file_ids.get(file_id))
+        if entrada is None:
+            entrada = await self._leer_disco(f"f_{file_id}")
+            if entrada is not None:
+                self._insertar(entrada, file_id=file_id)
+        # Un fallo aquí no cuenta: la petición sigue con la búsqueda por contenido
+        return self._contar(entrada, user_id, contar_fallo=False)
+
+    async def buscar_imagen(self, hash_img, phash=None, user_id=None):
+        entrada = self._buscar_memoria(hash_img)
+        if entrada is None:
+            entrada = await self._leer_disco(f"c_{hash_img}")
+            if entrada is not None:
+                self._insertar(entrada)
+        if entrada is None and phash is not None and user_id is not None and self.distancia_phash > 0:
+            entrada = self._buscar_phash(phash, user_id)
+        return self._contar(entrada, user_id)
+
+    def resumen(self):
+        return f"hits={self.hits} misses={self.misses} entries={len(self._entradas)}"
+
+    # --- Alta ---
+    async def guardar(self, resultado, lineas, hash_img, file_id=None, phash=None, user_id=None, ticket_id=None):
+        """user_id: dueño de la foto; sin él la foto no entra en la búsqueda por hash perceptual."""
+        entrada = {"hash": hash_img, "resultado": dict(resultado), "lineas": list(lineas), "tickets": {}}
+        if user_id is not None and ticket_id:
+            entrada["tickets"][str(user_id)] = ticket_id
+        self._insertar(entrada, file_id, phash, user_id)
+
+        await self._escribir_disco(f"c_{hash_img}", entrada)
+        if file_id:
+            await self._escribir_disco(f"f_{file_id}", entrada)
+
+    async def asociar_ticket(self, user_id, ticket_id, file_id=None, hash_img=None):
+        """
+        Apunta el ticket_id con el que otro usuario recibió un resultado ya en
+        caché (encontrado por file_id o por hash_img). Sin efecto si la entrada
+        ya no está en memoria.
+        """
+        hash_img = hash_img or self._file_ids.get(file_id)
+        entrada = self._entradas.get(hash_img)
+        if entrada is None:
+            return
+        entrada.setdefault("tickets", {})[str(user_id)] = ticket_id
+        await self._escribir_disco(f"c_{hash_img}", entrada)
+        for otro in self._file_ids_de.get(hash_img, ()):
+            await self._escribir_disco(f"f_{otro}", entrada)
+
+    # --- Internos ---
+    def _insertar(self, entrada, file_id=None, phash=None, user_id=None):
+        hash_img = entrada["hash"]
+        self._entradas[hash_img] = entrada
+        self._entradas.move_to_end(hash_img)
+        if file_id:
+            self._file_ids[file_id] = hash_img
+            self._file_ids_de.setdefault(hash_img, set()).add(file_id)
+        if phash is not None and user_id is not None:
+            self._phashes[hash_img] = (user_id, *phash)
+
+        while len(self._entradas) > self.max_entradas:
+            expulsado, _ = self._entradas.popitem(last=False)
+            self._phashes.pop(expulsado, None)
+            for otro in self._file_ids_de.pop(expulsado, ()):
+                if self._file_ids.get(otro) == expulsado:
+                    del self._file_ids[otro]
+
+    def _contar(self, entrada, user_id=None, contar_fallo=True):
+        if entrada is None:
+            if contar_fallo:
+                self.misses += 1
+            return None
+        self.hits += 1
+        # Copias: /editar modifica el ticket del usuario en sitio.
+        # Entradas anteriores a "tickets" no tienen ticket_id de nadie
+        ticket_id = entrada.get("tickets", {}).get(str(user_id))
+        return dict(entrada["resultado"]), list(entrada["lineas"]), ticket_id
+
+    def _buscar_memoria(self, hash_img):
+        if hash_img is None or hash_img not in self._entradas:
+            return None
+        self._entradas.move_to_end(hash_img)
+        return self._entradas[hash_img]
+
+    def _buscar_phash(self, phash, user_id):
+        corto, largo = phash
+        for hash_img, (dueno, otro_corto, otro_largo) in self._phashes.items():
+            # Nunca se reutiliza el ticket de otro usuario, por parecida que sea la foto
+            if dueno != user_id or _distancia(corto, otro_corto) > self.distancia_phash:
+                continue
+            if _distancia(largo, otro_largo) <= 4 * self.distancia_phash:
+                return self._buscar_memoria(hash_img)
+        return None
+
+    def _ruta(self, clave):
+        # Los file_unique_id de Telegram son seguros para nombres de fichero
+        return os.path.join(self.directorio, f"{clave}.json")
+
+    def _claves_en_disco(self):
+        """Claves ya guardadas en el directorio, de la más antigua a la más reciente."""
+        ficheros = []
+        for fichero in os.scandir(self.directorio):
+            if fichero.name.endswith(".json"):
+                try:
+                    ficheros.append((fichero.stat().st_mtime, fichero.name[:-len(".json")]))
+                except OSError:
+                    pass
+        return [clave for _, clave in sorted(ficheros)]
+
+    async def _leer_disco(self, clave):
+        if not self.directorio or clave not in self._disco:
+            return None
+        self._disco.move_to_end(clave)
+        return await asyncio.to_thread(self._leer_fichero, self._ruta(clave))
+
+    async def _escribir_disco(self, clave, entrada):
+        if not self.directorio:
+            return
+        self._disco[clave] = None
+        self._disco.move_to_end(clave)
+        expulsadas = []
+        while len(self._disco) > self.max_disco:
+            expulsadas.append(self._disco.popitem(last=False)[0])
+        await asyncio.to_thread(self._escribir_fichero, self._ruta(clave), entrada,
+                                [self._ruta(c) for c in expulsadas])
+
+    @staticmethod
+    def _leer_fichero(ruta):
+        try:
+            with open(ruta, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _escribir_fichero(ruta, entrada, expulsadas):
+        # Fichero temporal y os.replace: una lectura a la vez nunca ve un JSON a medias.
+        # El temporal tiene nombre único: dos escrituras de la misma clave (la misma
+        # foto de dos usuarios) no comparten fichero y gana la última completa
+        temporal = None
+        try:
+            with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(ruta),
+                                             prefix=os.path.basename(ruta) + ".", suffix=".tmp",
+                                             delete=False) as f:
+                temporal = f.name
+                json.dump(entrada, f, ensure_ascii=False)
+            os.replace(temporal, ruta)
+        except OSError:
+            if temporal is not None:
+                try:
+                    os.remove(temporal)
+                except OSError:
+                    pass
+        for expulsada in expulsadas:
+            try:
+                os.remove(expulsada)
+            except OSError:
+                pass
@@ -0,0 +1,111 @@
+import asyncio
+import time
+from collections import deque
+
+
+class ColaLlena(Exception):
+    """El planificador ya tiene max_cola trabajos esperando."""
+
+
+class FairScheduler:
+    """
+    Planificador de trabajos de OCR delante del pipeline.
+
+    - Como mucho max_en_vuelo tickets ejecutándose a la vez. Un trabajo
+      con varios tickets (un álbum) ocupa `peso` puestos, hasta max_en_vuelo.
+    - Turno rotatorio entre usuarios: quien reenvía 30 tickets no deja
+      esperando a los demás; cada usuario con trabajo pendiente ejecuta uno
+      por vuelta.
+    - Como mucho max_cola trabajos esperando; por encima, enviar() lanza
+      ColaLlena para poder responder "inténtalo más tarde".
+
+    Cada trabajo es una función async que recibe los segundos que ha estado
+    en cola. Se ejecuta en su propia tarea, así que el handler que lo encola
+    vuelve enseguida y los comandos no esperan detrás del OCR.
+    """
+
+    def __init__(self, max_en_vuelo=1, max_cola=100):
+        self.max_en_vuelo = max(1, max_en_vuelo)
+        self.max_cola = max_cola
+        self._colas = {}        # user_id -> deque[(trabajo, encolado)]
+        self._turno = deque()   # user_ids con trabajo pendiente, en orden de vuelta
+        self._tareas = set()
+        self.en_vuelo = 0
+        self.pendientes = 0
+        self.rechazados = 0
+        self.completados = 0
+
+    def enviar(self, user_id, trabajo, peso=1):
+        """
+        Encola un trabajo. Devuelve su puesto en la cola (1 = el siguiente en
+        empezar; 0 = empieza ya). Lanza ColaLlena si no cabe.
+        peso: tickets que procesa el trabajo a la vez (p.ej. las fotos de un álbum).
+        """
+        if self.pendientes >= self.max_cola:
+            self.rechazados += 1
+            raise ColaLlena()
+
+        cola = self._colas.get(user_id)
+        if cola is None:
+            cola = self._colas[user_id] = deque()
+            self._turno.append(user_id)
+        entrada = (trabajo, time.monotonic(), min(max(1, peso), self.max_en_vuelo))
+        cola.append(entrada)
+        self.pendientes += 1
+        self._despachar()
+        if self._colas.get(user_id) is not cola or not any(e is entrada for e in cola):
+            return 0
+        return self._posicion(user_id, next(i for i, e in enumerate(cola, 1) if e is entrada))
+
+    def _posicion(self, user_id, k):
+        """Puesto del k-ésimo pendiente de user_id siguiendo el turno rotatorio."""
+        delante = k - 1
+        antes_en_turno = True
+        for otro in self._turno:
+            if otro == user_id:
+                antes_en_turno = False
+                continue
+            # Los que van antes en la vuelta ejecutan k trabajos antes que este; los de después, k - 1
+            delante += min(len(self._colas[otro]), k if antes_en_turno else k - 1)
+        return delante + 1
+
+    def _despachar(self):
+        while self._turno:
+            user_id = self._turno[0]
+            cola = self._colas[user_id]
+            trabajo, encolado, peso = cola[0]
+            # El siguiente en turno espera a que haya sitio para todos sus tickets
+            if self.en_vuelo + peso > self.max_en_vuelo:
+                return
+            self._turno.popleft()
+            cola.popleft()
+            if cola:
+                self._turno.append(user_id)
+            else:
+                del self._colas[user_id]
+            self.pendientes -= 1
+            self.en_vuelo += peso
+            tarea = asyncio.create_task(self._ejecutar(trabajo, time.monotonic() - encolado, peso))
+            self._tareas.add(tarea)
+            tarea.add_done_callback(self._tareas.discard)
+
+    async def _ejecutar(self, trabajo, espera, peso):
+        try:
+            await trabajo(espera)
+        finally:
+            self.en_vuelo -= peso
+            self.completados += 1
+            self._despachar()
+
+    def resumen(self):
+        return (f"Cola OCR: {self.pendientes} en espera, {self.en_vuelo}/{self.max_en_vuelo} en curso, "
+                f"{self.rechazados} rechazados")
+
+    async def cerrar(self):
+        """Descarta lo pendiente y cancela lo que está en curso."""
+        self._colas.clear()
+        self._turno.clear()
+        self.pendientes = 0
+        for tarea in list(self._tareas):
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
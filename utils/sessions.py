@@ -0,0 +1,249 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+CAMPOS_TICKET = ("establecimiento", "cif", "fecha", "total", "iva", "divisa", "metodo_pago")
+
+
+class TicketSession:
+    """Último ticket de un usuario: los campos del resultado, su id y su caducidad."""
+    __slots__ = CAMPOS_TICKET + ("ticket_id", "expira")
+
+    def __init__(self, resultado, expira, ticket_id=None):
+        for campo in CAMPOS_TICKET:
+            setattr(self, campo, resultado.get(campo))
+        self.ticket_id = ticket_id
+        self.expira = expira
+
+    def a_dict(self):
+        return {campo: getattr(self, campo) for campo in CAMPOS_TICKET}
+
+
+class SessionStore:
+    """
+    Último ticket de cada usuario para /editar (o los de su último álbum,
+    numerados desde 1).
+
+    - Como mucho max_entradas usuarios en memoria (se expulsa el menos usado).
+    - Cada entrada caduca ttl segundos después de su última escritura.
+    - ruta_sqlite: opcional, copia en SQLite para sobrevivir a reinicios. Se
+      escribe por detrás (write-behind): los cambios se marcan y una tarea los
+      vuelca cada intervalo_escritura segundos en un hilo, así que ni
+      handle_photo ni /editar esperan al disco.
+    - Las sesiones caducadas se purgan cada intervalo_escritura segundos,
+      también sin ruta_sqlite.
+
+    Interfaz asíncrona: iniciar(), obtener(), obtener_con_id(), cuantos(),
+    guardar(), guardar_album(), cerrar().
+    """
+
+    def __init__(self, max_entradas=10000, ttl=86400, ruta_sqlite=None, intervalo_escritura=5.0):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.ruta_sqlite = ruta_sqlite
+        self.intervalo_escritura = intervalo_escritura
+
+        self._entradas = OrderedDict()  # user_id -> [TicketSession] (varios si venían en un álbum)
+        self._sucias = set()            # user_ids pendientes de escribir
+        self._borradas = set()          # user_ids pendientes de borrar
+        self._conexion = None
+        self._lock_db = threading.Lock()
+        self._tarea = None
+
+    def __len__(self):
+        return len(self._entradas)
+
+    # --- Ciclo de vida ---
+    async def iniciar(self):
+        """Carga las sesiones guardadas y arranca la purga y escritura en segundo plano."""
+        if self.ruta_sqlite:
+            filas = await asyncio.to_thread(self._abrir_y_cargar)
+            for user_id, ticket, expira in filas:
+                guardados = json.loads(ticket)
+                # Un dict para un ticket suelto, una lista para un álbum
+                if isinstance(guardados, dict):
+                    guardados = [guardados]
+                self._entradas[user_id] = [TicketSession(r, expira, r.get("ticket_id")) for r in guardados]
+        self._tarea = asyncio.create_task(self._escritura_periodica())
+
+    async def cerrar(self):
+        """Vuelca lo pendiente y cierra la base de datos."""
+        if self._tarea is not None:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+        if self._conexion is not None:
+            try:
+                # El último volcado y el cierre van juntos en el hilo, con _lock_db;
+                # shield: si se cancela cerrar, terminan igualmente
+                await asyncio.shield(self._volcar(cerrar=True))
+            except Exception:
+                log.exception("Could not flush sessions to %s on shutdown", self.ruta_sqlite)
+
+    # --- Consulta y escritura ---
+    async def obtener(self, user_id):
+        """Devuelve el ticket del usuario como dict (copia) o None si no hay o ha caducado."""
+        ticket, _ = await self.obtener_con_id(user_id)
+        return ticket
+
+    async def obtener_con_id(self, user_id, indice=None):
+        """
+        Como obtener, pero devuelve (ticket, ticket_id); (None, None) si no hay.
+        indice: número (desde 1) del ticket dentro del álbum; por defecto, el último.
+        """
+        sesiones = self._vigentes(user_id)
+        if not sesiones:
+            return None, None
+        if indice is None:
+            indice = len(sesiones)
+        if not 1 <= indice <= len(sesiones):
+            return None, None
+        sesion = sesiones[indice - 1]
+        return sesion.a_dict(), sesion.ticket_id
+
+    async def cuantos(self, user_id):
+        """Tickets editables del usuario (más de 1 si el último envío fue un álbum)."""
+        return len(self._vigentes(user_id))
+
+    async def guardar(self, user_id, resultado, ticket_id=None, indice=None):
+        """
+        Sin indice, resultado pasa a ser el único ticket del usuario (foto nueva).
+        Con indice (desde 1), sustituye ese ticket del álbum y renueva la caducidad de todos.
+        """
+        expira = time.time() + self.ttl
+        sesiones = self._vigentes(user_id)
+        if indice is None or not 1 <= indice <= len(sesiones):
+            sesiones = [TicketSession(resultado, expira, ticket_id)]
+        else:
+            sesiones[indice - 1] = TicketSession(resultado, expira, ticket_id)
+            for sesion in sesiones:
+                sesion.expira = expira
+        self._poner(user_id, sesiones)
+
+    async def guardar_album(self, user_id, tickets):
+        """tickets: [(resultado, ticket_id)] de un álbum; sustituyen a lo que hubiera."""
+        expira = time.time() + self.ttl
+        self._poner(user_id, [TicketSession(resultado, expira, ticket_id) for resultado, ticket_id in tickets])
+
+    # --- Internos ---
+    def _vigentes(self, user_id):
+        sesiones = self._entradas.get(user_id)
+        if sesiones is None:
+            return []
+        if sesiones[0].expira <= time.time():
+            self._eliminar(user_id)
+            return []
+        self._entradas.move_to_end(user_id)
+        return sesiones
+
+    def _poner(self, user_id, sesiones):
+        self._entradas[user_id] = sesiones
+        self._entradas.move_to_end(user_id)
+        self._marcar(user_id)
+        while len(self._entradas) > self.max_entradas:
+            antiguo, _ = self._entradas.popitem(last=False)
+            self._marcar_borrado(antiguo)
+
+    def _eliminar(self, user_id):
+        self._entradas.pop(user_id, None)
+        self._marcar_borrado(user_id)
+
+    def _marcar(self, user_id):
+        if self.ruta_sqlite:
+            self._borradas.discard(user_id)
+            self._sucias.add(user_id)
+
+    def _marcar_borrado(self, user_id):
+        if self.ruta_sqlite:
+            self._sucias.discard(user_id)
+            self._borradas.add(user_id)
+
+    def _purgar_caducadas(self):
+        ahora = time.time()
+        for user_id in [u for u, s in self._entradas.items() if s[0].expira <= ahora]:
+            self._eliminar(user_id)
+
+    async def _escritura_periodica(self):
+        while True:
+            await asyncio.sleep(self.intervalo_escritura)
+            self._purgar_caducadas()
+            try:
+                await self._volcar()
+            except Exception:
+                # Los cambios siguen marcados y se reintentan en la siguiente vuelta
+                log.exception("Could not flush sessions to %s", self.ruta_sqlite)
+
+    async def _volcar(self, cerrar=False):
+        if self._conexion is None:
+            return
+        if not self._sucias and not self._borradas and not cerrar:
+            return
+        # Foto de los cambios en el event loop; el hilo solo toca SQLite
+        escribir = []
+        for user_id in self._sucias:
+            sesiones = self._entradas.get(user_id)
+            if sesiones:
+                tickets = [dict(s.a_dict(), ticket_id=s.ticket_id) for s in sesiones]
+                # Un ticket suelto se guarda como dict, igual que antes de los álbumes
+                guardado = tickets[0] if len(tickets) == 1 else tickets
+                escribir.append((user_id, json.dumps(guardado, ensure_ascii=False), sesiones[0].expira))
+        borrar = [(user_id,) for user_id in self._borradas]
+        sucias, borradas = self._sucias, self._borradas
+        self._sucias, self._borradas = set(), set()
+        try:
+            await asyncio.to_thread(self._escribir, escribir, borrar, cerrar)
+        except BaseException:
+            # Volver a marcar lo que no se ha escrito (sin pisar cambios posteriores).
+            # También si se cancela la espera: el hilo puede no haber llegado a escribir
+            # y reescribir lo mismo no hace daño
+            self._sucias |= sucias - self._borradas
+            self._borradas |= borradas - self._sucias
+            raise
+
+    def _abrir_y_cargar(self):
+        self._conexion = sqlite3.connect(self.ruta_sqlite, check_same_thread=False)
+        with self._lock_db:
+            self._conexion.execute("PRAGMA journal_mode=WAL")
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS sesiones ("
+                "user_id INTEGER PRIMARY KEY, ticket TEXT NOT NULL, expira REAL NOT NULL)"
+            )
+            self._conexion.execute("DELETE FROM sesiones WHERE expira <= ?", (time.time(),))
+            # Las que no caben en memoria tampoco se conservan en disco
+            self._conexion.execute(
+                "DELETE FROM sesiones WHERE user_id NOT IN "
+                "(SELECT user_id FROM sesiones ORDER BY expira DESC LIMIT ?)",
+                (self.max_entradas,)
+            )
+            self._conexion.commit()
+            # Las más recientes al final, como en el OrderedDict
+            filas = self._conexion.execute(
+                "SELECT user_id, ticket, expira FROM sesiones ORDER BY expira DESC LIMIT ?",
+                (self.max_entradas,)
+            ).fetchall()
+        return list(reversed(filas))
+
+    def _escribir(self, escribir, borrar, cerrar=False):
+        with self._lock_db:
+            conexion = self._conexion
+            try:
+                conexion.executemany(
+                    "INSERT INTO sesiones (user_id, ticket, expira) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET ticket = excluded.ticket, expira = excluded.expira",
+                    escribir
+                )
+                conexion.executemany("DELETE FROM sesiones WHERE user_id = ?", borrar)
+                conexion.commit()
+            finally:
+                if cerrar:
+                    self._conexion = None
+                    conexion.close()
@@ -0,0 +1,41 @@
+import time
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """
+    Tiempos por etapa de un ticket más datos asociados (tamaño de imagen,
+    número de cajas OCR...). Es serializable, así que los workers del pool
+    pueden devolverlo al proceso principal.
+    """
+
+    def __init__(self):
+        self.etapas = {}  # nombre -> segundos (acumulados si se repite)
+        self.datos = {}
+
+    @contextmanager
+    def medir(self, etapa):
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.etapas[etapa] = self.etapas.get(etapa, 0.0) + time.perf_counter() - inicio
+
+    def sumar(self, etapa, segundos):
+        """Añade un tiempo medido fuera (p.ej. la espera en la cola del planificador)."""
+        self.etapas[etapa] = self.etapas.get(etapa, 0.0) + segundos
+
+    def anotar(self, **datos):
+        self.datos.update(datos)
+
+    def fusionar(self, otro):
+        for etapa, segundos in otro.etapas.items():
+            self.etapas[etapa] = self.etapas.get(etapa, 0.0) + segundos
+        self.datos.update(otro.datos)
+
+    def to_dict(self):
+        """Formato para los logs JSON (milisegundos)."""
+        return {
+            "stages_ms": {etapa: round(s * 1000, 2) for etapa, s in self.etapas.items()},
+            **self.datos,
+        }
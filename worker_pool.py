@@ -0,0 +1,144 @@
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+
+from pipeline import factor_escala, preprocesar
+from utils.timing import StageTimer
+
+# Pipeline propio de cada proceso worker (se crea una sola vez en el arranque)
+_pipeline = None
+
+
+def _init_worker(torch_threads, pipeline_kwargs):
+    """Inicializador de cada proceso: fija los hilos de torch y carga EasyOCR."""
+    global _pipeline
+    if torch_threads:
+        import torch
+        torch.set_num_threads(torch_threads)
+
+    from pipeline import TicketPipeline
+    _pipeline = TicketPipeline(**pipeline_kwargs)
+    _pipeline.calentar()
+
+
+def _ping():
+    return os.getpid()
+
+
+def _procesar_en_worker(shm_name, shape, dtype, escala):
+    """
+    Lee la imagen desde memoria compartida y ejecuta OCR + parseo.
+    Devuelve (resultado, lineas, tiempos).
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        img = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        try:
+            tiempos = StageTimer()
+            resultado, lineas = _pipeline.procesar_imagen(img, escala, tiempos)
+            return resultado, lineas, tiempos
+        finally:
+            # Liberar la vista antes de cerrar el segmento
+            del img
+    finally:
+        shm.close()
+
+
+def _procesar_ruta_en_worker(ruta):
+    """
+    Procesa un fichero de imagen completo (preprocesado incluido) en el worker.
+    Usado por el modo batch (batch.py). Devuelve (resultado, lineas, tiempos).
+    """
+    tiempos = StageTimer()
+    with tiempos.medir("total"):
+        resultado, lineas = _pipeline.procesar_ticket(ruta, tiempos)
+    return resultado, lineas, tiempos
+
+
+class OCRWorkerPool:
+    """
+    Pool de procesos con un TicketPipeline precalentado en cada worker.
+    La imagen preprocesada viaja por memoria compartida en lugar de serializarse.
+
+    num_workers: procesos del pool (por defecto, número de CPUs)
+    torch_threads: hilos intra-op de torch por worker
+                   (por defecto, CPUs / num_workers para no sobresuscribir)
+    pipeline_kwargs: argumentos para el TicketPipeline de cada worker; sus
+                     opciones de recorte y escala valen también para el
+                     preprocesado de procesar_ticket
+    """
+
+    def __init__(self, num_workers=None, torch_threads=None, **pipeline_kwargs):
+        cpus = os.cpu_count() or 1
+        self.num_workers = num_workers or cpus
+        self.torch_threads = torch_threads or max(1, cpus // self.num_workers)
+        self.pipeline_kwargs = pipeline_kwargs
+        self.executor = self._crear_executor()
+
+    def _crear_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.torch_threads, self.pipeline_kwargs)
+        )
+
+    def reiniciar(self):
+        """
+        Sustituye un pool roto (BrokenProcessPool: un worker murió, p.ej. por
+        falta de memoria) por uno nuevo con los modelos ya cargados.
+        """
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.executor = self._crear_executor()
+        self.precalentar()
+
+    def precalentar(self):
+        """Arranca todos los workers (y carga sus modelos) antes de recibir tickets."""
+        futures = [self.executor.submit(_ping) for _ in range(self.num_workers)]
+        return [f.result() for f in futures]
+
+    async def procesar_ticket(self, imagen, tiempos=None):
+        """
+        Como TicketPipeline.procesar_ticket: recorta y preprocesa la imagen en
+        un hilo de este proceso (con las opciones de pipeline_kwargs) y hace el
+        OCR y el parseo en un worker.
+        imagen: ruta, bytes de la foto o ndarray.
+        """
+        tiempos = tiempos if tiempos is not None else StageTimer()
+        scale_factor = factor_escala(self.pipeline_kwargs.get("escalado_adaptativo", False))
+        img, escala = await asyncio.to_thread(preprocesar, imagen, tiempos, scale_factor,
+                                              self.pipeline_kwargs.get("recortar", False))
+        return await self.procesar(img, escala, tiempos)
+
+    async def procesar(self, img, escala=2, tiempos=None):
+        """
+        Procesa una imagen preprocesada en un worker sin bloquear el event loop.
+        escala: factor aplicado en el preprocesado.
+        tiempos: StageTimer opcional donde se añaden los tiempos del worker.
+        """
+        shm = shared_memory.SharedMemory(create=True, size=max(img.nbytes, 1))
+        try:
+            destino = np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)
+            destino[:] = img
+            del destino
+
+            loop = asyncio.get_running_loop()
+            resultado, lineas, tiempos_worker = await loop.run_in_executor(
+                self.executor, _procesar_en_worker, shm.name, img.shape, img.dtype.str, escala
+            )
+            if tiempos is not None:
+                tiempos.fusionar(tiempos_worker)
+            return resultado, lineas
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def enviar_ruta(self, ruta):
+        """Encola un fichero de imagen (modo batch). Devuelve un Future con (resultado, lineas, tiempos)."""
+        return self.executor.submit(_procesar_ruta_en_worker, ruta)
+
+    def cerrar(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)